@@ -1,11 +1,24 @@
 import os
 import logging
+import multiprocessing
 from logging import Formatter, FileHandler
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Response, request, jsonify, render_template
 import json
 
-import data_manager
-from ocr import process_image
+import batch_scan
+import boss_refresh
+import config
+import fetch
+import jobs
+import layout
+import metrics
+import ocr_memo
+import ocr_pool
+import profiling
+import result_cache
+import sweep
+import threshold_plans
+from ocr import SCAN_TYPES, THRESHOLDS, process_image, warm_up_engine
 
 app = Flask(__name__)
 _VERSION = 1  # API version
@@ -32,17 +45,83 @@ def profile():
 def boss():
     return process_request(request, "boss")
 
-@app.route('/v{}/setup'.format(_VERSION), methods=["GET"])
-def setup():
-    status = "failure"
+@app.route('/v{}/batch'.format(_VERSION), methods=["POST"])
+def batch():
     try:
-        app.boss_list, boss_level_dict = data_manager.populate_boss_list()
-        app.boss_cp_map = data_manager.calculate_boss_cp_list(boss_level_dict)
-        app.logger.info("Boss List updated")
-        status = "success"
+        items = request.get_json()['items']
+        if not isinstance(items, list):
+            raise TypeError
     except:
-        app.logger.info("Failed to update Boss List")
-    return jsonify({"status": status})
+        return jsonify(
+            {"error": "Could not get 'items' from the request object. "
+                      "Send {'items': [{'image_url': 'http://.....', 'scan_type': 'raid'}, ...]}",
+             "data": request.data.decode('utf-8', 'replace')}
+        )
+    if len(items) > config.BATCH_MAX_ITEMS:
+        return jsonify({"error": "At most {} items per batch.".format(config.BATCH_MAX_ITEMS)})
+    results = batch_scan.scan_batch(items, boss_refresh.current())
+    return jsonify({"results": results})
+
+@app.route('/v{}/jobs'.format(_VERSION), methods=["POST"])
+def submit_job():
+    data = request.get_json(silent=True) or {}
+    url = data.get('image_url')
+    scan_type = data.get('scan_type')
+    if not url or scan_type not in SCAN_TYPES:
+        return jsonify(
+            {"error": "Send {'image_url': 'http://.....', 'scan_type': 'raid'} "
+                      "with an optional 'callback_url' and 'deadline'.",
+             "data": request.data.decode('utf-8', 'replace')}
+        )
+    try:
+        job = app.job_queue.submit(url, scan_type, data.get('callback_url'), _deadline(request))
+    except jobs.QueueFull:
+        return jsonify({"error": "Job queue is full. Try again later."}), 503
+    except fetch.UnsafeURL as e:
+        return jsonify({"error": str(e), "callback_url": data.get('callback_url')}), 400
+    return jsonify(job.to_dict())
+
+@app.route('/v{}/jobs/<job_id>'.format(_VERSION), methods=["GET"])
+def get_job(job_id):
+    wait = request.args.get('wait', 0, type=float)
+    job = app.job_queue.get(job_id, wait=wait, max_wait=config.JOB_SYNC_MAX_WAIT)
+    if job is None:
+        return jsonify({"error": "Unknown job.", "job_id": job_id}), 404
+    return jsonify(job)
+
+@app.route('/v{}/setup'.format(_VERSION), methods=["GET"])
+def setup():
+    # The refresh runs in the background; poll this or /v1/stats for its outcome
+    status = "started" if boss_refresh.trigger() else "running"
+    return jsonify({"status": status, "refresh": boss_refresh.status()})
+
+@app.route('/v{}/stats'.format(_VERSION), methods=["GET"])
+def stats():
+    return jsonify({"fetch": fetch.stats(), "cache": result_cache.stats(), "jobs": app.job_queue.stats(),
+                    "bosses": boss_refresh.status(), "layout": layout.stats(),
+                    "ocr_memo": ocr_memo.stats(), "ocr_pool": ocr_pool.stats()})
+
+@app.route('/metrics', methods=["GET"])
+def prometheus_metrics():
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+@app.route('/v{}/thresholds'.format(_VERSION), methods=["GET"])
+def thresholds():
+    return jsonify({"fields": threshold_plans.snapshot(THRESHOLDS), "defaults": THRESHOLDS})
+
+@app.route('/v{}/thresholds/reset'.format(_VERSION), methods=["POST"])
+def reset_thresholds():
+    if not profiling.authorized(request.headers.get('X-Profile-Token')):
+        return jsonify({"error": "Resetting thresholds needs a valid X-Profile-Token header."}), 403
+    field = (request.get_json(silent=True) or {}).get('field')
+    threshold_plans.reset(field)
+    return jsonify({"status": "success", "field": field})
+
+def _deadline(request):
+    """The request's latency budget in seconds: its 'deadline' if sent, else SCAN_DEADLINE"""
+    data = request.get_json(silent=True)
+    return sweep.scan_deadline(data.get('deadline') if isinstance(data, dict) else None)
 
 def process_request(request, request_type):
     # Read the URL
@@ -64,10 +143,24 @@ def process_request(request, request_type):
              "data": request.data }
         )
 
+    profile = request.args.get('profile') == '1'
+    if profile and not profiling.authorized(request.headers.get('X-Profile-Token')):
+        return jsonify({"error": "Profiling needs a valid X-Profile-Token header."}), 403
+
     # Process the image
     print("URL extracted:", url)
+    report = None
     try:
-        output = process_image(url, request_type, app.boss_list, app.boss_cp_map)
+        if profile:
+            # Profiled scans skip the result cache, which would hide the work being profiled
+            output, report = profiling.profile(process_image, url, request_type, boss_refresh.current(), False,
+                                               _deadline(request), dump=request.args.get('dump') == '1',
+                                               label=request_type)
+        else:
+            output = process_image(url, request_type, boss_refresh.current(), deadline=_deadline(request))
+    except fetch.FetchError as e:
+        return jsonify({"error": str(e),
+                        "url": url})
     except OSError:
         return jsonify({"error": "URL not recognized as image.",
                         "url": url})
@@ -77,6 +170,8 @@ def process_request(request, request_type):
              "request": request.data}
         )
     app.logger.info(output)
+    if report is not None:
+        return jsonify({"output": output, "profile": report})
     return jsonify({"output": output})
 
 
@@ -100,11 +195,12 @@ if not app.debug:
     app.logger.addHandler(file_handler)
     app.logger.info('errors')
 
-app.boss_list, boss_level_dict = data_manager.populate_boss_list()
-app.logger.info(boss_level_dict)
-app.boss_cp_map = data_manager.calculate_boss_cp_list(boss_level_dict)
-app.logger.info(app.boss_cp_map)
-app.logger.info("Boss List populated")
+# OCR pool workers started with spawn import the main module again as __mp_main__, so
+# under `python app.py` this runs only in the server process, not in each worker
+if multiprocessing.current_process().name == 'MainProcess':
+    warm_up_engine()
+    ocr_pool.start()
+    app.job_queue = jobs.JobQueue(boss_refresh.current)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,240 @@
+"""Async front end serving the same API as app.py
+
+Downloads run on an httpx.AsyncClient in the event loop, so a pending download
+costs a socket rather than a worker; a batch downloads all its items that way at
+once. Decoding and OCR run on a thread pool of ASGI_SCAN_WORKERS per process,
+which keeps the cores busy while other requests are still downloading.
+
+    gunicorn -c gunicorn_config.py -k uvicorn.workers.UvicornWorker -w 4 asgi_app:app
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+from starlette.templating import Jinja2Templates
+
+import batch_scan
+import boss_refresh
+import config
+import fetch
+import jobs
+import layout
+import metrics
+import ocr_memo
+import ocr_pool
+import profiling
+import result_cache
+import sweep
+import threshold_plans
+from ocr import SCAN_TYPES, THRESHOLDS, process_image_data, warm_up_engine
+
+_VERSION = 1  # API version
+# A budget already spent on the download still lets the scan start, so every field is reported as skipped
+_SPENT_BUDGET = 0.001
+
+logger = logging.getLogger(__name__)
+_executor = ThreadPoolExecutor(max_workers=config.ASGI_SCAN_WORKERS)
+# Where Flask looks for app.py's templates
+templates = Jinja2Templates(directory=os.path.join(config.basedir, 'templates'))
+
+
+def _path(name):
+    return '/v{}/{}'.format(_VERSION, name)
+
+
+def _parse(body):
+    try:
+        return json.loads(body.decode('utf-8'))
+    except ValueError:
+        return None
+
+
+def _deadline(data):
+    """The request's latency budget in seconds: its 'deadline' if sent, else SCAN_DEADLINE"""
+    return sweep.scan_deadline(data.get('deadline') if isinstance(data, dict) else None)
+
+
+def _scan(data, scan_type, deadline, profile, dump):
+    """Runs on the scan pool: decodes and scans the downloaded bytes"""
+    bosses = boss_refresh.current()
+    if profile:
+        # Profiled scans skip the result cache, which would hide the work being profiled
+        return profiling.profile(process_image_data, data, scan_type, bosses, False, deadline, dump=dump,
+                                 label=scan_type)
+    return process_image_data(data, scan_type, bosses, deadline=deadline), None
+
+
+async def process_request(request, request_type):
+    start = time.monotonic()
+    body = await request.body()
+    data = _parse(body)
+    url = (data.get('image_url') or data.get('img_url')) if isinstance(data, dict) else None
+    if not url:
+        return JSONResponse({"error": "Could not get 'image_url' from the request object. "
+                                      "Did you send {'image_url': 'http://.....'}",
+                             "data": body.decode('utf-8', 'replace')})
+
+    profile = request.query_params.get('profile') == '1'
+    if profile and not profiling.authorized(request.headers.get('X-Profile-Token')):
+        return JSONResponse({"error": "Profiling needs a valid X-Profile-Token header."}, status_code=403)
+
+    try:
+        image_data = await request.app.state.fetcher.fetch(url)
+    except fetch.FetchError as e:
+        metrics.count_error(request_type, 'fetch')
+        return JSONResponse({"error": str(e), "url": url})
+
+    deadline = _deadline(data)
+    if deadline is not None:
+        deadline = max(_SPENT_BUDGET, deadline - (time.monotonic() - start))
+    loop = asyncio.get_running_loop()
+    try:
+        output, report = await loop.run_in_executor(_executor, _scan, image_data, request_type, deadline,
+                                                    profile, request.query_params.get('dump') == '1')
+    except OSError:
+        return JSONResponse({"error": "URL not recognized as image.", "url": url})
+    except Exception:
+        logger.exception("Scanning %s failed", url)
+        return JSONResponse({"error": "Unknown processing image.", "request": body.decode('utf-8', 'replace')})
+    logger.info(output)
+    if report is not None:
+        return JSONResponse({"output": output, "profile": report})
+    return JSONResponse({"output": output})
+
+
+async def main(request):
+    return templates.TemplateResponse('index.html', {'request': request})
+
+
+def _scan_route(scan_type):
+    async def endpoint(request):
+        return await process_request(request, scan_type)
+    return Route(_path(scan_type), endpoint, methods=["POST"], name=scan_type)
+
+
+async def batch(request):
+    data = _parse(await request.body())
+    items = data.get('items') if isinstance(data, dict) else None
+    if not isinstance(items, list):
+        return JSONResponse({"error": "Could not get 'items' from the request object. "
+                                      "Send {'items': [{'image_url': 'http://.....', 'scan_type': 'raid'}, ...]}"})
+    if len(items) > config.BATCH_MAX_ITEMS:
+        return JSONResponse({"error": "At most {} items per batch.".format(config.BATCH_MAX_ITEMS)})
+    fetcher = request.app.state.fetcher
+    results = await asyncio.gather(*[_batch_item(fetcher, item) for item in items])
+    return JSONResponse({"results": results})
+
+
+async def _batch_item(fetcher, item):
+    """Downloads and scans one batch item, returning its {"output": ...} or {"error": ...} dict"""
+    error = batch_scan.item_error(item)
+    if error is not None:
+        return error
+    url, scan_type = item['image_url'], item['scan_type']
+    try:
+        data = await fetcher.fetch(url)
+    except fetch.FetchError as e:
+        metrics.count_error(scan_type, 'fetch')
+        return {"error": str(e), "url": url}
+    loop = asyncio.get_running_loop()
+    try:
+        output, __ = await loop.run_in_executor(_executor, _scan, data, scan_type,
+                                                sweep.scan_deadline(item.get('deadline')), False, False)
+    except OSError:
+        return {"error": "URL not recognized as image.", "url": url}
+    except Exception:
+        logger.exception("Scanning %s failed", url)
+        return {"error": "Unknown processing image.", "url": url}
+    return {"output": output}
+
+
+async def submit_job(request):
+    data = _parse(await request.body())
+    data = data if isinstance(data, dict) else {}
+    url = data.get('image_url')
+    scan_type = data.get('scan_type')
+    if not url or scan_type not in SCAN_TYPES:
+        return JSONResponse({"error": "Send {'image_url': 'http://.....', 'scan_type': 'raid'} "
+                                      "with an optional 'callback_url' and 'deadline'."})
+    try:
+        job = await run_in_threadpool(request.app.state.job_queue.submit, url, scan_type, data.get('callback_url'),
+                                      _deadline(data))
+    except jobs.QueueFull:
+        return JSONResponse({"error": "Job queue is full. Try again later."}, status_code=503)
+    except fetch.UnsafeURL as e:
+        return JSONResponse({"error": str(e), "callback_url": data.get('callback_url')}, status_code=400)
+    return JSONResponse(job.to_dict())
+
+
+async def get_job(request):
+    job_id = request.path_params['job_id']
+    try:
+        wait = float(request.query_params.get('wait', 0))
+    except ValueError:
+        wait = 0
+    job = await run_in_threadpool(request.app.state.job_queue.get, job_id, wait)
+    if job is None:
+        return JSONResponse({"error": "Unknown job.", "job_id": job_id}, status_code=404)
+    return JSONResponse(job)
+
+
+async def setup(request):
+    # The refresh runs in the background; poll this or /v1/stats for its outcome
+    status = "started" if boss_refresh.trigger() else "running"
+    return JSONResponse({"status": status, "refresh": boss_refresh.status()})
+
+
+async def stats(request):
+    return JSONResponse({"fetch": fetch.stats(), "async_fetch": request.app.state.fetcher.stats(),
+                         "cache": result_cache.stats(), "jobs": request.app.state.job_queue.stats(),
+                         "bosses": boss_refresh.status(), "layout": layout.stats(),
+                         "ocr_memo": ocr_memo.stats(), "ocr_pool": ocr_pool.stats()})
+
+
+async def prometheus_metrics(request):
+    body, content_type = metrics.render()
+    return Response(body, headers={'Content-Type': content_type})
+
+
+async def thresholds(request):
+    return JSONResponse({"fields": threshold_plans.snapshot(THRESHOLDS), "defaults": THRESHOLDS})
+
+
+async def reset_thresholds(request):
+    if not profiling.authorized(request.headers.get('X-Profile-Token')):
+        return JSONResponse({"error": "Resetting thresholds needs a valid X-Profile-Token header."}, status_code=403)
+    data = _parse(await request.body())
+    field = data.get('field') if isinstance(data, dict) else None
+    await run_in_threadpool(threshold_plans.reset, field)
+    return JSONResponse({"status": "success", "field": field})
+
+
+async def startup():
+    warm_up_engine()
+    ocr_pool.start()
+    app.state.job_queue = jobs.JobQueue(boss_refresh.current)
+    app.state.fetcher = fetch.AsyncImageFetcher()
+
+
+async def shutdown():
+    await app.state.fetcher.close()
+    _executor.shutdown(wait=False)
+
+
+app = Starlette(routes=[Route('/', main, methods=["GET"])] + [_scan_route(s) for s in SCAN_TYPES] + [
+    Route(_path('batch'), batch, methods=["POST"]),
+    Route(_path('jobs'), submit_job, methods=["POST"]),
+    Route(_path('jobs/{job_id}'), get_job, methods=["GET"]),
+    Route(_path('setup'), setup, methods=["GET"]),
+    Route(_path('stats'), stats, methods=["GET"]),
+    Route('/metrics', prometheus_metrics, methods=["GET"]),
+    Route(_path('thresholds'), thresholds, methods=["GET"]),
+    Route(_path('thresholds/reset'), reset_thresholds, methods=["POST"]),
+], on_startup=[startup], on_shutdown=[shutdown])
@@ -0,0 +1,75 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import config
+import fetch
+import metrics
+import ocr
+import sweep
+
+
+_fetch_executor = ThreadPoolExecutor(max_workers=config.BATCH_FETCH_WORKERS)
+_scan_executor = ThreadPoolExecutor(max_workers=config.BATCH_SCAN_WORKERS)
+
+
+def item_error(item):
+    """Returns an error dict if item isn't a usable {image_url, scan_type} dict, else None"""
+    if not isinstance(item, dict) or not item.get('image_url'):
+        return {"error": "Item needs an 'image_url'.", "item": item}
+    if item.get('scan_type') not in ocr.SCAN_TYPES:
+        return {"error": "Item 'scan_type' must be one of {}.".format(', '.join(ocr.SCAN_TYPES)),
+                "item": item}
+    return None
+
+
+def scan_item(image, scan_type, bosses, deadline):
+    """Scans one downloaded item within its own budget of deadline seconds"""
+    with sweep.budget_scope(deadline):
+        return ocr.process_decoded_image(image, scan_type, bosses)
+
+
+def scan_batch(items, bosses):
+    """Scans a list of {image_url, scan_type} items
+
+    Downloads run on their own pool and each image is handed to the scan pool as
+    soon as it arrives, so OCR of early images overlaps the remaining downloads.
+    Each item's scan gets its own latency budget, its 'deadline' or SCAN_DEADLINE,
+    counted from when the scan starts.
+    Returns one {"output": ...} or {"error": ...} dict per item, in order.
+    """
+    results = [None] * len(items)
+    fetches = {}
+    for index, item in enumerate(items):
+        results[index] = item_error(item)
+        if results[index] is None:
+            fetches[_fetch_executor.submit(fetch.get_image, item['image_url'])] = index
+
+    scans = {}
+    for future in as_completed(fetches):
+        index = fetches[future]
+        item = items[index]
+        try:
+            image = future.result()
+        except fetch.FetchError as e:
+            metrics.count_error(item['scan_type'], 'fetch')
+            results[index] = {"error": str(e), "url": item['image_url']}
+            continue
+        except OSError:
+            metrics.count_error(item['scan_type'], 'image')
+            results[index] = {"error": "URL not recognized as image.", "url": item['image_url']}
+            continue
+        except Exception:
+            # e.g. a decompression bomb; fails this item rather than the whole batch
+            metrics.count_error(item['scan_type'], 'image')
+            results[index] = {"error": "Unknown processing image.", "url": item['image_url']}
+            continue
+        scans[index] = _scan_executor.submit(scan_item, image, item['scan_type'], bosses,
+                                             sweep.scan_deadline(item.get('deadline')))
+
+    for index, future in scans.items():
+        try:
+            results[index] = {"output": future.result()}
+        except OSError:
+            results[index] = {"error": "URL not recognized as image.", "url": items[index]['image_url']}
+        except Exception:
+            results[index] = {"error": "Unknown processing image.", "url": items[index]['image_url']}
+    return results
@@ -0,0 +1,402 @@
+"""Benchmarks the scanners on locally rendered raid, egg, profile and EX pass screenshots
+
+Usage: python benchmark.py [--samples 5] [--resolution 1080x1920 ...] [--output results.json] [--compare baseline.json]
+       python benchmark.py --height 960 --height 1280 --height 1600 --height 0
+       python benchmark.py --layout
+
+Every screenshot is drawn with PIL from known values, so each scanned field can
+be scored against its ground truth. Reports per-field accuracy, wall time, peak
+traced memory and Tesseract calls for each scan, and exits non-zero when
+--compare finds a regression against an earlier run. With --height, the corpus is
+scanned again at each working height to chart accuracy against time. With --layout,
+it is scanned with fixed boxes and then with anchor detection, to put the accuracy
+of detected boxes next to the time they save.
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from PIL import Image, ImageDraw, ImageFont
+
+import config
+import data_manager
+import digits
+import layout
+import ocr
+import ocr_engine
+import ocr_memo
+from image_context import ImageContext
+from matcher import BossMatcher
+
+
+RESOLUTIONS = ['640x1136', '720x1280', '1080x1920', '1080x2280', '1440x2960', '1440x3200']
+_FONT_DIRS = ['/usr/share/fonts', '/Library/Fonts', 'C:\\Windows\\Fonts']
+_FONT_NAMES = ['DejaVuSans-Bold.ttf', 'LiberationSans-Bold.ttf', 'Arial Bold.ttf', 'arialbd.ttf']
+
+# Raid bosses the corpus draws from, by tier
+_BOSSES = {'1': ['shinx', 'klink', 'magikarp'], '3': ['machamp', 'alolan raichu', 'sneasel'],
+           '5': ['mewtwo', 'groudon', 'regice']}
+_GYM_WORDS = ['Memorial', 'Fountain', 'Park', 'Library', 'Mural', 'Church', 'Statue', 'Garden',
+              'Trailhead', 'Plaza', 'Community', 'Bridge', 'Water', 'Tower', 'Station', 'Sign']
+_TRAINER_NAMES = ['Kyogre', 'RaidLeader', 'MysticMaple', 'ValorVince', 'SparkFan', 'Groudonia',
+                  'Trainer', 'CatchEmAll', 'PidgeyPro']
+_MONTHS = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September',
+           'October', 'November', 'December']
+_LOCATIONS = ['Seattle, WA, United States', 'Portland, OR, United States', 'Austin, TX, United States']
+_TEAM_COLORS = {'instinct': (250, 215, 40), 'mystic': (30, 110, 250), 'valor': (240, 40, 40)}
+
+WHITE = (255, 255, 255)
+BLACK = (0, 0, 0)
+
+
+def find_font():
+    for font_dir in _FONT_DIRS:
+        for name in _FONT_NAMES:
+            found = glob.glob(os.path.join(font_dir, '**', name), recursive=True)
+            if found:
+                return found[0]
+    return None
+
+
+class Canvas(object):
+    """A screenshot at one resolution, drawn in fractions of its width and height"""
+
+    def __init__(self, resolution, background, font_path):
+        self.width, self.height = resolution
+        self.image = Image.new('RGB', resolution, background)
+        self.draw = ImageDraw.Draw(self.image)
+        self.font_path = font_path
+
+    def font(self, size):
+        return ImageFont.truetype(self.font_path, max(8, round(size * self.height)))
+
+    def fill(self, box, color):
+        """Fills box, given as (miny, maxy, minx, maxx) fractions like the scanner crops"""
+        miny, maxy, minx, maxx = box
+        self.draw.rectangle([minx * self.width, miny * self.height, maxx * self.width, maxy * self.height],
+                            fill=color)
+
+    def text(self, x, y, text, size, color=WHITE, center=False):
+        font = self.font(size)
+        left = x * self.width
+        if center:
+            left -= font.getsize(text)[0] / 2
+        self.draw.text((left, y * self.height), text, fill=color, font=font)
+
+
+def _phone_time(rng):
+    return '{}:{:02d}'.format(rng.randint(1, 12), rng.randint(0, 59))
+
+
+def _timer(rng):
+    return '{}:{:02d}:{:02d}'.format(rng.randint(0, 1), rng.randint(0, 59), rng.randint(0, 59))
+
+
+def _gym_name(rng):
+    return ' '.join(rng.sample(_GYM_WORDS, rng.randint(2, 3)))
+
+
+def _raid_background(rng, resolution, font_path, phone_time, gym):
+    canvas = Canvas(resolution, (rng.randint(30, 70), rng.randint(60, 90), rng.randint(60, 90)), font_path)
+    # Light status bar with the clock in dark text, then the gym name in white below it
+    canvas.fill((0, .035, 0, 1), (245, 245, 245))
+    canvas.text(.03, .005, phone_time, .022, BLACK)
+    canvas.text(.18, .075, gym, .035)
+    return canvas
+
+
+def render_egg(rng, resolution, font_path, bosses):
+    truth = {'phone_time': _phone_time(rng), 'names': _gym_name(rng), 'egg_time': _timer(rng),
+             's_tier': rng.choice(sorted(_BOSSES)), 'boss': None, 'expire_time': None}
+    canvas = _raid_background(rng, resolution, font_path, truth['phone_time'], truth['names'])
+    canvas.text(.5, .2, truth['egg_time'], .045, center=True)
+    canvas.text(.5, .3, '@' * int(truth['s_tier']), .035, center=True)
+    return canvas.image, truth
+
+
+def render_hatched(rng, resolution, font_path, bosses):
+    tier = rng.choice(sorted(_BOSSES))
+    boss = rng.choice(_BOSSES[tier])
+    cp = next(cp for cp, name in bosses.boss_cp_map.items() if name == boss)
+    truth = {'phone_time': _phone_time(rng), 'names': _gym_name(rng), 'egg_time': None, 's_tier': None,
+             'boss': boss, 'expire_time': _timer(rng)}
+    canvas = _raid_background(rng, resolution, font_path, truth['phone_time'], truth['names'])
+    canvas.text(.5, .165, cp, .055, center=True)
+    canvas.text(.5, .26, boss.title(), .035, center=True)
+    canvas.fill((.53, .63, .7, .96), (20, 30, 40))
+    canvas.text(.73, .56, truth['expire_time'], .03)
+    return canvas.image, truth
+
+
+def render_profile(rng, resolution, font_path, bosses):
+    team = rng.choice(sorted(_TEAM_COLORS))
+    level = rng.randint(5, 40)
+    xp = rng.randint(1000, 999999) if level < 40 else None
+    truth = {'team ': team, 'level': str(level), 'trainer_name': rng.choice(_TRAINER_NAMES),
+             'xp': str(xp) if xp else None}
+    canvas = Canvas(resolution, (rng.randint(20, 45), rng.randint(20, 45), rng.randint(30, 60)), font_path)
+    canvas.fill((0, 1, 0, .03), _TEAM_COLORS[team])
+    canvas.text(.07, .145, truth['trainer_name'], .03)
+    canvas.text(.07, .195, '& Buddy', .025)
+    canvas.text(.07, .56, truth['level'], .05)
+    if xp:
+        canvas.text(.57, .62, '{:,} / {:,}'.format(xp, xp + rng.randint(1000, 500000)), .025)
+    return canvas.image, truth
+
+
+def render_expass(rng, resolution, font_path, bosses):
+    start_hour = rng.randint(1, 11)
+    date = '{} {} {}:00 PM - {}:45 PM'.format(rng.choice(_MONTHS), rng.randint(1, 28), start_hour, start_hour)
+    truth = {'date': date, 'gym': _gym_name(rng), 'location': rng.choice(_LOCATIONS)}
+    canvas = Canvas(resolution, (rng.randint(20, 50), rng.randint(20, 50), rng.randint(40, 80)), font_path)
+    canvas.text(.14, .21, truth['date'], .022)
+    canvas.text(.14, .26, truth['gym'], .022)
+    canvas.text(.14, .31, truth['location'] + ' ', .022)
+    return canvas.image, truth
+
+
+def _scan_raid(ctx, bosses):
+    result = ocr.scan_raid_photo(ctx, bosses)
+    return {field: result[field] for field in ('phone_time', 'names', 'egg_time', 's_tier', 'boss', 'expire_time')}
+
+
+def _scan_boss(ctx, bosses):
+    boss, __ = ocr.check_boss_cp(ctx, bosses)
+    return {'boss': boss}
+
+
+def _scan_profile(ctx, bosses):
+    return ocr.scan_profile(ctx)
+
+
+def _scan_expass(ctx, bosses):
+    return ocr.check_gym_ex(ctx)
+
+
+# name: (renderers, scanner)
+SCANS = {
+    'raid': ([render_egg, render_hatched], _scan_raid),
+    'boss': ([render_hatched], _scan_boss),
+    'profile': ([render_profile], _scan_profile),
+    'expass': ([render_expass], _scan_expass),
+}
+
+
+def _normalize(value):
+    return ' '.join(str(value).lower().split())
+
+
+def _correct(field, expected, actual):
+    if field == 'names':
+        # check_gym_name returns one candidate per threshold; any of them naming the gym counts
+        return any(_normalize(expected) in _normalize(name) for name in actual or [])
+    if expected is None:
+        return actual is None
+    return actual is not None and _normalize(actual) == _normalize(expected)
+
+
+def _summary(values):
+    if not values:
+        return {'mean': 0.0, 'p50': 0.0, 'p95': 0.0, 'max': 0.0, 'total': 0.0}
+    ordered = sorted(values)
+    return {'mean': sum(ordered) / len(ordered), 'p50': ordered[len(ordered) // 2],
+            'p95': ordered[min(len(ordered) - 1, int(len(ordered) * .95))], 'max': ordered[-1],
+            'total': sum(ordered)}
+
+
+def run_scan(name, resolutions, samples, seed, font_path, bosses, trace_memory, working_height=None):
+    renderers, scanner = SCANS[name]
+    rng = random.Random('{}-{}'.format(seed, name))
+    fields, times, calls, skips, peaks, by_resolution = {}, [], [], [], [], {}
+    for resolution in resolutions:
+        label = '{}x{}'.format(*resolution)
+        resolution_hits = resolution_total = 0
+        resolution_times = []
+        for __ in range(samples):
+            image, truth = rng.choice(renderers)(rng, resolution, font_path, bosses)
+            calls_before, skips_before = ocr_engine.call_count(), ocr_memo.skip_count()
+            if trace_memory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            ctx = ImageContext(image, working_height)
+            ctx.layout = layout.resolve(ctx, name)
+            with ocr_memo.scope():
+                output = scanner(ctx, bosses)
+            elapsed = time.perf_counter() - start
+            if trace_memory:
+                peaks.append(tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+            times.append(elapsed)
+            resolution_times.append(elapsed)
+            calls.append(ocr_engine.call_count() - calls_before)
+            skips.append(ocr_memo.skip_count() - skips_before)
+            for field, expected in truth.items():
+                hit = _correct(field, expected, (output or {}).get(field))
+                counts = fields.setdefault(field, {'correct': 0, 'total': 0})
+                counts['correct'] += hit
+                counts['total'] += 1
+                resolution_hits += hit
+                resolution_total += 1
+        by_resolution[label] = {'accuracy': resolution_hits / resolution_total if resolution_total else 0.0,
+                                'mean_seconds': _summary(resolution_times)['mean']}
+    for counts in fields.values():
+        counts['accuracy'] = counts['correct'] / counts['total']
+    return {'samples': len(times), 'fields': fields, 'wall_seconds': _summary(times),
+            'tesseract_calls': _summary(calls), 'memo_skips': _summary(skips), 'peak_memory_bytes': max(peaks) if peaks else None,
+            'by_resolution': by_resolution}
+
+
+def height_curve(args, resolutions, font_path, bosses):
+    """Scans the same corpus at each working height, for picking WORKING_HEIGHT_<scan type>"""
+    curve = {}
+    for name in args.scan or sorted(SCANS):
+        curve[name] = {}
+        for height in args.height:
+            scan = run_scan(name, resolutions, args.samples, args.seed, font_path, bosses, False, height)
+            correct = sum(counts['correct'] for counts in scan['fields'].values())
+            total = sum(counts['total'] for counts in scan['fields'].values())
+            curve[name][str(height)] = {'accuracy': correct / total if total else 0.0,
+                                        'mean_seconds': scan['wall_seconds']['mean'],
+                                        'tesseract_calls': scan['tesseract_calls']['mean']}
+            print("{} at height {}: {:.1%} accurate, {:.3f}s mean".format(
+                name, height or 'full', curve[name][str(height)]['accuracy'], scan['wall_seconds']['mean']))
+    return curve
+
+
+def layout_curve(args, resolutions, font_path, bosses):
+    """Scans the same corpus with fixed boxes and with detected ones, for judging LAYOUT_DETECTION"""
+    curve = {}
+    detection = config.LAYOUT_DETECTION
+    try:
+        for name in args.scan or sorted(SCANS):
+            curve[name] = {}
+            for enabled in (False, True):
+                config.LAYOUT_DETECTION = enabled
+                layout.clear()
+                scan = run_scan(name, resolutions, args.samples, args.seed, font_path, bosses, False,
+                                config.WORKING_HEIGHTS.get(name))
+                correct = sum(counts['correct'] for counts in scan['fields'].values())
+                total = sum(counts['total'] for counts in scan['fields'].values())
+                label = 'detected' if enabled else 'fixed'
+                curve[name][label] = {'accuracy': correct / total if total else 0.0,
+                                      'mean_seconds': scan['wall_seconds']['mean'],
+                                      'tesseract_calls': scan['tesseract_calls']['mean']}
+                print("{} with {} boxes: {:.1%} accurate, {:.3f}s mean, {:.1f} Tesseract calls".format(
+                    name, label, curve[name][label]['accuracy'], scan['wall_seconds']['mean'],
+                    scan['tesseract_calls']['mean']))
+    finally:
+        config.LAYOUT_DETECTION = detection
+    return curve
+
+
+def compare(results, baseline, accuracy_tolerance, time_tolerance):
+    """Returns a description of each way results regressed against baseline"""
+    regressions = []
+    for name, scan in results['scans'].items():
+        before = baseline.get('scans', {}).get(name)
+        if not before:
+            continue
+        for field, counts in scan['fields'].items():
+            old = before['fields'].get(field)
+            if old and counts['accuracy'] < old['accuracy'] - accuracy_tolerance:
+                regressions.append('{} {} accuracy {:.1%} -> {:.1%}'.format(
+                    name, field, old['accuracy'], counts['accuracy']))
+        old_time, new_time = before['wall_seconds']['mean'], scan['wall_seconds']['mean']
+        if old_time and new_time > old_time * (1 + time_tolerance):
+            regressions.append('{} mean time {:.3f}s -> {:.3f}s'.format(name, old_time, new_time))
+        old_calls, new_calls = before['tesseract_calls']['mean'], scan['tesseract_calls']['mean']
+        if new_calls > old_calls * (1 + time_tolerance):
+            regressions.append('{} Tesseract calls per scan {:.1f} -> {:.1f}'.format(name, old_calls, new_calls))
+    return regressions
+
+
+def _parse_resolution(value):
+    try:
+        width, height = value.lower().split('x')
+        return int(width), int(height)
+    except ValueError:
+        raise argparse.ArgumentTypeError("Resolutions look like 1080x1920")
+
+
+def _print_report(results):
+    for name, scan in results['scans'].items():
+        print("{}: {} samples, {:.3f}s mean, {:.1f} Tesseract calls ({:.1f} skipped as repeats), peak {} bytes"
+              .format(name, scan['samples'], scan['wall_seconds']['mean'], scan['tesseract_calls']['mean'],
+                      scan['memo_skips']['mean'], scan['peak_memory_bytes']))
+        for field, counts in sorted(scan['fields'].items()):
+            print("    {:<14} {:>6.1%} ({}/{})".format(field, counts['accuracy'], counts['correct'], counts['total']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--samples', type=int, default=5, help='screenshots per scan and resolution')
+    parser.add_argument('--resolution', type=_parse_resolution, action='append',
+                        help='WIDTHxHEIGHT to render at; defaults to {}'.format(', '.join(RESOLUTIONS)))
+    parser.add_argument('--scan', choices=sorted(SCANS), action='append', help='defaults to every scan')
+    parser.add_argument('--height', type=int, action='append',
+                        help='also scan at this working height (0 for full size) to chart accuracy against time')
+    parser.add_argument('--layout', action='store_true',
+                        help='also scan with fixed and with detected field boxes to compare accuracy and time')
+    parser.add_argument('--font', help='bold TTF font to render with; defaults to a system font')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true', help='skip tracemalloc, which slows scans down')
+    parser.add_argument('--tuning', action='store_true', help='use and update the learned threshold orders')
+    parser.add_argument('--stacked', action='store_true',
+                        help='read each sweep\'s thresholds with one stacked Tesseract call (STACKED_SWEEP)')
+    parser.add_argument('--output', help='write the results as JSON, e.g. to make a new baseline')
+    parser.add_argument('--compare', help='baseline JSON to check the results against')
+    parser.add_argument('--accuracy-tolerance', type=float, default=.02)
+    parser.add_argument('--time-tolerance', type=float, default=.25)
+    args = parser.parse_args()
+
+    font_path = args.font or find_font()
+    if not font_path:
+        parser.error("No bold TTF font found; pass one with --font")
+    resolutions = args.resolution or [_parse_resolution(r) for r in RESOLUTIONS]
+    boss_level_dict = {tier: list(names) for tier, names in _BOSSES.items()}
+    bosses = BossMatcher(sum(_BOSSES.values(), []), data_manager.calculate_boss_cp_list(boss_level_dict))
+    # Learned threshold orders would make each run depend on the ones before it
+    config.THRESHOLD_TUNING = args.tuning
+    config.STACKED_SWEEP = args.stacked or config.STACKED_SWEEP
+    ocr.warm_up_engine()
+
+    results = {'meta': {'samples': args.samples, 'seed': args.seed, 'font': os.path.basename(font_path),
+                        'resolutions': ['{}x{}'.format(*r) for r in resolutions],
+                        'tesserocr': ocr_engine.tesserocr is not None, 'sweep_window': config.SWEEP_WINDOW,
+                        'threshold_tuning': args.tuning, 'stacked_sweep': config.STACKED_SWEEP,
+                        'layout_detection': config.LAYOUT_DETECTION,
+                        'digit_model': digits.available(),
+                        'python': platform.python_version(), 'created': time.time()},
+               'scans': {}}
+    for name in args.scan or sorted(SCANS):
+        results['scans'][name] = run_scan(name, resolutions, args.samples, args.seed, font_path, bosses,
+                                          not args.no_memory, config.WORKING_HEIGHTS.get(name))
+    _print_report(results)
+    if args.height:
+        results['heights'] = height_curve(args, resolutions, font_path, bosses)
+    if args.layout:
+        results['layouts'] = layout_curve(args, resolutions, font_path, bosses)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("Saved results to", args.output)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.accuracy_tolerance, args.time_tolerance)
+        for regression in regressions:
+            print("REGRESSION:", regression)
+        if regressions:
+            sys.exit(1)
+        print("No regressions against", args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import config
+import data_manager
+import result_cache
+from matcher import BossMatcher
+
+
+logger = logging.getLogger(__name__)
+
+
+def _cp_table():
+    if config.CP_TABLE_FALLBACK:
+        return data_manager.full_cp_table()
+    return None
+
+
+class BossRefresher(object):
+    """Keeps the current BossMatcher, refreshed from the boss page in the background
+
+    Startup loads the last snapshot from snapshot_path, so no worker waits on the
+    upstream to boot. Refreshes run on a background thread every interval seconds
+    (or when triggered) with a conditional GET. A new BossMatcher is built
+    completely before it replaces the old one, so a scan always sees a boss list
+    and CP map from the same refresh.
+
+    Each refresh writes the snapshot back, and a worker that finds a snapshot newer
+    than its own loads it instead of fetching, so gunicorn workers share refreshes.
+    """
+
+    def __init__(self, snapshot_path=None, interval=None, timeout=None):
+        self.snapshot_path = snapshot_path or config.BOSS_SNAPSHOT_PATH
+        self.interval = interval or config.BOSS_REFRESH_INTERVAL
+        self.timeout = timeout or config.BOSS_FETCH_TIMEOUT
+        self._bosses = BossMatcher([], {}, _cp_table())
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._refreshing = None
+        self._timer = None
+        self._status = {'source': None, 'updated': None, 'checked': None, 'error': None,
+                        'refreshes': 0, 'unchanged': 0, 'failures': 0}
+
+    def current(self):
+        """Returns the current BossMatcher"""
+        if self._timer is None:
+            self._start()
+        return self._bosses
+
+    def trigger(self):
+        """Starts a refresh in the background. Returns False if one is already running."""
+        if self._timer is None:
+            self._start()
+        with self._lock:
+            if self._refreshing is not None:
+                return False
+            self._refreshing = threading.Thread(target=self._run_refresh, daemon=True)
+            self._refreshing.start()
+            return True
+
+    def status(self):
+        with self._lock:
+            status = dict(self._status)
+            status['refreshing'] = self._refreshing is not None
+        bosses = self._bosses
+        status['bosses'] = len(bosses.boss_list)
+        status['cps'] = len(bosses.boss_cp_map)
+        return status
+
+    def version(self):
+        """When the boss list held was fetched, or None before one is loaded"""
+        snapshot = self._snapshot
+        return snapshot['fetched'] if snapshot else None
+
+    def reload(self):
+        """Takes the snapshot if it is newer than the boss list held, without fetching or refreshing in the background
+
+        Returns the current BossMatcher. For processes that follow another one's
+        refreshes, like OCR pool workers (see ocr_pool.py).
+        """
+        snapshot = self._read_snapshot()
+        if snapshot and (self._snapshot is None or snapshot['fetched'] > self._snapshot['fetched']):
+            self._swap(snapshot, 'snapshot')
+        return self._bosses
+
+    def refresh(self):
+        """Brings the boss list up to date from a newer snapshot or the boss page. Returns True if it changed."""
+        snapshot = self._read_snapshot()
+        if snapshot and (self._snapshot is None or snapshot['fetched'] > self._snapshot['fetched']):
+            changed = self._swap(snapshot, 'snapshot')
+            if time.time() - snapshot['fetched'] < self.interval:
+                return changed
+        previous = self._snapshot or {}
+        content, etag, last_modified = data_manager.fetch_boss_page(
+            previous.get('etag'), previous.get('last_modified'), timeout=self.timeout)
+        now = time.time()
+        with self._lock:
+            self._status['checked'] = now
+        if content is None:
+            with self._lock:
+                self._status['unchanged'] += 1
+            self._write_snapshot(dict(previous, fetched=now))
+            return False
+        boss_list, boss_level_dict = data_manager.parse_boss_page(content)
+        if not boss_list:
+            raise ValueError("No raid bosses found on the boss page")
+        snapshot = {'boss_list': boss_list, 'boss_level_dict': boss_level_dict,
+                    'etag': etag, 'last_modified': last_modified, 'fetched': now}
+        changed = self._swap(snapshot, 'upstream')
+        self._write_snapshot(snapshot)
+        return changed
+
+    def _start(self):
+        # Started on first use rather than at import, since gunicorn forks after importing the app
+        with self._lock:
+            if self._timer is not None:
+                return
+            self._timer = threading.Thread(target=self._periodic, daemon=True)
+        snapshot = self._read_snapshot()
+        if snapshot:
+            self._swap(snapshot, 'snapshot')
+        self._timer.start()
+
+    def _periodic(self):
+        # A worker without a usable snapshot refreshes straight away
+        if self._snapshot is None or time.time() - self._snapshot['fetched'] >= self.interval:
+            self.trigger()
+        while True:
+            time.sleep(self.interval)
+            self.trigger()
+
+    def _run_refresh(self):
+        try:
+            self.refresh()
+            with self._lock:
+                self._status['error'] = None
+        except Exception as e:
+            logger.warning("Boss list refresh failed: %s", e)
+            with self._lock:
+                self._status['error'] = str(e)
+                self._status['failures'] += 1
+        finally:
+            with self._lock:
+                self._refreshing = None
+
+    def _swap(self, snapshot, source):
+        current = self._snapshot
+        self._snapshot = snapshot
+        if current and (current['boss_list'], current['boss_level_dict']) == \
+                (snapshot['boss_list'], snapshot['boss_level_dict']):
+            return False
+        boss_cp_map = data_manager.calculate_boss_cp_list(snapshot['boss_level_dict'])
+        # One reference assignment, so scans see either the old pair or the new one
+        self._bosses = BossMatcher(snapshot['boss_list'], boss_cp_map, _cp_table())
+        result_cache.invalidate()
+        with self._lock:
+            self._status['source'] = source
+            self._status['updated'] = snapshot['fetched']
+            self._status['refreshes'] += 1
+        logger.info("Boss list updated from %s: %d bosses", source, len(snapshot['boss_list']))
+        return True
+
+    def _read_snapshot(self):
+        try:
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(snapshot, dict) or not snapshot.get('boss_list'):
+            return None
+        return snapshot
+
+    def _write_snapshot(self, snapshot):
+        if not snapshot.get('boss_list'):
+            return
+        tmp_path = '{}.{}.tmp'.format(self.snapshot_path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, self.snapshot_path)
+        except OSError as e:
+            logger.warning("Could not write boss snapshot: %s", e)
+
+
+# Built on first use: its BossMatcher loads the full CP table, which no worker should pay for at import
+_refresher = None
+_refresher_lock = threading.Lock()
+
+
+def _get():
+    global _refresher
+    if _refresher is None:
+        with _refresher_lock:
+            if _refresher is None:
+                _refresher = BossRefresher()
+    return _refresher
+
+
+def current():
+    return _get().current()
+
+
+def trigger():
+    return _get().trigger()
+
+
+def status():
+    return _get().status()
+
+
+def version():
+    return _get().version()
@@ -2,3 +2,127 @@ import os
 
 # Grabs the folder where the script runs.
 basedir = os.path.abspath(os.path.dirname(__file__))
+
+# Threads shared by every threshold sweep in a worker process
+SWEEP_WORKERS = int(os.environ.get('SWEEP_WORKERS', os.cpu_count() or 2))
+# Thresholds of a single sweep allowed in flight at once. 1 runs sweeps sequentially.
+SWEEP_WINDOW = int(os.environ.get('SWEEP_WINDOW', 4))
+# Threads running the field tasks of raid scans (see taskgraph.py)
+GRAPH_WORKERS = int(os.environ.get('GRAPH_WORKERS', 8))
+
+# Image downloads (see fetch.py)
+FETCH_CONNECT_TIMEOUT = float(os.environ.get('FETCH_CONNECT_TIMEOUT', 3.05))
+FETCH_READ_TIMEOUT = float(os.environ.get('FETCH_READ_TIMEOUT', 10))
+# Wall clock limit for a whole download, since the read timeout only bounds each socket read
+FETCH_TOTAL_TIMEOUT = float(os.environ.get('FETCH_TOTAL_TIMEOUT', 20))
+FETCH_MAX_BYTES = int(os.environ.get('FETCH_MAX_BYTES', 15 * 1024 * 1024))
+FETCH_POOL_SIZE = int(os.environ.get('FETCH_POOL_SIZE', 16))
+
+# Scan result cache keyed by perceptual hash (see result_cache.py)
+RESULT_CACHE_ENABLED = os.environ.get('RESULT_CACHE_ENABLED', '1') == '1'
+# Side of the difference-hash grid. Screenshots of the same boss only differ in small
+# text, so the grid has to be fine enough for timers and gym names to change the hash.
+RESULT_CACHE_HASH_SIZE = int(os.environ.get('RESULT_CACHE_HASH_SIZE', 32))
+# Differing hash bits still treated as the same screenshot (recompression noise).
+# Raid results carry timers, so raids only ever reuse an identical hash.
+RESULT_CACHE_MAX_DISTANCE = int(os.environ.get('RESULT_CACHE_MAX_DISTANCE', 12))
+RESULT_CACHE_TTL = float(os.environ.get('RESULT_CACHE_TTL', 15 * 60))
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', 2000))
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 16 * 1024 * 1024))
+
+# /v1/batch (see batch_scan.py)
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 50))
+BATCH_FETCH_WORKERS = int(os.environ.get('BATCH_FETCH_WORKERS', 8))
+# Each scan already spreads its thresholds over the sweep pool, so keep this small
+BATCH_SCAN_WORKERS = int(os.environ.get('BATCH_SCAN_WORKERS', 2))
+
+# Asynchronous scan jobs (see jobs.py)
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_QUEUE_SIZE = int(os.environ.get('JOB_QUEUE_SIZE', 64))
+# Job state is kept on disk so any gunicorn worker can answer a poll
+JOB_DIR = os.environ.get('JOB_DIR', os.path.join(basedir, 'jobs'))
+JOB_TTL = float(os.environ.get('JOB_TTL', 60 * 60))
+# Longest a poll may wait for a job to finish
+JOB_MAX_WAIT = float(os.environ.get('JOB_MAX_WAIT', 30))
+# The same under the sync front end (app.py), where a waiting poll holds a whole gunicorn worker
+JOB_SYNC_MAX_WAIT = float(os.environ.get('JOB_SYNC_MAX_WAIT', 2))
+
+# Threshold order learned from which thresholds produce matches (see threshold_plans.py)
+THRESHOLD_TUNING = os.environ.get('THRESHOLD_TUNING', '1') == '1'
+THRESHOLD_PLAN_PATH = os.environ.get('THRESHOLD_PLAN_PATH', os.path.join(basedir, 'threshold_stats.json'))
+# Sweeps that must have tried a threshold before it may be left out
+THRESHOLD_MIN_RUNS = int(os.environ.get('THRESHOLD_MIN_RUNS', 200))
+# Thresholds matching less often than this are left out of most sweeps
+THRESHOLD_MIN_HIT_RATE = float(os.environ.get('THRESHOLD_MIN_HIT_RATE', 0.005))
+# Share of sweeps that still try every threshold
+THRESHOLD_EXPLORATION_RATE = float(os.environ.get('THRESHOLD_EXPLORATION_RATE', 0.05))
+THRESHOLD_FLUSH_EVERY = int(os.environ.get('THRESHOLD_FLUSH_EVERY', 25))
+
+# Digit-field recognizer for timers, the phone clock and boss CP (see digits.py, train_digits.py)
+DIGIT_RECOGNIZER = os.environ.get('DIGIT_RECOGNIZER', '1') == '1'
+DIGIT_MODEL_PATH = os.environ.get('DIGIT_MODEL_PATH', os.path.join(basedir, 'models', 'digits.h5'))
+# Glyphs classified below this fall back to Tesseract
+DIGIT_MIN_CONFIDENCE = float(os.environ.get('DIGIT_MIN_CONFIDENCE', 0.9))
+
+# CP reads resolved through cp_index below this confidence fall back to fuzzy matching. Reads
+# short of an exact one (1.0) only win when the boss name read doesn't contradict them.
+CP_MIN_CONFIDENCE = float(os.environ.get('CP_MIN_CONFIDENCE', 0.75))
+
+# Raid boss list, refreshed in the background (see boss_refresh.py)
+BOSS_SNAPSHOT_PATH = os.environ.get('BOSS_SNAPSHOT_PATH', os.path.join(basedir, 'boss_snapshot.json'))
+BOSS_REFRESH_INTERVAL = float(os.environ.get('BOSS_REFRESH_INTERVAL', 6 * 60 * 60))
+BOSS_FETCH_TIMEOUT = float(os.environ.get('BOSS_FETCH_TIMEOUT', 20))
+
+# CPs of every species at every raid tier and level, built from the base stats (see cp_table.py)
+CP_TABLE_PATH = os.environ.get('CP_TABLE_PATH', os.path.join(basedir, 'cp_table.npz'))
+# Identify a boss from the full CP table when the boss list doesn't know its CP
+CP_TABLE_FALLBACK = os.environ.get('CP_TABLE_FALLBACK', '1') == '1'
+
+# Directory gunicorn workers share Prometheus samples through (see metrics.py, gunicorn_config.py).
+# prometheus_client reads the same variable when imported, so set it in the environment, not here.
+METRICS_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR') or os.environ.get('prometheus_multiproc_dir', '')
+
+# Scan requests with ?profile=1 and this token in X-Profile-Token are profiled (see profiling.py); unset disables it.
+# The same header is needed to reset the learned thresholds.
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN', '')
+# Where ?profile=1&dump=1 saves pstats files for flame graphs; unset disables dumps
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '')
+# Calls taking less than this share of the scan are trimmed from the returned call tree
+PROFILE_MIN_FRACTION = float(os.environ.get('PROFILE_MIN_FRACTION', 0.01))
+PROFILE_MAX_DEPTH = int(os.environ.get('PROFILE_MAX_DEPTH', 12))
+
+# Latency budget of a scan request in seconds, unless it sends its own 'deadline'; 0 disables it
+SCAN_DEADLINE = float(os.environ.get('SCAN_DEADLINE', 10))
+SCAN_MAX_DEADLINE = float(os.environ.get('SCAN_MAX_DEADLINE', 60))
+
+# Screenshots taller than this are scaled down to it before any crop, per scan type; 0 keeps full size.
+# python benchmark.py --height ... shows the accuracy and time at each height.
+WORKING_HEIGHTS = {scan_type: int(os.environ.get('WORKING_HEIGHT_' + scan_type.upper(), 1600))
+                   for scan_type in ('raid', 'boss', 'profile', 'expass')}
+
+# Find field boxes from anchors (status bar, raid timer, profile level box) once per device class (see layout.py)
+LAYOUT_DETECTION = os.environ.get('LAYOUT_DETECTION', '1') == '1'
+LAYOUT_CACHE_SIZE = int(os.environ.get('LAYOUT_CACHE_SIZE', 64))
+
+# Read every threshold variant of a sweep from one tall image with a single Tesseract call (see stacked.py)
+STACKED_SWEEP = os.environ.get('STACKED_SWEEP', '0') == '1'
+# Variants stacked into each call; a sweep with more thresholds reads the rest only if these miss
+STACKED_SWEEP_GROUP = int(os.environ.get('STACKED_SWEEP_GROUP', 8))
+
+# Reuse the text of a crop variant identical to one the same request already read (see ocr_memo.py)
+OCR_MEMO = os.environ.get('OCR_MEMO', '1') == '1'
+# Also keep up to this many texts across requests in each worker; 0 keeps them per request only
+OCR_MEMO_PROCESS_SIZE = int(os.environ.get('OCR_MEMO_PROCESS_SIZE', 0))
+
+# ASGI front end (see asgi_app.py): scans run on this many threads per worker, downloads on an async client
+ASGI_SCAN_WORKERS = int(os.environ.get('ASGI_SCAN_WORKERS', os.cpu_count() or 2))
+ASYNC_FETCH_CONNECTIONS = int(os.environ.get('ASYNC_FETCH_CONNECTIONS', 200))
+
+# OCR worker processes per front-end process, fed through shared memory (see ocr_pool.py); 0 scans in-process.
+# Pair it with a single front-end worker, e.g. the ASGI front end with -w 1.
+OCR_POOL_WORKERS = int(os.environ.get('OCR_POOL_WORKERS', 0))
+OCR_POOL_START_METHOD = os.environ.get('OCR_POOL_START_METHOD', 'spawn')
+# Seconds past a scan's budget to wait before giving its worker up as lost
+OCR_POOL_GRACE = float(os.environ.get('OCR_POOL_GRACE', 5))
+# Seconds to wait for a scan without a budget, which may run well past SCAN_MAX_DEADLINE, before the same
+OCR_POOL_UNBUDGETED_WAIT = float(os.environ.get('OCR_POOL_UNBUDGETED_WAIT', 600))
@@ -0,0 +1,96 @@
+import re
+
+import numpy
+
+
+# Digit pairs OCR commonly mixes up in the CP font
+_CONFUSIONS = [('8', '3'), ('8', '0'), ('8', '6'), ('8', '9'), ('1', '7'), ('1', '4'), ('5', '6'),
+               ('5', '3'), ('0', '6'), ('0', '9'), ('6', '9'), ('2', '7'), ('4', '9')]
+_CONFUSABLE = {}
+for _a, _b in _CONFUSIONS:
+    _CONFUSABLE.setdefault(_a, []).append(_b)
+    _CONFUSABLE.setdefault(_b, []).append(_a)
+
+# How much each kind of single OCR error costs the confidence of a match
+_SUBSTITUTION_PENALTY = .2
+_DROPPED_DIGIT_PENALTY = .3
+_EXTRA_DIGIT_PENALTY = .3
+# Halves the confidence when a read is one error away from several different CPs
+_AMBIGUITY_FACTOR = .5
+
+_NON_DIGITS = re.compile(r'\D')
+
+
+def _neighbours(key):
+    """Yields (variant, penalty) for each way a single OCR error could turn key into variant"""
+    for i, digit in enumerate(key):
+        for other in _CONFUSABLE.get(digit, ()):
+            yield key[:i] + other + key[i + 1:], _SUBSTITUTION_PENALTY
+        if len(key) > 3:
+            yield key[:i] + key[i + 1:], _DROPPED_DIGIT_PENALTY
+
+
+class CPIndex(object):
+    """Resolves an OCR'd CP string to the nearest known boss CP
+
+    Exact reads are a binary search over the sorted CPs. Every single-error
+    variant of every CP (a confused digit or a dropped digit) is precomputed into
+    a second sorted array, so a misread resolves with a binary search too.
+    """
+
+    def __init__(self, cps):
+        cps = sorted(set(cps), key=int)
+        self._values = numpy.array([int(cp) for cp in cps], dtype=numpy.int64)
+        self._keys = cps
+        known = set(cps)
+        variants = {}
+        for cp in cps:
+            for variant, penalty in _neighbours(cp):
+                if variant not in known:
+                    variants.setdefault(variant, []).append((cp, penalty))
+        ordered = sorted(variants)
+        self._variants = numpy.array(ordered, dtype=str) if ordered else numpy.array([], dtype='<U1')
+        self._variant_keys = [variants[v] for v in ordered]
+
+    def __len__(self):
+        return len(self._keys)
+
+    def lookup(self, text):
+        """Returns (cp, confidence) for the known CP nearest to the digits in text, or (None, 0.0)"""
+        digits = _NON_DIGITS.sub('', text or '')
+        if len(digits) < 3 or not self._keys:
+            return None, 0.0
+        exact = self._exact(digits)
+        if exact:
+            return exact, 1.0
+        candidates = self._variant_matches(digits)
+        # OCR read a digit that isn't there
+        for i in range(len(digits)):
+            exact = self._exact(digits[:i] + digits[i + 1:])
+            if exact:
+                candidates.append((exact, _EXTRA_DIGIT_PENALTY))
+        if not candidates:
+            return None, 0.0
+        best = {}
+        for cp, penalty in candidates:
+            best[cp] = min(penalty, best.get(cp, 1.0))
+        cp = min(best, key=lambda k: (best[k], int(k)))
+        confidence = 1.0 - best[cp]
+        if len(best) > 1:
+            confidence *= _AMBIGUITY_FACTOR
+        return cp, confidence
+
+    def _exact(self, digits):
+        if digits.startswith('0'):
+            return None
+        value = int(digits)
+        i = int(numpy.searchsorted(self._values, value))
+        if i < len(self._values) and self._values[i] == value:
+            return self._keys[i]
+        return None
+
+    def _variant_matches(self, digits):
+        i = int(numpy.searchsorted(self._variants, digits))
+        if i < len(self._variants) and self._variants[i] == digits:
+            return list(self._variant_keys[i])
+        return []
@@ -0,0 +1,193 @@
+import hashlib
+import os
+import threading
+import zipfile
+from contextlib import contextmanager
+
+import numpy
+
+try:
+    import fcntl
+except ImportError:
+    # Windows; a single dev server process has nothing to race with
+    fcntl = None
+
+
+# Base stats of every species, one row each
+STATS_DTYPE = numpy.dtype([('name', 'U24'), ('attack', numpy.int16), ('defense', numpy.int16),
+                           ('stamina', numpy.int16)])
+
+# CP multiplier at each whole level, 1 to 40
+CP_MULTIPLIERS = numpy.array([
+    0.094, 0.16639787, 0.21573247, 0.25572005, 0.29024988, 0.3210876, 0.34921268, 0.37523559,
+    0.39956728, 0.42250001, 0.44310755, 0.46279839, 0.48168495, 0.49985844, 0.51739395, 0.53435433,
+    0.55079269, 0.56675452, 0.58227891, 0.59740001, 0.61215729, 0.62656713, 0.64065295, 0.65443563,
+    0.667934, 0.68116492, 0.69414365, 0.70688421, 0.71939909, 0.7317, 0.73776948, 0.74378943,
+    0.74976104, 0.75568551, 0.76156384, 0.76739717, 0.7731865, 0.77893275, 0.784637, 0.79030001])
+# Raid bosses are caught at level 20, or 25 when weather boosted, with every IV at least 10
+RAID_CATCH_LEVEL = 20
+WEATHER_BOOSTED_LEVEL = 25
+RAID_MIN_IV = 10
+MAX_IV = 15
+
+
+def raid_cp(attack, defense, boss_stamina):
+    """CP of a raid boss: perfect IVs, a multiplier of 1 and the tier's stamina in place of the species'"""
+    return numpy.floor((attack + MAX_IV) * numpy.sqrt(defense + MAX_IV) * numpy.sqrt(boss_stamina) / 10)
+
+
+def catch_cp(attack, defense, stamina, multiplier, iv):
+    """CP of a caught Pokemon with the same IV in every stat; never below 10"""
+    cp = (attack + iv) * numpy.sqrt(defense + iv) * numpy.sqrt(stamina + iv) * multiplier ** 2 / 10
+    return numpy.maximum(10, numpy.floor(cp))
+
+
+class CPTable(object):
+    """Every CP the game can show for a species, computed at once for all species
+
+    raid is (species, tier) boss CPs. catch_min and catch_max are the (species, level)
+    CP range of a wild catch, with all IVs at 0 and at 15. raid_catch is the
+    (species, weather boosted, min/max) CP range of a caught raid boss.
+    """
+
+    _ARRAYS = ('names', 'tiers', 'raid', 'catch_min', 'catch_max', 'raid_catch', 'checksum')
+
+    def __init__(self, names, tiers, raid, catch_min, catch_max, raid_catch, checksum):
+        self.names = names
+        self.tiers = tiers
+        self.raid = raid
+        self.catch_min = catch_min
+        self.catch_max = catch_max
+        self.raid_catch = raid_catch
+        self.checksum = str(checksum)
+        self._ids = {name: i for i, name in enumerate(names)}
+        # Every boss CP in one sorted array, for binary search
+        flat = raid.ravel()
+        self._raid_order = numpy.argsort(flat, kind='stable')
+        self._raid_sorted = flat[self._raid_order]
+
+    @classmethod
+    def build(cls, stats, boss_stamina):
+        """stats is a STATS_DTYPE array; boss_stamina maps each raid tier to its boss stamina"""
+        tiers = sorted(boss_stamina)
+        attack = stats['attack'].astype(numpy.float64)[:, None]
+        defense = stats['defense'].astype(numpy.float64)[:, None]
+        stamina = stats['stamina'].astype(numpy.float64)[:, None]
+        tier_stamina = numpy.array([boss_stamina[t] for t in tiers], dtype=numpy.float64)[None, :]
+        raid = raid_cp(attack, defense, tier_stamina).astype(numpy.int32)
+        catch_min = catch_cp(attack, defense, stamina, CP_MULTIPLIERS[None, :], 0).astype(numpy.int32)
+        catch_max = catch_cp(attack, defense, stamina, CP_MULTIPLIERS[None, :], MAX_IV).astype(numpy.int32)
+        # (species, boosted, min/max)
+        raid_levels = CP_MULTIPLIERS[[RAID_CATCH_LEVEL - 1, WEATHER_BOOSTED_LEVEL - 1]][None, :, None]
+        ivs = numpy.array([RAID_MIN_IV, MAX_IV], dtype=numpy.float64)[None, None, :]
+        raid_catch = catch_cp(attack[..., None], defense[..., None], stamina[..., None],
+                              raid_levels, ivs).astype(numpy.int32)
+        return cls(stats['name'].copy(), numpy.array(tiers), raid, catch_min, catch_max, raid_catch,
+                   checksum(stats, boss_stamina))
+
+    @classmethod
+    def load(cls, path):
+        with numpy.load(path) as data:
+            return cls(*[data[name] for name in cls._ARRAYS])
+
+    def save(self, path):
+        # Written through a file object so numpy doesn't append .npz to the temporary name
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            numpy.savez(f, **{name: getattr(self, name) for name in self._ARRAYS})
+        os.replace(tmp_path, path)
+
+    def __len__(self):
+        return len(self.names)
+
+    def raid_bosses(self, cp):
+        """Returns (name, tier) for every species and tier whose raid boss shows cp"""
+        start = int(numpy.searchsorted(self._raid_sorted, cp, side='left'))
+        stop = int(numpy.searchsorted(self._raid_sorted, cp, side='right'))
+        hits = self._raid_order[start:stop]
+        species, tier = numpy.divmod(hits, len(self.tiers))
+        return [(str(self.names[s]), str(self.tiers[t])) for s, t in zip(species, tier)]
+
+    def boss_for_cp(self, cp):
+        """Returns the species of a raid boss showing cp, or None when no species or several do"""
+        names = {name for name, __ in self.raid_bosses(cp)}
+        if len(names) == 1:
+            return names.pop()
+        return None
+
+    def catch_range(self, name, level=None, weather_boosted=False):
+        """Returns the (min, max) CP of name caught at level, or caught from a raid when level is None"""
+        i = self._ids[name]
+        if level is None:
+            return tuple(int(cp) for cp in self.raid_catch[i, int(weather_boosted)])
+        return int(self.catch_min[i, level - 1]), int(self.catch_max[i, level - 1])
+
+    def species_for_catch(self, cp, level=None, weather_boosted=False):
+        """Returns every species whose catch range at level, or from a raid when level is None, includes cp"""
+        if level is None:
+            low, high = self.raid_catch[:, int(weather_boosted), 0], self.raid_catch[:, int(weather_boosted), 1]
+        else:
+            low, high = self.catch_min[:, level - 1], self.catch_max[:, level - 1]
+        return [str(name) for name in self.names[(low <= cp) & (cp <= high)]]
+
+
+def checksum(stats, boss_stamina):
+    """Identifies the inputs a table was built from, so a saved table is rebuilt when they change"""
+    digest = hashlib.sha1(stats.tobytes())
+    digest.update(repr(sorted(boss_stamina.items())).encode())
+    digest.update(CP_MULTIPLIERS.tobytes())
+    return digest.hexdigest()
+
+
+_table = None
+_table_lock = threading.Lock()
+
+
+def _load(path, expected):
+    """Returns the table saved at path, or None when it is missing, unreadable or out of date"""
+    try:
+        table = CPTable.load(path)
+    except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+        # A truncated or corrupt file is rebuilt like a missing one
+        return None
+    return table if table.checksum == expected else None
+
+
+@contextmanager
+def _build_lock(path):
+    """Holds a file lock next to path so one gunicorn worker builds the table while the others wait"""
+    try:
+        lock_file = open(path + '.lock', 'a')
+    except OSError:
+        yield
+        return
+    with lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def load_or_build(path, stats, boss_stamina):
+    """Returns the table saved at path, rebuilding and saving it when missing or out of date"""
+    global _table
+    with _table_lock:
+        if _table is not None:
+            return _table
+        expected = checksum(stats, boss_stamina)
+        table = _load(path, expected)
+        if table is None:
+            with _build_lock(path):
+                # Another worker may have saved it while this one waited
+                table = _load(path, expected)
+                if table is None:
+                    table = CPTable.build(stats, boss_stamina)
+                    try:
+                        table.save(path)
+                    except OSError:
+                        pass
+        _table = table
+        return _table
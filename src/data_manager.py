@@ -1,8 +1,12 @@
 import json
-import math
+import numpy
 import requests
 from bs4 import BeautifulSoup
 
+import config
+import cp_table
+from cp_index import CPIndex
+
 _poke_stats = {'bulbasaur': [118, 111, 128],
     'ivysaur': [151, 143, 155],
     'venusaur': [198, 189, 190],
@@ -830,9 +834,40 @@ _poke_stats = {'bulbasaur': [118, 111, 128],
     'alolan marowak': [144, 186, 155],
     'galarian weezing': [174, 197, 163]    }
 
+# One compact row per species; _poke_ids maps each name to its row
+_poke_stat_rows = numpy.array([(name,) + tuple(stats) for name, stats in _poke_stats.items()],
+                              dtype=cp_table.STATS_DTYPE)
+_poke_ids = {name: i for i, name in enumerate(_poke_stat_rows['name'])}
+
 _raid_stamina = {'1': 600, '2': 1800, '3': 3600, '4': 9000, '5': 15000, '6': 22500}
 
+_BOSS_PAGE = "https://thesilphroad.com/raid-bosses"
+
+
+def fetch_boss_page(etag=None, last_modified=None, timeout=None):
+    """Conditional GET of the raid boss page
+
+    Returns (content, etag, last_modified). content is None when the page is
+    unchanged since the etag/last_modified of an earlier fetch.
+    """
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    page = requests.get(_BOSS_PAGE, headers=headers, timeout=timeout)
+    if page.status_code == 304:
+        return None, etag, last_modified
+    page.raise_for_status()
+    return page.content, page.headers.get('ETag'), page.headers.get('Last-Modified')
+
+
 def populate_boss_list():
+    content, __, __ = fetch_boss_page()
+    return parse_boss_page(content)
+
+
+def parse_boss_page(content):
     boss_list = []
     boss_level_dict = {'1': [], '2': [], '3': [], '4': [], '5': [] }
     def walk_siblings(sib):
@@ -861,9 +896,7 @@ def populate_boss_list():
             return poke
 
 
-    task_page = "https://thesilphroad.com/raid-bosses"
-    page = requests.get(task_page)
-    soup = BeautifulSoup(page.content, 'html.parser')
+    soup = BeautifulSoup(content, 'html.parser')
     # This will pull all tier headers to walk through.
     # The headers are at the same hierarchy level as the actual raids
     # so walking through siblings will encounter both.
@@ -890,29 +923,44 @@ def populate_boss_list():
             boss_level_dict['5'] += raid_pokemon
         boss_list += raid_pokemon
 
+    # Regional forms also match on their base name. Collect those separately so the
+    # loop doesn't walk the names it appends, and keep each name once.
+    base_names = []
     for b in boss_list:
-        if b.lower().startswith('alolan'):
-            boss_list.append(b.split()[1])
-        if b.lower().startswith('galar'):
-            boss_list.append(b.split()[1])
-        if b.lower().startswith('incarnate'):
-            boss_list.append(b.split()[1])
-        if b.lower().startswith('armor'):
-            boss_list.append(b.split()[1])
-    return boss_list, boss_level_dict
+        if b.lower().startswith(('alolan', 'galar', 'incarnate', 'armor')):
+            base_names.append(b.split()[1])
+    unique_names = []
+    for b in boss_list + base_names:
+        if b not in unique_names:
+            unique_names.append(b)
+    return unique_names, boss_level_dict
+
+class BossCPMap(dict):
+    """Maps boss CP strings to boss names, with a CPIndex over the CPs for OCR'd reads"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.index = CPIndex(self)
+
 
 def calculate_boss_cp_list(boss_dict):
-    boss_cp_map = {}
+    names, ids, stamina = [], [], []
     for tier in boss_dict.keys():
         for poke in boss_dict[tier]:
             poke = poke.lower()
-            if poke in _poke_stats:
-                stamina = _raid_stamina[tier]
-                attack = _poke_stats[poke][0]
-                defense = _poke_stats[poke][1]
-                boss_cp = int(((attack + 15) * math.sqrt(defense + 15) * math.sqrt(stamina)) / 10)
-                boss_cp_map[str(boss_cp)] = poke
-    return boss_cp_map
+            if poke in _poke_ids:
+                names.append(poke)
+                ids.append(_poke_ids[poke])
+                stamina.append(_raid_stamina[tier])
+    stats = _poke_stat_rows[ids]
+    boss_cps = cp_table.raid_cp(stats['attack'].astype(numpy.float64), stats['defense'].astype(numpy.float64),
+                                numpy.array(stamina, dtype=numpy.float64))
+    boss_cp_map = {}
+    for poke, boss_cp in zip(names, boss_cps):
+        boss_cp_map[str(int(boss_cp))] = poke
+    return BossCPMap(boss_cp_map)
+
 
-print(populate_boss_list())
-    
+def full_cp_table():
+    """Returns the CP table over every species, tier and level, loading or building it on first use"""
+    return cp_table.load_or_build(config.CP_TABLE_PATH, _poke_stat_rows, _raid_stamina)
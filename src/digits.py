@@ -0,0 +1,172 @@
+import os
+import re
+import threading
+
+import cv2
+import numpy
+
+import config
+
+
+CHARSET = '0123456789:'
+# Class the model puts anything else in, like the letters of a name caught in the crop
+REJECT = len(CHARSET)
+CLASSES = len(CHARSET) + 1
+GLYPH_SIZE = 24
+# Stands in for glyphs the model isn't sure about, so regexes can't match across them
+UNSURE = '?'
+
+_model = None
+_graph = None
+_model_lock = threading.Lock()
+_load_failed = False
+
+
+def binarize(crop):
+    """Otsu-thresholds crop so the glyphs are white on black"""
+    if crop.ndim == 3:
+        crop = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+    binary = cv2.threshold(crop, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
+    # Text is the minority of the pixels, whichever way round it is drawn
+    if cv2.countNonZero(binary) > binary.size // 2:
+        binary = cv2.bitwise_not(binary)
+    return binary
+
+
+def segment(binary):
+    """Splits the main text line of a binarized crop into glyph boxes
+
+    Returns (x, y, w, h) boxes sorted left to right, with the dots of a colon
+    merged into one box, and a list of which boxes follow a word gap.
+    """
+    count, __, stats, __ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+    boxes = [tuple(stats[i][:4]) for i in range(1, count) if stats[i][cv2.CC_STAT_AREA] >= 4]
+    if not boxes:
+        return [], []
+    tallest = max(h for __, __, __, h in boxes)
+    # Keep the line the tallest glyphs sit on; digits are at least 40% of its height, colon dots are smaller
+    line = max((b for b in boxes if b[3] == tallest), key=lambda b: b[2])
+    top, bottom = line[1] - tallest // 2, line[1] + line[3] + tallest // 2
+    boxes = sorted(b for b in boxes if b[1] >= top and b[1] + b[3] <= bottom)
+
+    merged = []
+    for box in boxes:
+        if merged and _x_overlap(merged[-1], box):
+            merged[-1] = _union(merged[-1], box)
+        else:
+            merged.append(box)
+    merged = [b for b in merged if b[3] >= tallest * .4 or _is_colon(b, tallest)]
+
+    widths = sorted(b[2] for b in merged)
+    median_width = widths[len(widths) // 2] if widths else 0
+    gaps = [i > 0 and box[0] - (merged[i - 1][0] + merged[i - 1][2]) > median_width
+            for i, box in enumerate(merged)]
+    return merged, gaps
+
+
+def _x_overlap(a, b):
+    return b[0] < a[0] + a[2] and a[0] < b[0] + b[2]
+
+
+def _union(a, b):
+    x, y = min(a[0], b[0]), min(a[1], b[1])
+    return x, y, max(a[0] + a[2], b[0] + b[2]) - x, max(a[1] + a[3], b[1] + b[3]) - y
+
+
+def _is_colon(box, tallest):
+    # Two dots stacked a few pixels apart make a tall, thin box
+    return box[3] >= tallest * .3 and box[2] <= tallest * .4
+
+
+def normalize_glyph(binary, box):
+    """Scales one glyph into a GLYPH_SIZE square, keeping its aspect ratio"""
+    x, y, w, h = box
+    glyph = binary[y:y + h, x:x + w]
+    scale = (GLYPH_SIZE - 4) / max(w, h)
+    resized = cv2.resize(glyph, (max(1, round(w * scale)), max(1, round(h * scale))),
+                         interpolation=cv2.INTER_AREA)
+    canvas = numpy.zeros((GLYPH_SIZE, GLYPH_SIZE), dtype=numpy.float32)
+    top = (GLYPH_SIZE - resized.shape[0]) // 2
+    left = (GLYPH_SIZE - resized.shape[1]) // 2
+    canvas[top:top + resized.shape[0], left:left + resized.shape[1]] = resized / 255.0
+    return canvas
+
+
+def _load_model():
+    global _model, _graph, _load_failed
+    with _model_lock:
+        if _model is not None or _load_failed:
+            return _model
+        if not os.path.exists(config.DIGIT_MODEL_PATH):
+            # Don't pay for importing TensorFlow in a worker that has no model to run
+            _load_failed = True
+            return None
+        try:
+            import tensorflow as tf
+        except ImportError:
+            _load_failed = True
+            return None
+        try:
+            model = tf.keras.models.load_model(config.DIGIT_MODEL_PATH)
+            if model.output_shape[-1] != CLASSES:
+                # Trained before the reject class; it would read letters as confident digits
+                raise ValueError("Digit model has no reject class; retrain it with train_digits.py")
+            if hasattr(tf, 'get_default_graph'):
+                # TF 1.x: predictions from other threads must run in the graph the model was loaded into
+                model._make_predict_function()
+                _graph = tf.get_default_graph()
+            _model = model
+        except (IOError, OSError, ValueError):
+            _load_failed = True
+        return _model
+
+
+def available():
+    """True if the recognizer is on and its model loads"""
+    return config.DIGIT_RECOGNIZER and _load_model() is not None
+
+
+def _predict(batch):
+    with _model_lock:
+        if _graph is not None:
+            with _graph.as_default():
+                return _model.predict(batch)
+        return _model.predict(batch)
+
+
+def read(crop):
+    """Reads the main text line of crop, or None when no model is available
+
+    Returns a tuple of (text, confidences). Glyphs classified with less than
+    DIGIT_MIN_CONFIDENCE or as REJECT come back as UNSURE and word gaps as spaces.
+    """
+    if not available():
+        return None
+    binary = binarize(crop)
+    boxes, gaps = segment(binary)
+    if not boxes:
+        return '', []
+    batch = numpy.stack([normalize_glyph(binary, box) for box in boxes])[..., numpy.newaxis]
+    probabilities = _predict(batch)
+    text, confidences = [], []
+    for gap, row in zip(gaps, probabilities):
+        if gap:
+            text.append(' ')
+            confidences.append(1.0)
+        best = int(numpy.argmax(row))
+        confidence = float(row[best])
+        sure = best != REJECT and confidence >= config.DIGIT_MIN_CONFIDENCE
+        text.append(CHARSET[best] if sure else UNSURE)
+        confidences.append(confidence)
+    return ''.join(text), confidences
+
+
+def read_match(crop, regex):
+    """Returns the first match of regex in the recognised text of crop, or None"""
+    result = read(crop)
+    if not result:
+        return None
+    match = re.search(regex, result[0])
+    if match:
+        return match.group(0)
+    return None
@@ -1,3 +1,5 @@
+import os
+
 from fabric.api import local, settings, abort
 from fabric.contrib.console import confirm
 
@@ -5,11 +7,14 @@ from fabric.contrib.console import confirm
 
 
 def test():
+    if not os.path.exists("benchmark_baseline.json"):
+        abort("No benchmark_baseline.json. Create one with "
+              "'python benchmark.py --output benchmark_baseline.json' (see readme.md).")
     with settings(warn_only=True):
         result = local(
-            "python test_tasks.py -v && python test_users.py -v", capture=True
+            "python benchmark.py --compare benchmark_baseline.json", capture=True
         )
-    if result.failed and not confirm("Tests failed. Continue?"):
+    if result.failed and not confirm("Benchmark regressed. Continue?"):
         abort("Aborted at user request.")
 
 
@@ -40,7 +45,7 @@ def heroku():
 
 def heroku_test():
     local(
-        "heroku run python test_tasks.py -v && heroku run python test_users.py -v"
+        "heroku run python benchmark.py --compare benchmark_baseline.json"
     )
 
 
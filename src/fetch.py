@@ -0,0 +1,275 @@
+import asyncio
+import ipaddress
+import socket
+import threading
+import time
+from io import BytesIO
+from urllib.parse import urlsplit
+
+import requests
+from PIL import Image
+from requests.adapters import HTTPAdapter
+
+import config
+import metrics
+
+try:
+    import httpx
+except ImportError:
+    # Only the ASGI front end (asgi_app.py) downloads through httpx
+    httpx = None
+
+
+_CHUNK_SIZE = 64 * 1024
+# Redirects followed per download, the same limit requests uses
+_MAX_REDIRECTS = requests.models.DEFAULT_REDIRECT_LIMIT
+
+# Leading bytes of the formats Pillow can decode for us
+_SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'BM', 'bmp'),
+]
+
+
+class FetchError(OSError):
+    """The image at a URL could not be downloaded"""
+
+
+class ImageTooLarge(FetchError):
+    """The download went past the configured byte limit"""
+
+
+class NotAnImage(FetchError):
+    """The downloaded bytes are not an image format we decode"""
+
+
+class UnsafeURL(FetchError):
+    """The URL isn't http(s) or its host resolves to a private, loopback or otherwise internal address"""
+
+
+def check_public_url(url):
+    """Raises UnsafeURL unless url is http(s) on a host that only resolves to public addresses"""
+    try:
+        parts = urlsplit(url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+    except (TypeError, ValueError):
+        raise UnsafeURL("Not a valid URL: {}".format(url))
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise UnsafeURL("Only http and https URLs are allowed: {}".format(url))
+    try:
+        addresses = socket.getaddrinfo(parts.hostname, port, proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError) as e:
+        raise UnsafeURL("Could not resolve {}: {}".format(parts.hostname, e))
+    for __, __, __, __, sockaddr in addresses:
+        # Scoped IPv6 addresses carry a %zone the ipaddress module doesn't parse
+        address = ipaddress.ip_address(sockaddr[0].split('%')[0])
+        if not address.is_global or address.is_multicast:
+            raise UnsafeURL("{} resolves to a non-public address".format(parts.hostname))
+
+
+def sniff_format(data):
+    """Returns the image format named by the first bytes of data, or None"""
+    for signature, image_format in _SIGNATURES:
+        if data.startswith(signature):
+            return image_format
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+def decode(data):
+    """Decodes downloaded image bytes into a PIL image"""
+    # Image.open only reads the header; load() does the decoding
+    with metrics.stage('decode'):
+        image = Image.open(BytesIO(data))
+        image.load()
+    return image
+
+
+class _Limits(object):
+    """Timeouts, size limit and stats shared by both fetchers"""
+
+    def __init__(self, connect_timeout=None, read_timeout=None, total_timeout=None, max_bytes=None):
+        self.connect_timeout = connect_timeout or config.FETCH_CONNECT_TIMEOUT
+        self.read_timeout = read_timeout or config.FETCH_READ_TIMEOUT
+        self.total_timeout = total_timeout or config.FETCH_TOTAL_TIMEOUT
+        self.max_bytes = max_bytes or config.FETCH_MAX_BYTES
+        self._lock = threading.Lock()
+        self._stats = {'fetches': 0, 'failures': 0, 'too_large': 0, 'not_image': 0,
+                       'bytes': 0, 'seconds': 0.0, 'max_seconds': 0.0}
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def _check_response(self, url, status_code, headers):
+        if status_code != 200:
+            raise FetchError("Fetching {} returned HTTP {}".format(url, status_code))
+        content_type = headers.get('Content-Type', '')
+        if content_type.startswith('text/'):
+            self._count('not_image')
+            raise NotAnImage("URL returned {} instead of an image: {}".format(content_type, url))
+        length = headers.get('Content-Length')
+        if length and length.isdigit() and int(length) > self.max_bytes:
+            self._count('too_large')
+            raise ImageTooLarge("Image is {} bytes, limit is {}".format(length, self.max_bytes))
+
+    def _check_size(self, buffer):
+        if len(buffer) > self.max_bytes:
+            self._count('too_large')
+            raise ImageTooLarge("Image is over the {} byte limit".format(self.max_bytes))
+
+    def _check_image(self, url, data):
+        if not sniff_format(data):
+            self._count('not_image')
+            raise NotAnImage("URL did not return a supported image: {}".format(url))
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def _record(self, received, elapsed):
+        with self._lock:
+            self._stats['fetches'] += 1
+            self._stats['bytes'] += received
+            self._stats['seconds'] += elapsed
+            self._stats['max_seconds'] = max(self._stats['max_seconds'], elapsed)
+
+
+class ImageFetcher(_Limits):
+    """Downloads screenshots over a shared keep-alive connection pool
+
+    Downloads are streamed and aborted once they pass max_bytes or total_timeout.
+    Pass a session to point it at a stand-in server.
+    """
+
+    def __init__(self, session=None, connect_timeout=None, read_timeout=None, total_timeout=None,
+                 max_bytes=None, pool_size=None):
+        super().__init__(connect_timeout, read_timeout, total_timeout, max_bytes)
+        if session is None:
+            pool_size = pool_size or config.FETCH_POOL_SIZE
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+
+    def fetch(self, url):
+        """Returns the raw bytes at url, after checking they look like an image"""
+        start = time.time()
+        received = 0
+        try:
+            data, received = self._download(url, start)
+            self._check_image(url, data)
+            return data
+        except FetchError:
+            self._count('failures')
+            raise
+        finally:
+            self._record(received, time.time() - start)
+
+    def get_image(self, url):
+        with metrics.stage('fetch'):
+            data = self.fetch(url)
+        return decode(data)
+
+    def _download(self, url, start):
+        try:
+            response = self.session.get(url, stream=True, timeout=(self.connect_timeout, self.read_timeout))
+        except requests.RequestException as e:
+            raise FetchError("Could not fetch {}: {}".format(url, e))
+        with response:
+            self._check_response(url, response.status_code, response.headers)
+            buffer = bytearray()
+            try:
+                for chunk in response.iter_content(_CHUNK_SIZE):
+                    buffer += chunk
+                    self._check_size(buffer)
+                    if time.time() - start > self.total_timeout:
+                        raise FetchError("Fetching {} took over {}s".format(url, self.total_timeout))
+            except requests.RequestException as e:
+                raise FetchError("Could not fetch {}: {}".format(url, e))
+            return bytes(buffer), len(buffer)
+
+
+class AsyncImageFetcher(_Limits):
+    """ImageFetcher for the ASGI front end, on an httpx.AsyncClient
+
+    A pending download holds a socket but no thread, so hundreds of them cost
+    next to nothing. Create it inside the running event loop.
+    """
+
+    def __init__(self, client=None, connect_timeout=None, read_timeout=None, total_timeout=None,
+                 max_bytes=None, max_connections=None):
+        super().__init__(connect_timeout, read_timeout, total_timeout, max_bytes)
+        if client is None:
+            # Followed like the requests session does, since CDN and attachment links often redirect
+            client = httpx.AsyncClient(
+                follow_redirects=True, max_redirects=_MAX_REDIRECTS,
+                timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(max_connections=max_connections or config.ASYNC_FETCH_CONNECTIONS))
+        self.client = client
+
+    async def fetch(self, url):
+        """Returns the raw bytes at url, after checking they look like an image"""
+        start = time.time()
+        received = [0]
+        try:
+            with metrics.stage('fetch'):
+                data = await asyncio.wait_for(self._download(url, received), self.total_timeout)
+            self._check_image(url, data)
+            return data
+        except asyncio.TimeoutError:
+            self._count('failures')
+            raise FetchError("Fetching {} took over {}s".format(url, self.total_timeout))
+        except FetchError:
+            self._count('failures')
+            raise
+        finally:
+            self._record(received[0], time.time() - start)
+
+    async def close(self):
+        await self.client.aclose()
+
+    async def _download(self, url, received):
+        try:
+            async with self.client.stream('GET', url) as response:
+                self._check_response(url, response.status_code, response.headers)
+                buffer = bytearray()
+                async for chunk in response.aiter_bytes():
+                    buffer += chunk
+                    received[0] = len(buffer)
+                    self._check_size(buffer)
+                return bytes(buffer)
+        except (httpx.HTTPError, httpx.InvalidURL) as e:
+            raise FetchError("Could not fetch {}: {}".format(url, e))
+
+
+_fetcher = ImageFetcher()
+
+
+def get_image(url):
+    return _fetcher.get_image(url)
+
+
+def post_json(url, payload):
+    """POSTs payload to a public url over the shared session, raising FetchError on failure
+
+    The host is checked again here, as its DNS may have changed since the URL was
+    accepted, and redirects aren't followed since they could point anywhere.
+    """
+    check_public_url(url)
+    try:
+        response = _fetcher.session.post(url, json=payload, allow_redirects=False,
+                                         timeout=(_fetcher.connect_timeout, _fetcher.read_timeout))
+    except requests.RequestException as e:
+        raise FetchError("Could not post to {}: {}".format(url, e))
+    if response.status_code >= 400:
+        raise FetchError("Posting to {} returned HTTP {}".format(url, response.status_code))
+
+
+def stats():
+    return _fetcher.stats()
@@ -0,0 +1,17 @@
+import glob
+import os
+
+import config
+
+
+def on_starting(server):
+    # Samples left by workers of an earlier run would be added to this run's totals
+    if config.METRICS_DIR:
+        os.makedirs(config.METRICS_DIR, exist_ok=True)
+        for path in glob.glob(os.path.join(config.METRICS_DIR, '*.db')):
+            os.remove(path)
+
+
+def child_exit(server, worker):
+    import metrics
+    metrics.mark_process_dead(worker.pid)
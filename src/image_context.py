@@ -0,0 +1,115 @@
+import threading
+
+import cv2
+import numpy
+
+import layout
+import metrics
+
+
+# Screenshots smaller than this are upscaled 2x before scanning
+_MIN_HEIGHT = 400
+_MIN_WIDTH = 200
+
+
+class ImageContext(object):
+    """A decoded screenshot shared by every scanner working on one request
+
+    image is a PIL image or an RGB(A) numpy array. The full-frame variants (gray, BGR) are computed once, on first use, at the
+    working resolution: screenshots taller than working_height are scaled down to
+    it first, and small ones are upscaled 2x. Crops are numpy views into them, and
+    inverted crops only invert the cropped pixels. Boxes are (miny, maxy, minx, maxx)
+    fractions of the frame's height and width; box(name) looks a field's box up in
+    the layout the request resolved (see layout.py).
+    """
+
+    def __init__(self, image, working_height=None):
+        if isinstance(image, numpy.ndarray):
+            # Decoded elsewhere, e.g. into an OCR pool worker's shared memory segment
+            self.rgb = image
+        else:
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGB')
+            self.rgb = numpy.asarray(image)
+        height, width = self.rgb.shape[:2]
+        if height < _MIN_HEIGHT or width < _MIN_WIDTH:
+            self.scale = 2
+        elif working_height and height > working_height:
+            self.scale = working_height / height
+        else:
+            self.scale = 1
+        self.layout = layout.DEFAULT
+        self._variants = {}
+        self._inverted = {}
+        self._lock = threading.Lock()
+
+    @property
+    def gray(self):
+        return self._variant('gray', cv2.COLOR_RGB2GRAY)
+
+    @property
+    def bgr(self):
+        return self._variant('bgr', cv2.COLOR_RGB2BGR)
+
+    @property
+    def shape(self):
+        """(height, width) of the frame the scanners work on"""
+        height, width = self.rgb.shape[:2]
+        return round(height * self.scale), round(width * self.scale)
+
+    def to_original(self, rect):
+        """Maps a pixel (miny, maxy, minx, maxx) in the working frame back to the decoded screenshot"""
+        return tuple(round(v / self.scale) for v in rect)
+
+    def from_original(self, y, x):
+        """Maps a pixel of the decoded screenshot to the working frame"""
+        height, width = self.shape
+        return min(height - 1, round(y * self.scale)), min(width - 1, round(x * self.scale))
+
+    def box(self, name):
+        return self.layout.box(name)
+
+    def rect(self, box):
+        """Converts a fraction box to pixel (miny, maxy, minx, maxx)"""
+        height, width = self.shape
+        miny, maxy, minx, maxx = box
+        return round(height * miny), round(height * maxy), round(width * minx), round(width * maxx)
+
+    def crop(self, box, variant='gray', invert=False):
+        """Returns a view of box in the given variant, or an inverted copy of just that region"""
+        if invert:
+            key = (box, variant)
+            with self._lock:
+                inverted = self._inverted.get(key)
+            if inverted is None:
+                crop = self.crop(box, variant)
+                with metrics.stage('preprocess'):
+                    inverted = cv2.bitwise_not(crop)
+                with self._lock:
+                    inverted = self._inverted.setdefault(key, inverted)
+            return inverted
+        miny, maxy, minx, maxx = self.rect(box)
+        return getattr(self, variant)[miny:maxy, minx:maxx]
+
+    def _variant(self, name, conversion):
+        # Scanners run in parallel threads, so only one of them builds each variant
+        with self._lock:
+            image = self._variants.get(name)
+            if image is None:
+                with metrics.stage('preprocess'):
+                    image = cv2.cvtColor(self._working_rgb(), conversion)
+                self._variants[name] = image
+            return image
+
+    def _working_rgb(self):
+        # Called with the lock held. Resized once, before conversion, so each variant
+        # converts the smaller of the two frames
+        image = self._variants.get('rgb')
+        if image is None:
+            image = self.rgb
+            if self.scale != 1:
+                height, width = self.shape
+                # INTER_AREA averages the pixels a downscale drops; it is also what the 2x upscale always used
+                image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+            self._variants['rgb'] = image
+        return image
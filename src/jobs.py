@@ -0,0 +1,207 @@
+import json
+import logging
+import os
+import queue
+import tempfile
+import threading
+import time
+import uuid
+
+import config
+import fetch
+import ocr
+
+
+logger = logging.getLogger(__name__)
+
+_POLL_INTERVAL = 0.1
+
+
+class QueueFull(Exception):
+    """The job queue is at JOB_QUEUE_SIZE"""
+
+
+class Job(object):
+    def __init__(self, url, scan_type, callback_url=None, deadline=None):
+        self.id = uuid.uuid4().hex
+        self.url = url
+        self.scan_type = scan_type
+        self.callback_url = callback_url
+        # Latency budget of the scan in seconds, counted from when a worker picks the job up
+        self.deadline = deadline
+        self.status = 'queued'
+        self.output = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def to_dict(self):
+        result = {'job_id': self.id, 'status': self.status, 'scan_type': self.scan_type, 'url': self.url,
+                  'submitted': self.submitted, 'started': self.started, 'finished': self.finished}
+        if self.status == 'done':
+            result['output'] = self.output
+        if self.status == 'error':
+            result['error'] = self.error
+        return result
+
+
+class JobQueue(object):
+    """Bounded in-process queue of scan jobs, worked off by a few OCR threads
+
+    Job state is written to job_dir as it changes, so a job submitted to one
+    gunicorn worker can be polled through any of them. bosses is a callable
+    returning the current matcher.BossMatcher. A callback_url must be http(s) on
+    a public host (see fetch.check_public_url).
+    """
+
+    def __init__(self, bosses, workers=None, max_depth=None, job_dir=None, ttl=None):
+        self.bosses = bosses
+        self.workers = workers or config.JOB_WORKERS
+        self.job_dir = job_dir or config.JOB_DIR
+        self.ttl = ttl or config.JOB_TTL
+        self._queue = queue.Queue(maxsize=max_depth or config.JOB_QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._busy = 0
+        # Notified whenever a job of this process finishes, so polls for them wake at once
+        self._finished = threading.Condition()
+        self._stats = {'submitted': 0, 'rejected': 0, 'done': 0, 'failed': 0,
+                       'wait_seconds': 0.0, 'max_wait_seconds': 0.0,
+                       'service_seconds': 0.0, 'max_service_seconds': 0.0}
+        os.makedirs(self.job_dir, exist_ok=True)
+
+    def submit(self, url, scan_type, callback_url=None, deadline=None):
+        """Queues a scan job with the budget sweep.scan_deadline gave its request, None for none
+
+        Raises fetch.UnsafeURL for a callback_url the server may not call.
+        """
+        if callback_url:
+            fetch.check_public_url(callback_url)
+        self._start_workers()
+        job = Job(url, scan_type, callback_url, deadline)
+        self._save(job)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            os.remove(self._path(job.id))
+            with self._lock:
+                self._stats['rejected'] += 1
+            raise QueueFull()
+        with self._lock:
+            self._stats['submitted'] += 1
+        self._expire_old_jobs()
+        return job
+
+    def get(self, job_id, wait=0, max_wait=None):
+        """Returns the job's dict, waiting up to wait seconds for it to finish. None if unknown.
+
+        wait is capped at max_wait, JOB_MAX_WAIT by default. A job finishing in this
+        process wakes the poll at once; one run by another worker is seen within
+        _POLL_INTERVAL.
+        """
+        deadline = time.time() + min(wait, config.JOB_MAX_WAIT if max_wait is None else max_wait)
+        while True:
+            job = self._load(job_id)
+            remaining = deadline - time.time()
+            if job is None or job['status'] in ('done', 'error') or remaining <= 0:
+                return job
+            with self._finished:
+                self._finished.wait(min(remaining, _POLL_INTERVAL))
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['busy_workers'] = self._busy
+        stats['depth'] = self._queue.qsize()
+        stats['workers'] = self.workers
+        finished = stats['done'] + stats['failed']
+        stats['mean_wait_seconds'] = stats['wait_seconds'] / finished if finished else 0.0
+        stats['mean_service_seconds'] = stats['service_seconds'] / finished if finished else 0.0
+        return stats
+
+    def _start_workers(self):
+        # Started on first use rather than at import, since gunicorn forks after importing the app
+        with self._lock:
+            if self._threads:
+                return
+            for __ in range(self.workers):
+                thread = threading.Thread(target=self._work, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            job.status = 'running'
+            job.started = time.time()
+            with self._lock:
+                self._busy += 1
+            self._save(job)
+            try:
+                job.output = ocr.process_image(job.url, job.scan_type, self.bosses(), deadline=job.deadline)
+                job.status = 'done'
+            except fetch.FetchError as e:
+                job.error = str(e)
+                job.status = 'error'
+            except OSError:
+                job.error = "URL not recognized as image."
+                job.status = 'error'
+            except Exception:
+                logger.exception("Job %s failed", job.id)
+                job.error = "Unknown processing image."
+                job.status = 'error'
+            job.finished = time.time()
+            self._save(job)
+            with self._finished:
+                self._finished.notify_all()
+            self._record(job)
+            if job.callback_url:
+                self._callback(job)
+
+    def _record(self, job):
+        wait = job.started - job.submitted
+        service = job.finished - job.started
+        with self._lock:
+            self._busy -= 1
+            self._stats['done' if job.status == 'done' else 'failed'] += 1
+            self._stats['wait_seconds'] += wait
+            self._stats['max_wait_seconds'] = max(self._stats['max_wait_seconds'], wait)
+            self._stats['service_seconds'] += service
+            self._stats['max_service_seconds'] = max(self._stats['max_service_seconds'], service)
+
+    def _callback(self, job):
+        try:
+            fetch.post_json(job.callback_url, job.to_dict())
+        except fetch.FetchError as e:
+            logger.info("Callback for job %s failed: %s", job.id, e)
+
+    def _path(self, job_id):
+        return os.path.join(self.job_dir, '{}.json'.format(job_id))
+
+    def _save(self, job):
+        # A unique tmp name per write: forked workers share thread idents
+        fd, tmp_path = tempfile.mkstemp(dir=self.job_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(job.to_dict(), f)
+        os.replace(tmp_path, self._path(job.id))
+
+    def _load(self, job_id):
+        # Job ids are uuid4 hex; anything else can't name a job file
+        if not job_id.isalnum():
+            return None
+        try:
+            with open(self._path(job_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _expire_old_jobs(self):
+        cutoff = time.time() - self.ttl
+        for name in os.listdir(self.job_dir):
+            path = os.path.join(self.job_dir, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
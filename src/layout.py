@@ -0,0 +1,264 @@
+import threading
+from collections import OrderedDict
+
+import numpy
+
+import config
+import digits
+
+
+# Where each field sits on the screenshots the scanners were tuned on, as
+# (miny, maxy, minx, maxx) fractions of the frame
+BOXES = {
+    'phone_time': (0, .15, 0, 1),
+    # Just the status bar, where the clock is the tallest text
+    'phone_clock': (0, .035, 0, 1),
+    'gym_name': (.04, .19, .15, .92),
+    'egg_time': (.16, .33, .25, .75),
+    'egg_tier': (.27, .37, .22, .78),
+    'expire_time': (.52, .64, .7, .96),
+    'boss_cp_line': (.15, .25, .11, .89),
+    'boss': (.15, .34, .11, .89),
+    'gym_ex': (.19, .38, .13, .87),
+    # The two profile windows span both bands the scanners used to guess between
+    'profile_name': (.13, .4, .05, .56),
+    'profile_level': (.5, .8, .05, .2),
+    'xp': (.55, .78, .55, .96),
+}
+
+# Bottom of the status bar on those screenshots. A taller status bar (notches,
+# tall phones) pushes everything below it down by the difference.
+_STATUS_BAR_BOTTOM = .035
+# Where to look for the status bar's bottom edge, and how far its row median must jump
+_STATUS_BAR_RANGE = (.012, .09)
+_STATUS_BAR_EDGE = 20
+# A row with at least this share of text pixels belongs to a text band
+_TEXT_ROW_FILL = .02
+# Text band heights worth trusting, as fractions of the frame height
+_BAND_HEIGHT = (.008, .08)
+_BAND_PADDING = .3
+
+# Fields each scan type finds from anchors. The rest only follow the status bar.
+ANCHORED_FIELDS = {
+    'raid': ('expire_time',),
+    'profile': ('profile_name', 'profile_level'),
+}
+
+
+class Layout(object):
+    """Field boxes for one device class
+
+    offset is how far below the reference status bar this device's status bar ends;
+    every box follows it. rects holds the exact boxes of fields found from anchors.
+    key is the device class the layout was resolved for, if it came from the cache.
+    """
+
+    def __init__(self, offset=None, rects=None, key=None):
+        self.offset = offset
+        self.rects = dict(rects or {})
+        self.key = key
+
+    def box(self, name):
+        if name in self.rects:
+            return self.rects[name]
+        miny, maxy, minx, maxx = BOXES[name]
+        offset = self.offset or 0
+        if miny > 0:
+            miny = _clamp(miny + offset)
+        return miny, _clamp(maxy + offset), minx, maxx
+
+    def detected(self, name):
+        return name in self.rects
+
+    def complete(self, scan_type):
+        return self.offset is not None and all(name in self.rects for name in ANCHORED_FIELDS.get(scan_type, ()))
+
+
+DEFAULT = Layout()
+
+
+def _clamp(value):
+    return min(1.0, max(0.0, value))
+
+
+def status_bar_offset(gray):
+    """Returns how far below the reference the status bar ends, as a fraction of the height, or None"""
+    height = gray.shape[0]
+    start, stop = (round(height * f) for f in _STATUS_BAR_RANGE)
+    # The median ignores the clock and icons, which only cover part of each row
+    medians = numpy.median(gray[:stop + 1], axis=1)
+    for row in range(max(1, start), stop + 1):
+        if abs(float(medians[row]) - float(medians[row - 1])) > _STATUS_BAR_EDGE:
+            return row / height - _STATUS_BAR_BOTTOM
+    return None
+
+
+def text_bands(gray, rect):
+    """Returns the (top, bottom) pixel rows of each line of text inside the pixel rect"""
+    miny, maxy, minx, maxx = rect
+    crop = gray[miny:maxy, minx:maxx]
+    if crop.size == 0:
+        return []
+    rows = (digits.binarize(crop) > 0).mean(axis=1) >= _TEXT_ROW_FILL
+    bands = []
+    start = None
+    for row, on in enumerate(rows):
+        if on and start is None:
+            start = row
+        elif not on and start is not None:
+            bands.append((miny + start, miny + row))
+            start = None
+    if start is not None:
+        bands.append((miny + start, maxy))
+    return bands
+
+
+def _plausible(ctx, bands):
+    height = ctx.shape[0]
+    return [(top, bottom) for top, bottom in bands
+            if _BAND_HEIGHT[0] <= (bottom - top) / height <= _BAND_HEIGHT[1]]
+
+
+def _padded_box(ctx, top, bottom, minx, maxx):
+    height = ctx.shape[0]
+    padding = (bottom - top) * _BAND_PADDING
+    return _clamp((top - padding) / height), _clamp((bottom + padding) / height), minx, maxx
+
+
+def _find_expire_time(ctx, layout):
+    # The raid timer bar: the one line of text in the expire window
+    miny, maxy, minx, maxx = layout.box('expire_time')
+    bands = _plausible(ctx, text_bands(ctx.gray, ctx.rect((miny, maxy, minx, maxx))))
+    if len(bands) != 1:
+        return None
+    return _padded_box(ctx, bands[0][0], bands[0][1], minx, maxx)
+
+
+def _find_profile_name(ctx, layout):
+    # The trainer name and the line under it, which check_profile_name's regex reads together
+    miny, maxy, minx, maxx = layout.box('profile_name')
+    bands = _plausible(ctx, text_bands(ctx.gray, ctx.rect((miny, maxy, minx, maxx))))
+    if len(bands) < 2:
+        return None
+    return _padded_box(ctx, bands[0][0], bands[1][1], minx, maxx)
+
+
+def _find_profile_level(ctx, layout):
+    # The level box: the tallest text in the level window
+    miny, maxy, minx, maxx = layout.box('profile_level')
+    bands = _plausible(ctx, text_bands(ctx.gray, ctx.rect((miny, maxy, minx, maxx))))
+    if not bands:
+        return None
+    top, bottom = max(bands, key=lambda band: band[1] - band[0])
+    return _padded_box(ctx, top, bottom, minx, maxx)
+
+
+_FINDERS = {
+    'expire_time': _find_expire_time,
+    'profile_name': _find_profile_name,
+    'profile_level': _find_profile_level,
+}
+
+
+def detect(ctx, scan_type, known=None):
+    """Finds the anchors of scan_type that known (a Layout from the cache) doesn't have yet"""
+    offset = known.offset if known is not None else None
+    rects = dict(known.rects) if known is not None else {}
+    if offset is None:
+        offset = status_bar_offset(ctx.gray)
+    layout = Layout(offset, rects)
+    for name in ANCHORED_FIELDS.get(scan_type, ()):
+        if name not in rects:
+            rect = _FINDERS[name](ctx, layout)
+            if rect is not None:
+                rects[name] = rect
+    return Layout(offset, rects)
+
+
+class LayoutCache(object):
+    """Layouts by (scan type, width, height, aspect) of the decoded screenshot, least recently used first out
+
+    The status bar offset and the anchors depend on the screenshot's content, so what
+    detection finds is only used by the request that found it until a field read from
+    it parses (see confirm). Only then do later screenshots of the device class skip
+    detecting it.
+    """
+
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries or config.LAYOUT_CACHE_SIZE
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'detections': 0, 'confirmations': 0}
+
+    def resolve(self, ctx, scan_type):
+        height, width = ctx.rgb.shape[:2]
+        key = (scan_type, width, height, round(width / height, 4))
+        with self._lock:
+            known = self._entries.get(key)
+            if known is not None:
+                self._entries.move_to_end(key)
+                if known.complete(scan_type):
+                    self._stats['hits'] += 1
+                    return known
+            self._stats['detections'] += 1
+        layout = detect(ctx, scan_type, known)
+        layout.key = key
+        return layout
+
+    def confirm(self, layout, name):
+        """Keeps what layout detected once the field name, read from its box, has parsed
+
+        Any parsed field confirms the status bar offset every box follows; a field
+        found from an anchor also confirms its own box.
+        """
+        if layout.key is None or layout.offset is None:
+            return
+        with self._lock:
+            known = self._entries.get(layout.key)
+            if known is None:
+                known = self._entries[layout.key] = Layout(key=layout.key)
+                self._evict()
+            if known.offset is None:
+                known.offset = layout.offset
+                self._stats['confirmations'] += 1
+            # A box found under a different offset, by a request racing this one, isn't kept
+            if name in layout.rects and name not in known.rects and known.offset == layout.offset:
+                known.rects[name] = layout.rects[name]
+                self._stats['confirmations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            return stats
+
+
+_cache = LayoutCache()
+
+
+def resolve(ctx, scan_type):
+    """Returns the Layout for ctx, detecting anchors only for device classes without confirmed ones"""
+    if not config.LAYOUT_DETECTION:
+        return DEFAULT
+    return _cache.resolve(ctx, scan_type)
+
+
+def confirm(layout, name):
+    """Records that the field name read from layout's box parsed, so the box can be reused"""
+    _cache.confirm(layout, name)
+
+
+def clear():
+    _cache.clear()
+
+
+def stats():
+    return _cache.stats()
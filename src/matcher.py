@@ -0,0 +1,230 @@
+import re
+from collections import namedtuple
+
+import numpy
+
+import config
+from cp_index import CPIndex
+
+
+_NON_ALNUM = re.compile(r'(?ui)\W')
+_NON_DIGITS = re.compile(r'\D')
+# Candidates are scored as one 64-bit word each
+_MAX_LENGTH = 64
+_ALL_BITS = numpy.uint64(0xFFFFFFFFFFFFFFFF)
+_BYTE_BITS = numpy.array([bin(i).count('1') for i in range(256)], dtype=numpy.int32)
+
+
+def full_process(s):
+    """Same normalisation fuzzywuzzy's default processor applies before scoring"""
+    return _NON_ALNUM.sub(' ', s).lower().strip()
+
+
+def _popcount(words):
+    """Number of set bits in each uint64 of words"""
+    return _BYTE_BITS[words.view(numpy.uint8)].reshape(words.shape + (8,)).sum(axis=-1)
+
+
+def _unique(candidates):
+    seen = set()
+    return [c for c in candidates if not (c in seen or seen.add(c))]
+
+
+class FuzzyMatcher(object):
+    """A fixed candidate list prepared for scoring many tokens at once
+
+    Scores are fuzz.ratio as computed by fuzzywuzzy with python-Levenshtein:
+    round(100 * 2 * LCS / (len(a) + len(b))) on the normalised strings. So
+    extract_one(token, cutoff) returns what process.extractOne(token, candidates,
+    scorer=fuzz.ratio, score_cutoff=cutoff) would, including ties going to the
+    earliest candidate. Without python-Levenshtein fuzzywuzzy falls back to
+    difflib, whose scores differ, which is why requirements.txt pins it.
+    """
+
+    def __init__(self, candidates):
+        self.candidates = _unique(candidates)
+        processed = [full_process(c) for c in self.candidates]
+        if any(len(p) > _MAX_LENGTH for p in processed):
+            raise ValueError("Candidates are limited to {} characters".format(_MAX_LENGTH))
+        alphabet = sorted(set(''.join(processed)))
+        self._alphabet = {char: i for i, char in enumerate(alphabet)}
+        self._lengths = numpy.array([len(p) for p in processed], dtype=numpy.int32)
+        self._low_bits = numpy.array([(1 << len(p)) - 1 for p in processed], dtype=numpy.uint64)
+        # _positions[a, c] has bit j set where candidate c has alphabet letter a at position j.
+        # The extra last row is for letters no candidate contains.
+        positions = [[0] * len(processed) for __ in range(len(alphabet) + 1)]
+        for c, text in enumerate(processed):
+            for j, char in enumerate(text):
+                positions[self._alphabet[char]][c] |= 1 << j
+        self._positions = numpy.array(positions, dtype=numpy.uint64).reshape(len(alphabet) + 1, len(processed))
+
+    def __len__(self):
+        return len(self.candidates)
+
+    def scores(self, tokens):
+        """Returns a (len(tokens), len(candidates)) int matrix of fuzz.ratio scores"""
+        processed = [full_process(t) if isinstance(t, str) else '' for t in tokens]
+        count = len(self.candidates)
+        if not processed or not count:
+            return numpy.zeros((len(processed), count), dtype=numpy.int32)
+        token_width = max(len(p) for p in processed)
+        unknown = len(self._positions) - 1
+        codes = numpy.full((len(processed), token_width), unknown, dtype=numpy.int32)
+        for t, text in enumerate(processed):
+            codes[t, :len(text)] = [self._alphabet.get(char, unknown) for char in text]
+        token_lengths = numpy.array([len(p) for p in processed], dtype=numpy.int32)
+
+        # Bit-parallel LCS length (Hyyro 2004), run for every (token, candidate) pair at once.
+        # Padding is mapped to the unknown row, which has no bits set and leaves v unchanged.
+        v = numpy.full((len(processed), count), _ALL_BITS, dtype=numpy.uint64)
+        for i in range(token_width):
+            u = v & self._positions[codes[:, i]]
+            v = (v + u) | (v - u)
+        lcs = self._lengths[None, :] - _popcount(v & self._low_bits[None, :])
+
+        length_sum = token_lengths[:, None] + self._lengths[None, :]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            ratio = numpy.where(length_sum > 0, 2 * lcs / length_sum, 0)
+        scores = numpy.rint(100 * ratio).astype(numpy.int32)
+        # fuzz.ratio scores 0 whenever either side is empty
+        scores[(token_lengths[:, None] == 0) | (self._lengths[None, :] == 0)] = 0
+        return scores
+
+    def best(self, tokens, score_cutoff):
+        """Returns a (candidate, score) or (None, None) tuple per token"""
+        scores = self.scores(tokens)
+        results = []
+        for row in scores:
+            if not len(row):
+                results.append((None, None))
+                continue
+            best = int(numpy.argmax(row))
+            if row[best] >= score_cutoff:
+                results.append((self.candidates[best], int(row[best])))
+            else:
+                results.append((None, None))
+        return results
+
+    def extract_one(self, token, score_cutoff):
+        if not token:
+            return None, None
+        return self.best([token], score_cutoff)[0]
+
+
+class BossScores(namedtuple('BossScores', ['boss', 'token', 'candidate', 'score', 'tokens', 'candidates',
+                                           'scores'])):
+    """The outcome of BossMatcher.score_tokens
+
+    boss is None when no cell reached the cutoff; token and candidate are then None too.
+    scores is the (len(tokens), len(candidates)) matrix the winner was picked from.
+    """
+    __slots__ = ()
+
+    def to_dict(self):
+        """The scores as JSON, with each token's row keyed by candidate, for debugging missed bosses"""
+        return {'boss': self.boss, 'token': self.token, 'candidate': self.candidate, 'score': self.score,
+                'scores': {token: dict(zip(self.candidates, (int(s) for s in row)))
+                           for token, row in zip(self.tokens, self.scores)}}
+
+
+class BossMatcher(object):
+    """The boss names and boss CPs of one boss list refresh, ready for matching
+
+    Built once per refresh and never modified, so scans can share it between threads.
+    table is an optional cp_table.CPTable over every species, used for bosses the
+    list doesn't know.
+    """
+
+    def __init__(self, boss_list, boss_cp_map, table=None):
+        self.boss_list = tuple(_unique(boss_list))
+        self.boss_cp_map = dict(boss_cp_map)
+        # calculate_boss_cp_list builds the index along with the map
+        self.cp_index = getattr(boss_cp_map, 'index', None) or CPIndex(self.boss_cp_map)
+        # Names first, then CP strings, so one matrix scores each token against both lists
+        self.candidates = FuzzyMatcher(list(self.boss_list) + list(self.boss_cp_map))
+        self._name_count = len(self.boss_list)
+        self.table = table
+
+    def boss_for_cp(self, cp):
+        return self.boss_cp_map[cp]
+
+    def score_tokens(self, tokens, score_cutoff):
+        """Scores every token against every boss name and CP string at once and picks the winner
+
+        The winner is the best name for the second token, else the best CP for the first,
+        else the best name then the best CP of each token in order, counting only scores
+        of at least score_cutoff. When a single cell of the matrix reaches the cutoff it
+        wins outright. Returns BossScores.
+        """
+        scores = self.candidates.scores(tokens)
+        passing = scores >= score_cutoff
+        if not passing.any():
+            return BossScores(None, None, None, None, tokens, self.candidates.candidates, scores)
+        if int(passing.sum()) == 1:
+            # Whatever the precedence, this is the only cell it could pick
+            token, column = (int(i) for i in numpy.argwhere(passing)[0])
+            return self._winner(tokens, scores, token, column)
+        order = []
+        if len(tokens) > 1:
+            order.append((1, False))
+        order.append((0, True))
+        for token in range(len(tokens)):
+            order += [(token, False), (token, True)]
+        for token, is_cp in order:
+            start, stop = (self._name_count, scores.shape[1]) if is_cp else (0, self._name_count)
+            row = scores[token, start:stop]
+            if not len(row):
+                continue
+            best = int(numpy.argmax(row))
+            if row[best] >= score_cutoff:
+                return self._winner(tokens, scores, token, start + best)
+        return BossScores(None, None, None, None, tokens, self.candidates.candidates, scores)
+
+    def _winner(self, tokens, scores, token, column):
+        candidate = self.candidates.candidates[column]
+        boss = candidate if column < self._name_count else self.boss_for_cp(candidate)
+        return BossScores(boss, tokens[token], candidate, int(scores[token, column]), tokens,
+                          self.candidates.candidates, scores)
+
+    def exact_cp(self, tokens):
+        """Returns the first token that is exactly a known boss CP, or None"""
+        for token in tokens:
+            if token in self.boss_cp_map:
+                return token
+        return None
+
+    def legible_cp(self, tokens, min_confidence=None):
+        """Returns the first known CP the tokens resolve to with min_confidence, or None
+
+        min_confidence defaults to CP_MIN_CONFIDENCE; 1.0 only takes exact reads.
+        """
+        min_confidence = config.CP_MIN_CONFIDENCE if min_confidence is None else min_confidence
+        for token in tokens:
+            cp, confidence = self.cp_index.lookup(token)
+            if cp and confidence >= min_confidence:
+                return cp
+        return None
+
+    def contradicts(self, scored, cp):
+        """True if scored (a BossScores) matched a boss name other than the boss showing cp or its base name"""
+        if scored.boss is None or scored.candidate in self.boss_cp_map:
+            return False
+        boss = self.boss_for_cp(cp)
+        return scored.boss != boss and scored.boss not in boss.split()
+
+    def unlisted_boss(self, tokens):
+        """Returns the only species whose raid boss shows a CP read exactly from tokens, or None
+
+        Covers bosses missing from a stale or unavailable boss list. Only exact reads
+        count, since nearly every CP is some species' boss CP at some tier.
+        """
+        if self.table is None:
+            return None
+        for token in tokens:
+            token = _NON_DIGITS.sub('', token)
+            if len(token) < 3 or token.startswith('0'):
+                continue
+            boss = self.table.boss_for_cp(int(token))
+            if boss:
+                return boss
+        return None
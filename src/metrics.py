@@ -0,0 +1,162 @@
+import contextvars
+import functools
+import time
+from contextlib import contextmanager
+
+import config
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:
+    # Without prometheus_client everything below records nothing and /metrics is empty
+    prometheus_client = None
+
+
+# The field extractor the current thread is working for, so Tesseract calls
+# made deep inside sweeps can be counted against it. sweep.submit carries it
+# onto pool threads along with the cancel scope.
+_field = contextvars.ContextVar('metrics_field', default='none')
+
+_STAGE_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+_FIELD_BUCKETS = (.01, .025, .05, .1, .25, .5, 1, 2, 4, 8, 16)
+
+
+class _Metrics(object):
+    def __init__(self):
+        self.stage_seconds = prometheus_client.Histogram(
+            'kyogre_stage_seconds', "Time spent in each stage of a scan request",
+            ['stage'], buckets=_STAGE_BUCKETS)
+        self.field_seconds = prometheus_client.Histogram(
+            'kyogre_field_seconds', "Time spent in each field extractor",
+            ['field'], buckets=_FIELD_BUCKETS)
+        self.scan_seconds = prometheus_client.Histogram(
+            'kyogre_scan_seconds', "Time to scan one decoded screenshot, cache lookups included",
+            ['scan_type'], buckets=_FIELD_BUCKETS)
+        self.tesseract_calls = prometheus_client.Counter(
+            'kyogre_tesseract_calls_total', "Tesseract recognitions by the field extractor that ran them",
+            ['field'])
+        self.threshold_attempts = prometheus_client.Counter(
+            'kyogre_threshold_attempts_total', "Thresholds tried by threshold sweeps", ['field'])
+        self.threshold_retries = prometheus_client.Counter(
+            'kyogre_threshold_retries_total', "Thresholds tried after the first one of a sweep", ['field'])
+        self.cache_lookups = prometheus_client.Counter(
+            'kyogre_cache_lookups_total', "Result cache lookups by outcome", ['scan_type', 'result'])
+        self.ocr_lookups = prometheus_client.Counter(
+            'kyogre_ocr_memo_lookups_total', "Tesseract reads looked up in the per-request OCR memo", ['field'])
+        self.ocr_skips = prometheus_client.Counter(
+            'kyogre_ocr_memo_skips_total', "Tesseract reads skipped because the same crop had been read already",
+            ['field'])
+        self.errors = prometheus_client.Counter(
+            'kyogre_scan_errors_total', "Failed scan requests by scan type and kind of failure",
+            ['scan_type', 'kind'])
+
+
+_metrics = _Metrics() if prometheus_client is not None else None
+
+
+def observe_stage(stage, seconds):
+    if _metrics is not None:
+        _metrics.stage_seconds.labels(stage).observe(seconds)
+
+
+@contextmanager
+def stage(name):
+    """Times the body as one of the request stages (fetch, decode, preprocess)"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - start)
+
+
+def timed_field(fn):
+    """Decorates a field extractor so its time and the Tesseract calls under it are recorded by its name"""
+    name = fn.__name__
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        token = _field.set(name)
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            if _metrics is not None:
+                _metrics.field_seconds.labels(name).observe(time.perf_counter() - start)
+            _field.reset(token)
+    return wrapper
+
+
+def current_field():
+    """Name of the field extractor running in this context, or 'none'"""
+    return _field.get()
+
+
+def count_tesseract_calls(calls=1):
+    if _metrics is not None:
+        _metrics.tesseract_calls.labels(_field.get()).inc(calls)
+
+
+def count_sweep(field, attempts):
+    """Records a threshold sweep of field that ran attempts thresholds"""
+    if _metrics is not None and attempts:
+        _metrics.threshold_attempts.labels(field).inc(attempts)
+        if attempts > 1:
+            _metrics.threshold_retries.labels(field).inc(attempts - 1)
+
+
+def count_ocr_lookups(lookups, skipped):
+    if _metrics is not None:
+        _metrics.ocr_lookups.labels(_field.get()).inc(lookups)
+        if skipped:
+            _metrics.ocr_skips.labels(_field.get()).inc(skipped)
+
+
+def count_cache_lookup(scan_type, hit):
+    if _metrics is not None:
+        _metrics.cache_lookups.labels(scan_type, 'hit' if hit else 'miss').inc()
+
+
+def count_error(scan_type, kind):
+    """kind is 'fetch' for a failed download, 'image' for one that won't decode, else 'scan'"""
+    if _metrics is not None:
+        _metrics.errors.labels(scan_type, kind).inc()
+
+
+@contextmanager
+def scan(scan_type):
+    """Times a scan of one screenshot and counts it as an error if it raises"""
+    start = time.perf_counter()
+    try:
+        yield
+    except OSError:
+        count_error(scan_type, 'image')
+        raise
+    except Exception:
+        count_error(scan_type, 'scan')
+        raise
+    finally:
+        if _metrics is not None:
+            _metrics.scan_seconds.labels(scan_type).observe(time.perf_counter() - start)
+
+
+def render():
+    """Returns (body, content type) of every metric in the Prometheus text format
+
+    Under gunicorn with METRICS_DIR set, each worker writes its samples to files
+    there and this collects all workers' files, so any worker returns the totals.
+    """
+    if prometheus_client is None:
+        return '', 'text/plain; version=0.0.4; charset=utf-8'
+    if config.METRICS_DIR:
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry, path=config.METRICS_DIR)
+    else:
+        registry = prometheus_client.REGISTRY
+    return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid):
+    """Called by gunicorn when a worker exits, so its live samples stop counting"""
+    if prometheus_client is not None and config.METRICS_DIR:
+        multiprocess.mark_process_dead(pid, path=config.METRICS_DIR)
@@ -1,14 +1,23 @@
 import cv2
-import numpy
-import pytesseract
 import re
-import requests
 import time
 from fuzzywuzzy import fuzz
 from fuzzywuzzy import process
-from io import BytesIO
-from PIL import Image
-from PIL import ImageFilter
+
+import config
+import digits
+import fetch
+from image_context import ImageContext
+import layout
+import metrics
+import ocr_engine
+import ocr_memo
+import ocr_pool
+import profiling
+import result_cache
+import stacked
+import sweep
+import taskgraph
 
 
 _boss_list = ['geodude', 'snorunt', 'beldum', 'shinx', 'klink', 'alolan exeggutor',
@@ -50,7 +59,6 @@ raid_cp_chart = {"2873": "Shinx",
                  "21385": "Alolan Marowak",
                  "21360": "Umbreon",
                  "38490": "Dragonite",
-                 "65675": "Tyranitar",
                  "20453": "Togetic",
                  "28590": "Houndoom",
                  "28769": "Absol",
@@ -59,6 +67,34 @@ raid_cp_chart = {"2873": "Shinx",
                  }
 raid_cp_list = raid_cp_chart.keys()
 
+_DIGIT_CONFIG = '--psm 6 -c tessedit_char_whitelist=:0123456789'
+_TEXT_CONFIG = '--psm 4'
+# check_egg_tier needs the legacy engine, which only ships in the tessdata below
+_TIER_CONFIG = '--psm 7 --oem 0 -c tessedit_char_whitelist=@Q®© --tessdata-dir "/usr/local/share/tessdata/"'
+
+
+# Fuzzy score a token needs to name a boss or a boss CP
+_BOSS_SCORE_CUTOFF = 70
+
+# Default threshold order of each swept field. threshold_plans reorders these
+# by how often each one actually produced the match.
+THRESHOLDS = {
+    'phone_time': [0, 10, 20],
+    'phone_time_inverted': [40, 50, 60, 0, 10, 20],
+    'egg_time': [0, 70, 10, 20, 80],
+    'expire_time': [0, 70, 10],
+    'profile_name': [180, 190],
+    'profile_level': [220, 230, 240],
+    'xp': [210, 220],
+    'boss_cp': [30, 40, 20, 50, 60, 10, 70, 80],
+    'boss_cp_inverted': [220, 252, 240, 230],
+}
+
+
+def warm_up_engine():
+    ocr_engine.warm_up([('eng', _DIGIT_CONFIG), ('eng', _TEXT_CONFIG), ('eng', _TIER_CONFIG)])
+
+
 def get_match(word_list: list, word: str, score_cutoff: int = 60, isPartial: bool = False, limit: int = 1):
     """Uses fuzzywuzzy to see if word is close to entries in word_list
 
@@ -79,118 +115,167 @@ def get_match(word_list: list, word: str, score_cutoff: int = 60, isPartial: boo
         else:
             result = process.extractBests(word, word_list,
                                           scorer=scorer, score_cutoff=score_cutoff, limit=limit)
-    except (TypeError, AttributeError) as e:
+    except (TypeError, AttributeError):
         pass
     if not result:
         return (None, None)
     return result
 
 
-def check_match(image, regex):
-    img_text = pytesseract.image_to_string(image, lang='eng', config='--psm 6 -c tessedit_char_whitelist=:0123456789')
-    match = re.search(regex, img_text)
-    if match:
-        return match.group(0)
-    else:
+def _thresholded(crop, blur=True):
+    """Returns render(t): crop thresholded at t, blurred the way every scanner reads it"""
+    def render(t):
+        thresh = cv2.threshold(crop, t, 255, cv2.THRESH_BINARY)[1]
+        if blur:
+            thresh = cv2.GaussianBlur(thresh, (5, 5), 0)
+        return thresh
+    return render
+
+
+def _sweep_text(render, parse, vals, ocr_config, accept=bool, field=None):
+    """Sweeps vals, reading the text of render(val) and returning the sweep.Sweep of parse(text)
+
+    With STACKED_SWEEP the variants are read a group at a time in one Tesseract call
+    (see stacked.py), otherwise each on its own on the sweep pool.
+    """
+    if config.STACKED_SWEEP:
+        return stacked.first_match(render, parse, vals, accept=accept, field=field, ocr_config=ocr_config)
+
+    def attempt(val):
+        return parse(ocr_engine.image_to_string(render(val), lang='eng', config=ocr_config))
+    return sweep.first_match(attempt, vals, accept=accept, field=field)
+
+
+def _read_each(render, vals, ocr_config):
+    """Yields the text of render(val) for every val, from one stacked call or one call each"""
+    if config.STACKED_SWEEP:
+        sweep.check_cancelled()
+        yield from stacked.read([render(val) for val in vals], ocr_config=ocr_config)
+        return
+    for val in vals:
+        sweep.check_cancelled()
+        yield ocr_engine.image_to_string(render(val), lang='eng', config=ocr_config)
+
+
+def _regex_parser(regex):
+    def parse(img_text):
+        match = re.search(regex, img_text)
+        if match:
+            return match.group(0)
         return None
+    return parse
 
 
-def check_val_range(egg_time_crop, vals, regex=None, blur=False):
-    for i in vals:
-        thresh = cv2.threshold(egg_time_crop, i, 255, cv2.THRESH_BINARY)[1]
-        if blur:
-            thresh = cv2.GaussianBlur(thresh, (5, 5), 0)
-        match = check_match(thresh, regex)
+def check_val_range(egg_time_crop, vals, regex=None, blur=False, field=None, digits_first=False):
+    if digits_first:
+        # One batched classification of the whole crop; Tesseract only if it isn't sure
+        match = digits.read_match(egg_time_crop, regex)
         if match:
             return match
-    return None
+    return _sweep_text(_thresholded(egg_time_crop, blur), _regex_parser(regex), vals, _DIGIT_CONFIG,
+                       field=field).value
 
 
-def check_phone_time(image):
-    height, width = image.shape
-    maxy = round(height * .15)
-    miny = 0
-    maxx = width
-    minx = 0
-    phone_time_crop = image[miny:maxy, minx:maxx]
+@metrics.timed_field
+def check_phone_time(ctx):
+    box = ctx.box('phone_time')
     regex = r'1{0,1}[0-9]{1}:[0-5]{1}[0-9]{1}'
-    vals = [0, 10, 20]
-    ivals= [40, 50, 60, 0, 10, 20]
-    result = check_val_range(phone_time_crop, vals, regex, blur=True)
+    # The recognizer reads the tallest line, which in the phone_time box is the gym name
+    result = digits.read_match(ctx.crop(ctx.box('phone_clock')), regex)
+    if result:
+        return result
+    result = check_val_range(ctx.crop(box), THRESHOLDS['phone_time'], regex, blur=True, field='phone_time')
     if not result:
-        phone_time_crop = cv2.bitwise_not(phone_time_crop)
-        result = check_val_range(phone_time_crop, ivals, regex, blur=True)
+        result = check_val_range(ctx.crop(box, invert=True), THRESHOLDS['phone_time_inverted'], regex,
+                                 blur=True, field='phone_time_inverted')
     return result
 
 
-def check_egg_time(image):
-    image = cv2.bitwise_not(image)
-    height, width = image.shape
-    maxy = round(height * .33)
-    miny = round(height * .16)
-    maxx = round(width * .75)
-    minx = round(width * .25)
-    egg_time_crop = image[miny:maxy, minx:maxx]
+@metrics.timed_field
+def check_egg_time(ctx):
+    egg_time_crop = ctx.crop(ctx.box('egg_time'), invert=True)
     regex = r'[0-1]{0,1}:[0-5]{1}[0-9]{1}:[0-5]{1}[0-9]{1}'
-    result = check_val_range(egg_time_crop, [0, 70, 10, 20, 80], regex)
+    result = check_val_range(egg_time_crop, THRESHOLDS['egg_time'], regex, field='egg_time', digits_first=True)
+    if result:
+        layout.confirm(ctx.layout, 'egg_time')
     return result
 
 
-def check_egg_tier(image):
-    height, width = image.shape
-    maxy = round(height * .37)
-    miny = round(height * .27)
-    maxx = round(width * .78)
-    minx = round(width * .22)
-    gym_name_crop = image[miny:maxy, minx:maxx]
+@metrics.timed_field
+def check_egg_tier(ctx):
+    gym_name_crop = ctx.crop(ctx.box('egg_tier'))
     vals = [251, 252]
     for th in vals:
+        sweep.check_cancelled()
         thresh = cv2.threshold(gym_name_crop, th, 255, cv2.THRESH_BINARY)[1]
         thresh = cv2.GaussianBlur(thresh, (5, 5), 0)
-        img_text = pytesseract.image_to_string(thresh,
-                                               lang='eng', config='--psm 7 --oem 0 -c tessedit_char_whitelist=@Q®© '
-                                                                  '--tessdata-dir "/usr/local/share/tessdata/"')
+        img_text = ocr_engine.image_to_string(thresh, lang='eng', config=_TIER_CONFIG)
         tier = img_text.replace(' ', '')
         if len(tier) > 0:
             return str(len(tier))
     return None
 
 
-def check_expire_time(image):
-    image = cv2.bitwise_not(image)
-    height, width = image.shape
-    maxy = round(height * .64)
-    miny = round(height * .52)
-    maxx = round(width * .96)
-    minx = round(width * .7)
-    expire_time_crop = image[miny:maxy, minx:maxx]
+@metrics.timed_field
+def check_expire_time(ctx):
+    expire_time_crop = ctx.crop(ctx.box('expire_time'), invert=True)
     regex = r'[0-2]{0,1}:[0-5]{1}[0-9]{1}:[0-5]{1}[0-9]{1}'
-    result = check_val_range(expire_time_crop, [0, 70, 10], regex)
+    result = check_val_range(expire_time_crop, THRESHOLDS['expire_time'], regex, field='expire_time',
+                             digits_first=True)
+    if result:
+        layout.confirm(ctx.layout, 'expire_time')
     return result
 
 
-def check_profile_name(image):
-    height, width, __ = image.shape
-    regex = r'\S{5,20}\n+&'
-    vals = [180, 190]
-    maxx = round(width * .56)
-    minx = round(width * .05)
-    yvals = [(.13, .24), (.2, .4)]
-    for pair in yvals:
-        maxy = round(height * pair[1])
-        miny = round(height * pair[0])
-        profile_name_crop = image[miny:maxy, minx:maxx]
-        for i in vals:
-            thresh = cv2.threshold(profile_name_crop, i, 255, cv2.THRESH_BINARY)[1]
+def _found(value):
+    return value is not None
+
+
+def _profile_bands(ctx, name, yvals):
+    """Boxes to read a profile field from: the one the layout found, else each (miny, maxy) guess in yvals"""
+    miny, maxy, minx, maxx = ctx.box(name)
+    if ctx.layout.detected(name):
+        return [(miny, maxy, minx, maxx)]
+    # Guesses follow the status bar like every other box
+    shift = miny - layout.BOXES[name][0]
+    return [(top + shift, bottom + shift, minx, maxx) for top, bottom in yvals]
+
+
+def _sweep_bands(ctx, bands, parse, field):
+    """Sweeps every threshold of field over each band in turn, returning the first parse(text) found
+
+    A band is only cropped and read once every threshold has failed on the bands before it.
+    """
+    for box in bands:
+        band = ctx.crop(box, 'bgr')
+
+        def attempt(i):
+            thresh = cv2.threshold(band, i, 255, cv2.THRESH_BINARY)[1]
             thresh = cv2.GaussianBlur(thresh, (5, 5), 0)
-            img_text = pytesseract.image_to_string(thresh, lang='eng', config='--psm 4')
-            match = re.search(regex, img_text)
-            if match:
-                return match.group(0).split('&')[0].strip()
+            return parse(ocr_engine.image_to_string(thresh, lang='eng', config=_TEXT_CONFIG))
+        result = sweep.first_match(attempt, THRESHOLDS[field], accept=_found, field=field).value
+        if result is not None:
+            layout.confirm(ctx.layout, field)
+            return result
+    return None
+
 
+@metrics.timed_field
+def check_profile_name(ctx):
+    regex = r'\S{5,20}\n+&'
 
-def determine_team(image):
-    b, g, r = image[300, 5]
+    def parse(img_text):
+        match = re.search(regex, img_text)
+        if match:
+            return match.group(0).split('&')[0].strip()
+    bands = _profile_bands(ctx, 'profile_name', [(.13, .24), (.2, .4)])
+    return _sweep_bands(ctx, bands, parse, 'profile_name')
+
+
+@metrics.timed_field
+def determine_team(ctx):
+    # Sampled at the same screenshot pixel whatever the working resolution
+    b, g, r = ctx.bgr[ctx.from_original(300, 5)]
     if r >= 200 and g >= 200:
         return "instinct"
     if b >= 200:
@@ -200,40 +285,19 @@ def determine_team(image):
     return None
 
 
-def check_profile_level(image):
-    height, width, __ = image.shape
-    vals = [220, 230, 240]
+@metrics.timed_field
+def check_profile_level(ctx):
     regex = r'[1-4]{0,1}[0-9]{1}'
-    maxx = round(width * .2)
-    minx = round(width * .05)
-    yvals = [(.5, .7), (.6, .8)]
-    for pair in yvals:
-        maxy = round(height * pair[1])
-        miny = round(height * pair[0])
-        level_crop = image[miny:maxy, minx:maxx]
-        for i in vals:
-            thresh = cv2.threshold(level_crop, i, 255, cv2.THRESH_BINARY)[1]
-            thresh = cv2.GaussianBlur(thresh, (5, 5), 0)
-            img_text = pytesseract.image_to_string(thresh, lang='eng', config='--psm 4')
-            match = re.search(regex, img_text)
-            if match:
-                return match.group(0)
-
-
-def get_xp(image):
-    image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    height, width = image.shape
-    maxy = round(height * .78)
-    miny = round(height * .55)
-    maxx = round(width * .96)
-    minx = round(width * .55)
-    xp_crop = image[miny:maxy, minx:maxx]
-    vals = [210, 220]
+    bands = _profile_bands(ctx, 'profile_level', [(.5, .7), (.6, .8)])
+    return _sweep_bands(ctx, bands, _regex_parser(regex), 'profile_level')
+
+
+@metrics.timed_field
+def get_xp(ctx):
+    xp_crop = ctx.crop(ctx.box('xp'))
     regex = r'[0-9,\.]{3,9}/*\s*[0-9,\.]{3,12}'
-    for t in vals:
-        thresh = cv2.threshold(xp_crop, t, 255, cv2.THRESH_BINARY)[1]
-        thresh = cv2.GaussianBlur(thresh, (5, 5), 0)
-        img_text = pytesseract.image_to_string(thresh, lang='eng', config='--psm 4')
+
+    def parse(img_text):
         match = re.search(regex, img_text)
         if match:
             xp_str = match.group(0)
@@ -241,21 +305,16 @@ def get_xp(image):
                 return xp_str.split('/')[0].strip().replace(',', '').replace('.', '')
             else:
                 return xp_str.split(' ')[0].strip().replace(',', '').replace('.', '')
+    return _sweep_text(_thresholded(xp_crop), parse, THRESHOLDS['xp'], _TEXT_CONFIG, accept=_found,
+                       field='xp').value
 
 
-def check_gym_name(image):
-    height, width = image.shape
-    maxy = round(height * .19)
-    miny = round(height * .04)
-    maxx = round(width * .92)
-    minx = round(width * .15)
-    gym_name_crop = image[miny:maxy, minx:maxx]
+@metrics.timed_field
+def check_gym_name(ctx):
+    gym_name_crop = ctx.crop(ctx.box('gym_name'))
     vals = [220, 210, 190]
     possible_names = []
-    for i in vals:
-        thresh = cv2.threshold(gym_name_crop, i, 255, cv2.THRESH_BINARY)[1]
-        thresh = cv2.GaussianBlur(thresh, (5, 5), 0)
-        img_text = pytesseract.image_to_string(thresh, lang='eng', config='--psm 4')
+    for img_text in _read_each(_thresholded(gym_name_crop), vals, _TEXT_CONFIG):
         img_text = [s for s in list(filter(None, img_text.split('\n'))) if len(s) > 3]
         possible_text = []
         for line in img_text:
@@ -287,33 +346,58 @@ def _word_length(line):
     return longest
 
 
-def check_boss_cp_wrap(pil_image):
-    image = cv2.cvtColor(numpy.array(pil_image), cv2.COLOR_RGB2GRAY)
-    boss = check_boss_cp(image)
+def _within_budget(fields, fn, *args):
+    """Returns fn(*args), or None with fields recorded as skipped if the request's budget runs out"""
+    try:
+        return fn(*args)
+    except sweep.DeadlineExceeded:
+        for field in fields:
+            sweep.skip_field(field)
+        return None
+
+
+def check_boss_cp_wrap(ctx, bosses):
+    boss, __ = _within_budget(('boss',), check_boss_cp, ctx, bosses) or (None, None)
     if not boss:
         boss = "No Match"
     return {'boss': boss}
 
-def check_boss_cp(image, boss_list, boss_cp_map):
-    height, width = image.shape
-    maxy = round(height * .34)
-    miny = round(height * .15)
-    maxx = round(width * .89)
-    minx = round(width * .11)
-    gym_name_crop = image[miny:maxy, minx:maxx]
-    gym_name_crop = cv2.bitwise_not(gym_name_crop)
-    vals = [30, 40, 20, 50, 20, 60, 10, 70, 80]
-    i_vals = [220, 252, 240, 230]
+def _read_boss_cp(ctx, bosses):
+    """Reads the CP line above the boss name with the digit recognizer
+
+    Returns the known boss CP the digits spell exactly, else None; near misses are
+    left to the Tesseract sweep.
+    """
+    cp_line = ctx.crop(ctx.box('boss_cp_line'))
+    result = digits.read(cp_line)
+    if not result:
+        return None
+    return bosses.exact_cp(re.findall(r'(?<![0-9?])[0-9]{3,6}(?![0-9?])', result[0]))
+
+
+@metrics.timed_field
+def check_boss_cp(ctx, bosses):
+    box = ctx.box('boss')
+    cp = _read_boss_cp(ctx, bosses)
+    if cp:
+        layout.confirm(ctx.layout, 'boss_cp_line')
+        return bosses.boss_for_cp(cp), [[cp]]
+    gym_name_crop = ctx.crop(box, invert=True)
     scanned_values = []
-    result, scanned_values = check_boss_internal(gym_name_crop, vals, boss_list, boss_cp_map)
+    result, scanned_values = check_boss_internal(gym_name_crop, THRESHOLDS['boss_cp'], bosses,
+                                                 field='boss_cp')
     if not result:
-        gym_name_crop = cv2.bitwise_not(gym_name_crop)
-        result, new_scanned_values = check_boss_internal(gym_name_crop, i_vals, boss_list, boss_cp_map)
+        gym_name_crop = ctx.crop(box)
+        result, new_scanned_values = check_boss_internal(gym_name_crop, THRESHOLDS['boss_cp_inverted'],
+                                                         bosses, field='boss_cp_inverted')
         scanned_values += new_scanned_values
+    if not result:
+        # Last resort for a boss the list doesn't have yet, once every threshold has failed against it
+        result = bosses.unlisted_boss([token for img_text in scanned_values for token in img_text])
     return result, scanned_values
     
 
-def check_boss_internal(gym_name_crop, vals, boss_list, boss_cp_map):
+def check_boss_internal(gym_name_crop, vals, bosses, field=None):
     # This doesn't fully handle Alolan forms
     # For example, in one particular screenshot of an Alolan Marowak no boss was ever identified.
     # The img_text contained 'Marowak' but fuzzy match threshold was too high for that to match
@@ -321,136 +405,212 @@ def check_boss_internal(gym_name_crop, vals, boss_list, boss_cp_map):
     # Additionally, no match was ever made on the CP value as it never got a clear read.
     # Likely need to refactor this so that if an alolan species is read in, additional scans are made
     # To try and pick up the CP and make sure we have the right form
-    boss_cp_list = boss_cp_map.keys()
-    possible_text = []
-    for t in vals:
-        thresh = cv2.threshold(gym_name_crop, t, 255, cv2.THRESH_BINARY)[1]
-        thresh = cv2.GaussianBlur(thresh, (5, 5), 0)
-        img_text = pytesseract.image_to_string(thresh, lang='eng', config='--psm 4')
+    def parse(img_text):
         img_text = [s for s in list(filter(None, img_text.split())) if len(s) > 3]
-        possible_text.append(img_text)
-        if len(img_text) > 1:
-            match = get_match(boss_list, img_text[1], score_cutoff=70)
-            if match and match[0]:
-                return match[0], possible_text
-        if len(img_text) > 0:
-            match = get_match(list(boss_cp_list), img_text[0], score_cutoff=70)
-            if match and match[0]:
-                return boss_cp_map[match[0]], possible_text
-        for i in img_text:
-            match = get_match(boss_list, i, score_cutoff=70)
-            if match and match[0]:
-                return match[0], possible_text
-            match = get_match(list(boss_cp_list), i, score_cutoff=70)
-            if match and match[0]:
-                return boss_cp_map[match[0]], possible_text
+        # An exact CP read names the exact form, so it wins outright
+        # and the sweep can stop at the first threshold that produces one
+        cp = bosses.legible_cp(img_text, min_confidence=1.0)
+        if cp:
+            return img_text, bosses.boss_for_cp(cp), None
+        # Every token is scored against every boss name and CP in one matrix, kept
+        # alongside the match so profiled scans show why a form was missed
+        scored = bosses.score_tokens(img_text, _BOSS_SCORE_CUTOFF)
+        # A CP one OCR confusion away from a known one is also one away from other
+        # bosses' CPs, so it only wins when the name read doesn't name someone else
+        cp = bosses.legible_cp(img_text)
+        if cp and not bosses.contradicts(scored, cp):
+            return img_text, bosses.boss_for_cp(cp), scored
+        return img_text, scored.boss, scored
+
+    swept = _sweep_text(_thresholded(gym_name_crop), parse, vals, _TEXT_CONFIG,
+                        accept=lambda output: bool(output[1]), field=field)
+    possible_text = [output[0] for output in swept.outputs]
+    if swept.value:
+        return swept.value[1], possible_text
     return None, possible_text
 
 
-def check_gym_ex(pil_image):
-    image = cv2.cvtColor(numpy.array(pil_image), cv2.COLOR_RGB2GRAY)
-    height, width = image.shape
-    if height < 400 or width < 200:
-        #print(f"height: {height} - width: {width}")
-        dim = (round(width*2), round(height*2))
-        image = cv2.resize(image, dim, interpolation=cv2.INTER_AREA)
-    height, width = image.shape
-    maxy = round(height * .38)
-    miny = round(height * .19)
-    maxx = round(width * .87)
-    minx = round(width * .13)
-    gym_name_crop = image[miny:maxy, minx:maxx]
+@metrics.timed_field
+def check_gym_ex(ctx):
+    gym_name_crop = ctx.crop(ctx.box('gym_ex'))
     vals = [180, 190, 200, 210]
     result = {'date': None, 'gym': None, 'location': None}
     regex = r'(?P<date>[A-Za-z]{3,10} [0-9]{1,2} [0-9]{1,2}:[0-9]{1,2}\s*[APM]{2}\s*[-—]*\s*[0-9]{1,2}:[0-9]{1,' \
             r'2}\s*[APM]{2})\s+(?P<gym>[\S+ ]+)\s*(?P<location>[A-Za-z ]+[,\.]+ [A-Za-z]+[,\.]+ [A-Za-z ]+) '
-    for i in vals:
-        thresh = cv2.threshold(gym_name_crop, i, 255, cv2.THRESH_BINARY)[1]
-        thresh = cv2.GaussianBlur(thresh, (5, 5), 0)
-        img_text = pytesseract.image_to_string(thresh, lang='eng', config='--psm 4')
-        regex_result = re.search(regex, img_text)
-        if regex_result:
-            results = regex_result.groupdict()
-            result['date'] = results['date']
-            result['gym'] = results['gym']
-            result['location'] = results['location']
-            break
+    regex_result = _sweep_text(_thresholded(gym_name_crop), lambda img_text: re.search(regex, img_text),
+                               vals, _TEXT_CONFIG).value
+    if regex_result:
+        results = regex_result.groupdict()
+        result['date'] = results['date']
+        result['gym'] = results['gym']
+        result['location'] = results['location']
     return result
 
 
-def scan_raid_photo(pil_image, boss_list, boss_cp_map):
-    start = time.time()
-    image = cv2.cvtColor(numpy.array(pil_image), cv2.COLOR_RGB2GRAY)
-    height, width = image.shape
-    if height < 400 or width < 200:
-        dim = (round(width * 2), round(height * 2))
-        image = cv2.resize(image, dim, interpolation=cv2.INTER_AREA)
-    result_gym = check_gym_name(image)
-    result_egg, result_expire, result_boss, result_tier, result_phone, scanned_values = None, None, None, None, None, []
+def _any_found(results, names):
+    """True once any of the named tasks found something, False once all finished empty-handed, else None"""
+    if any(results.get(name) for name in names):
+        return True
+    if all(name in results for name in names):
+        return False
+    return None
+
+
+def _tier_when(results):
+    return _any_found(results, ('egg', 'expire'))
+
+
+def _phone_when(results):
+    # If we don't find an egg time or a boss, we don't need the phone's time
+    # Even if it's picked up as an egg later, the time won't be correct without egg time
+    return _any_found(results, ('egg', 'boss', 'tier'))
+
+
+def _egg_cancels(result_egg):
+    # Expire time and boss only matter when there is no egg time
+    return ('boss', 'expire') if result_egg else ()
+
+
+def _gym_when(results):
     # If we don't have a gym, no point in checking anything else
-    if result_gym:
-        result_egg = check_egg_time(image)
-        # Only check for expire time and boss if no egg time found
-        # May make sense to reverse this. Tough call.
-        if not result_egg:
-            result_boss, scanned_values = check_boss_cp(image, boss_list, boss_cp_map)
-            result_expire = check_expire_time(image)
-        if result_egg or result_expire:
-            try:
-                boss = False
-                if result_expire:
-                    boss = True
-                result_tier = check_egg_tier(image, boss)
-            except Exception as e:
-                #logger.info(f"Could not read egg tier from text. Error: {e}")
-                # TODO return error
-                pass
-        # If we don't find an egg time or a boss, we don't need the phone's time
-        # Even if it's picked up as an egg later, the time won't be correct without egg time
-        if result_egg or result_boss or result_tier:
-            result_phone = check_phone_time(image)
-    result = {'egg_time': result_egg, 'expire_time': result_expire, 'boss': result_boss, 's_tier': result_tier,
-            'phone_time': result_phone, 'names': result_gym, 'runtime': time.time() - start, 'boss_scans': scanned_values}
+    return _any_found(results, ('gym',))
+
+
+def _safe_egg_tier(ctx):
+    try:
+        return check_egg_tier(ctx)
+    except sweep.Cancelled:
+        raise
+    except Exception:
+        # An unreadable tier is reported like any other field that wasn't found
+        return None
+
+
+# Result key of each raid graph task
+_RAID_FIELDS = {'gym': 'names', 'egg': 'egg_time', 'boss': 'boss', 'expire': 'expire_time', 'tier': 's_tier',
+                'phone': 'phone_time'}
+
+
+def scan_raid_photo(ctx, bosses):
+    start = time.time()
+
+    def boss_task():
+        # Returns only the boss so the graph can test it; the scans are kept for the result
+        result_boss, scanned = check_boss_cp(ctx, bosses)
+        scanned_values.extend(scanned)
+        return result_boss
+
+    # Nothing else starts until the gym is found. Egg time and boss/expire then run
+    # speculatively side by side instead of guessing which one to try first; whichever
+    # is useless for this screenshot is cancelled once the egg time settles it.
+    scanned_values = []
+    graph = taskgraph.TaskGraph()
+    graph.add('gym', check_gym_name, ctx)
+    graph.add('egg', check_egg_time, ctx, when=_gym_when, cancels=_egg_cancels)
+    graph.add('boss', boss_task, when=_gym_when)
+    graph.add('expire', check_expire_time, ctx, when=_gym_when)
+    graph.add('tier', _safe_egg_tier, ctx, when=_tier_when)
+    graph.add('phone', check_phone_time, ctx, when=_phone_when)
+    results, branches = graph.run()
+    for name in branches['expired']:
+        sweep.skip_field(_RAID_FIELDS[name])
+    if 'boss' in branches['wasted'] or 'boss' in branches['skipped']:
+        scanned_values = []
+    result = {'egg_time': results['egg'], 'expire_time': results['expire'], 'boss': results['boss'],
+              's_tier': results['tier'], 'phone_time': results['phone'], 'names': results['gym'],
+              'runtime': time.time() - start, 'boss_scans': scanned_values, 'branches': branches}
     print(result)
     return result
 
 
-def scan_profile(pil_image):
-    image = cv2.cvtColor(numpy.array(pil_image), cv2.COLOR_RGB2BGR)
-    height, width, __ = image.shape
-    if height < 400 or width < 200:
-        #print(f"height: {height} - width: {width}")
-        dim = (round(width*2), round(height*2))
-        image = cv2.resize(image, dim, interpolation=cv2.INTER_AREA)
-    team = determine_team(image)
+def scan_profile(ctx):
+    team = determine_team(ctx)
     if team == 'grey':
         return None, None, None, None
-    level = check_profile_level(image)
-    trainer_name = check_profile_name(image)
+    level = _within_budget(('level',), check_profile_level, ctx)
+    trainer_name = _within_budget(('trainer_name',), check_profile_name, ctx)
     xp = None
     if level:
         try:
             lev_int = int(level)
             if lev_int < 40:
-                xp = get_xp(image)
+                xp = _within_budget(('xp',), get_xp, ctx)
         except ValueError:
             pass
     return {"team ": team , "level": level, "trainer_name": trainer_name, "xp": xp}
 
 
-def process_image(url, scan_type, boss_list, boss_cp_map):
-    image = _get_image(url)
+def process_image(url, scan_type, bosses, use_cache=True, deadline=None):
+    """Scans the screenshot at url. bosses is the current matcher.BossMatcher.
+
+    deadline is an optional budget in seconds for the whole request, fetch included.
+    Fields the budget runs out before are None and listed under 'skipped_fields'.
+    """
+    with sweep.budget_scope(deadline):
+        try:
+            image = _get_image(url)
+        except fetch.FetchError:
+            metrics.count_error(scan_type, 'fetch')
+            raise
+        except OSError:
+            metrics.count_error(scan_type, 'image')
+            raise
+        return process_decoded_image(image, scan_type, bosses, use_cache)
+
+
+def process_image_data(data, scan_type, bosses, use_cache=True, deadline=None):
+    """Scans screenshot bytes someone else downloaded, as process_image does after its fetch"""
+    with sweep.budget_scope(deadline):
+        try:
+            image = fetch.decode(data)
+        except OSError:
+            metrics.count_error(scan_type, 'image')
+            raise
+        return process_decoded_image(image, scan_type, bosses, use_cache)
+
+
+def process_decoded_image(image, scan_type, bosses, use_cache=True):
     #image.filter(ImageFilter.SHARPEN)
+    with metrics.scan(scan_type):
+        cache_key = result_cache.key(scan_type, image) if use_cache else None
+        result = result_cache.get(cache_key)
+        if cache_key is not None:
+            metrics.count_cache_lookup(scan_type, result is not None)
+        if result is not None:
+            return result
+        if ocr_pool.enabled() and not profiling.active():
+            # Profiles can't follow the scan into another process, so profiled scans stay here
+            result = ocr_pool.scan(image, scan_type)
+        else:
+            with ocr_memo.scope():
+                result = _scan_image(image, scan_type, bosses)
+        budget = sweep.current_budget()
+        if budget is not None and budget.skipped:
+            # A partial result is only good for this request, so it isn't cached
+            if isinstance(result, dict):
+                result['skipped_fields'] = list(budget.skipped)
+            return result
+        result_cache.put(cache_key, result)
+        return result
+
+
+SCAN_TYPES = ("expass", "raid", "profile", "boss")
+
+
+def _scan_image(image, scan_type, bosses):
+    ctx = ImageContext(image, config.WORKING_HEIGHTS.get(scan_type))
+    ctx.layout = layout.resolve(ctx, scan_type)
     if scan_type == "expass":
-        return check_gym_ex(image)
+        return (_within_budget(('date', 'gym', 'location'), check_gym_ex, ctx)
+                or {'date': None, 'gym': None, 'location': None})
     if scan_type == "raid":
-        return scan_raid_photo(image, boss_list, boss_cp_map)
+        return scan_raid_photo(ctx, bosses)
     if scan_type == "profile":
-        return scan_profile(image)
+        return scan_profile(ctx)
     if scan_type == "boss":
-        return check_boss_cp_wrap(image)
+        return check_boss_cp_wrap(ctx, bosses)
 
 
 
 def _get_image(url):
-    return Image.open(BytesIO(requests.get(url).content))
+    return fetch.get_image(url)
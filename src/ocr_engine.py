@@ -0,0 +1,241 @@
+import inspect
+import shlex
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy
+import pytesseract
+from PIL import Image
+
+import metrics
+import ocr_memo
+import profiling
+import sweep
+
+try:
+    import tesserocr
+except ImportError:
+    # tesserocr needs the libtesseract headers to build. Without it every call
+    # falls back to pytesseract, which spawns the tesseract binary per call.
+    tesserocr = None
+
+
+# Warm API handles, one free-list per (lang, config) combination.
+# A handle is checked out by one thread at a time and returned afterwards,
+# so a worker never creates more handles per combination than it runs threads.
+_pools = {}
+_pools_lock = threading.Lock()
+# Older pytesseract releases can't time out the tesseract process
+_PYTESSERACT_TIMEOUT = 'timeout' in inspect.signature(pytesseract.image_to_string).parameters
+
+# Recognitions run since import, for benchmarks and stats
+_calls = 0
+_calls_lock = threading.Lock()
+
+
+def _parse_config(config):
+    """Splits a pytesseract style config string into tesserocr init arguments
+
+    Returns a tuple of (psm, oem, tessdata_dir, variables)
+    """
+    psm, oem, tessdata_dir, variables = None, None, None, {}
+    args = shlex.split(config or '')
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg == '--psm':
+            psm = int(args[i + 1])
+            i += 1
+        elif arg == '--oem':
+            oem = int(args[i + 1])
+            i += 1
+        elif arg == '--tessdata-dir':
+            tessdata_dir = args[i + 1]
+            i += 1
+        elif arg == '-c':
+            name, __, value = args[i + 1].partition('=')
+            variables[name] = value
+            i += 1
+        i += 1
+    return psm, oem, tessdata_dir, variables
+
+
+def _create_api(lang, config):
+    psm, oem, tessdata_dir, variables = _parse_config(config)
+    kwargs = {'lang': lang}
+    if tessdata_dir:
+        kwargs['path'] = tessdata_dir
+    if oem is not None:
+        kwargs['oem'] = oem
+    if psm is not None:
+        kwargs['psm'] = psm
+    api = tesserocr.PyTessBaseAPI(**kwargs)
+    for name, value in variables.items():
+        api.SetVariable(name, value)
+    return api
+
+
+@contextmanager
+def _checkout(lang, config):
+    key = (lang, config)
+    with _pools_lock:
+        pool = _pools.setdefault(key, [])
+        api = pool.pop() if pool else None
+    if api is None:
+        api = _create_api(lang, config)
+    try:
+        yield api
+    finally:
+        with _pools_lock:
+            _pools[key].append(api)
+
+
+def _set_image(api, image):
+    if isinstance(image, Image.Image):
+        api.SetImage(image)
+        return
+    image = numpy.ascontiguousarray(image, dtype=numpy.uint8)
+    height, width = image.shape[:2]
+    bytes_per_pixel = 1 if image.ndim == 2 else image.shape[2]
+    api.SetImageBytes(image.tobytes(), width, height, bytes_per_pixel, width * bytes_per_pixel)
+
+
+def _count(calls=1):
+    global _calls
+    with _calls_lock:
+        _calls += calls
+    metrics.count_tesseract_calls(calls)
+
+
+def call_count():
+    """Number of Tesseract recognitions run by this process"""
+    return _calls
+
+
+def _time_left():
+    """Seconds the current request may still spend in Tesseract, or None without a budget"""
+    remaining = sweep.remaining()
+    if remaining is not None and remaining <= 0:
+        raise sweep.DeadlineExceeded()
+    return remaining
+
+
+def _recognize(api):
+    remaining = _time_left()
+    if remaining is not None and not api.Recognize(timeout=max(1, int(remaining * 1000))):
+        # Tesseract stopped part way; the partial text isn't worth returning
+        raise sweep.DeadlineExceeded()
+    return api.GetUTF8Text().strip()
+
+
+def _recognize_page(api):
+    """Recognises the whole image so its result iterator can be walked"""
+    remaining = _time_left()
+    if remaining is None:
+        return api.Recognize()
+    if not api.Recognize(timeout=max(1, int(remaining * 1000))):
+        raise sweep.DeadlineExceeded()
+    return True
+
+
+def _run_pytesseract(image, lang, config, read=pytesseract.image_to_string, **kwargs):
+    remaining = _time_left()
+    if remaining is None or not _PYTESSERACT_TIMEOUT:
+        return read(image, lang=lang, config=config, **kwargs)
+    try:
+        return read(image, lang=lang, config=config, timeout=remaining, **kwargs)
+    except RuntimeError as e:
+        if 'timeout' in str(e).lower():
+            raise sweep.DeadlineExceeded()
+        raise
+
+
+def image_to_string(image, lang='eng', config=''):
+    """Drop-in for pytesseract.image_to_string backed by warm in-process handles
+
+    image can be a numpy array or a PIL image. Under a request budget (see
+    sweep.budget_scope) recognition is stopped when the budget runs out,
+    raising sweep.DeadlineExceeded. Within an ocr_memo.scope, an image already
+    read with the same config is not recognised again.
+    """
+    text, skipped = ocr_memo.read((ocr_memo.digest(image), lang, config),
+                                  lambda: _image_to_string(image, lang, config))
+    if skipped:
+        profiling.record_ocr(config, text, 0)
+    return text
+
+
+def _image_to_string(image, lang, config):
+    _count()
+    start = time.perf_counter()
+    if tesserocr is None:
+        text = _run_pytesseract(image, lang, config).strip()
+    else:
+        with _checkout(lang, config) as api:
+            _set_image(api, image)
+            text = _recognize(api)
+    profiling.record_ocr(config, text, time.perf_counter() - start)
+    return text
+
+
+def _iterator_lines(api):
+    lines = []
+    iterator = api.GetIterator()
+    if iterator is None:
+        return lines
+    level = tesserocr.RIL.TEXTLINE
+    for line in tesserocr.iterate_level(iterator, level):
+        box = line.BoundingBox(level)
+        text = (line.GetUTF8Text(level) or '').strip()
+        if box and text:
+            lines.append((box[1], box[3], text))
+    return lines
+
+
+def _data_lines(data):
+    """Groups the words of pytesseract.image_to_data output back into lines"""
+    lines = {}
+    for i, word in enumerate(data['text']):
+        word = str(word).strip()
+        if not word:
+            continue
+        key = (data['block_num'][i], data['par_num'][i], data['line_num'][i])
+        top = data['top'][i]
+        bottom = top + data['height'][i]
+        if key in lines:
+            line_top, line_bottom, words = lines[key]
+            lines[key] = (min(line_top, top), max(line_bottom, bottom), words + [word])
+        else:
+            lines[key] = (top, bottom, [word])
+    return [(top, bottom, ' '.join(words)) for top, bottom, words in lines.values()]
+
+
+def read_lines(image, lang='eng', config=''):
+    """Recognises image once and returns each line of text as (top, bottom, text), top to bottom"""
+    _count()
+    start = time.perf_counter()
+    if tesserocr is None:
+        data = _run_pytesseract(image, lang, config, read=pytesseract.image_to_data,
+                                output_type=pytesseract.Output.DICT)
+        lines = _data_lines(data)
+    else:
+        with _checkout(lang, config) as api:
+            _set_image(api, image)
+            lines = _iterator_lines(api) if _recognize_page(api) else []
+    lines.sort()
+    profiling.record_ocr(config, '\n'.join(text for __, __, text in lines), time.perf_counter() - start)
+    return lines
+
+
+def warm_up(configs):
+    """Creates one handle for each (lang, config) pair so the first scan doesn't pay for model loading"""
+    if tesserocr is None:
+        return
+    for lang, config in configs:
+        try:
+            with _checkout(lang, config):
+                pass
+        except RuntimeError:
+            # Missing traineddata for this combination; the scan that needs it will raise instead
+            pass
@@ -0,0 +1,213 @@
+import contextvars
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy
+from PIL import Image
+
+import config
+import metrics
+
+
+# Texts read so far by the scan request running in this context. sweep.submit
+# carries it onto pool threads, so every threshold of the request shares it.
+_memo = contextvars.ContextVar('ocr_memo', default=None)
+
+# Recognitions looked up and skipped since import, for /v1/stats and benchmarks
+_stats = {'lookups': 0, 'skipped': 0}
+_stats_lock = threading.Lock()
+
+
+def digest(image):
+    """Fast hash of the pixels of a numpy array or PIL image"""
+    if isinstance(image, Image.Image):
+        data, shape = image.tobytes(), (image.mode, image.size)
+    else:
+        data = numpy.ascontiguousarray(image)
+        shape = (data.dtype.str, data.shape)
+    h = hashlib.blake2b(data, digest_size=16)
+    h.update(repr(shape).encode())
+    return h.digest()
+
+
+class _Entry(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.text = None
+
+
+class ProcessMemo(object):
+    """Texts by key across requests, least recently used first out"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            text = self._entries.get(key)
+            if text is not None:
+                self._entries.move_to_end(key)
+            return text
+
+    def put(self, key, text):
+        with self._lock:
+            self._entries[key] = text
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_process = ProcessMemo(config.OCR_MEMO_PROCESS_SIZE) if config.OCR_MEMO_PROCESS_SIZE > 0 else None
+
+
+class Memo(object):
+    """Texts read during one scan request, by (crop digest, lang, config)
+
+    A variant that is already being read on another pool thread is waited for
+    rather than read twice, since neighbouring thresholds run side by side.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.skipped = 0
+
+    def read(self, key, recognize):
+        with self._lock:
+            self.lookups += 1
+            entry = self._entries.get(key)
+            owner = entry is None
+            if owner:
+                entry = self._entries[key] = _Entry()
+        if not owner:
+            entry.done.wait()
+            if entry.text is None:
+                # The first reader was cancelled or ran out of budget
+                return recognize(), False
+            self._skip()
+            return entry.text, True
+        try:
+            entry.text, hit = _read_process(key, recognize)
+        except BaseException:
+            with self._lock:
+                self._entries.pop(key, None)
+            raise
+        finally:
+            entry.done.set()
+        if hit:
+            self._skip()
+        return entry.text, hit
+
+    def peek(self, key):
+        """Returns the text of key if it has been read already, else None"""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry.done.is_set() and entry.text is not None:
+            return entry.text
+        return _process.get(key) if _process is not None else None
+
+    def store(self, key, text):
+        entry = _Entry()
+        entry.text = text
+        entry.done.set()
+        with self._lock:
+            self._entries.setdefault(key, entry)
+        if _process is not None:
+            _process.put(key, text)
+
+    def count(self, lookups, skipped):
+        with self._lock:
+            self.lookups += lookups
+            self.skipped += skipped
+
+    def _skip(self):
+        with self._lock:
+            self.skipped += 1
+
+
+def _read_process(key, recognize):
+    if _process is not None:
+        text = _process.get(key)
+        if text is not None:
+            return text, True
+    text = recognize()
+    if _process is not None:
+        _process.put(key, text)
+    return text, False
+
+
+def _count(lookups, skipped):
+    with _stats_lock:
+        _stats['lookups'] += lookups
+        _stats['skipped'] += skipped
+    metrics.count_ocr_lookups(lookups, skipped)
+
+
+@contextmanager
+def scope():
+    """Memoizes the reads of the scan inside; yields the Memo, or None with OCR_MEMO off"""
+    if not config.OCR_MEMO:
+        yield None
+        return
+    token = _memo.set(Memo())
+    try:
+        yield _memo.get()
+    finally:
+        _memo.reset(token)
+
+
+def read(key, recognize):
+    """Returns (text, skipped): the memoized text of key, else recognize()"""
+    memo = _memo.get()
+    if memo is None:
+        return recognize(), False
+    text, hit = memo.read(key, recognize)
+    _count(1, int(hit))
+    return text, hit
+
+
+def read_many(keys, recognize):
+    """Returns the text of each key; recognize(indices) reads the keys at indices that aren't memoized, each once"""
+    memo = _memo.get()
+    if memo is None:
+        return recognize(list(range(len(keys))))
+    texts = {}
+    missing = []
+    seen = set()
+    for i, key in enumerate(keys):
+        if key in seen:
+            continue
+        seen.add(key)
+        text = memo.peek(key)
+        if text is None:
+            missing.append(i)
+        else:
+            texts[key] = text
+    if missing:
+        for i, text in zip(missing, recognize(missing)):
+            memo.store(keys[i], text)
+            texts[keys[i]] = text
+    skipped = len(keys) - len(missing)
+    memo.count(len(keys), skipped)
+    _count(len(keys), skipped)
+    return [texts[key] for key in keys]
+
+
+def skip_count():
+    """Recognitions skipped by this process because the same crop had been read already"""
+    return _stats['skipped']
+
+
+def stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['process_entries'] = len(_process) if _process is not None else None
+    return stats
@@ -0,0 +1,226 @@
+import atexit
+import itertools
+import multiprocessing
+import os
+import threading
+
+import numpy
+
+import boss_refresh
+import config
+import sweep
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:
+    # Python before 3.8; the pool is unavailable and scans run in-process
+    resource_tracker = shared_memory = None
+
+
+# Segment names carry the owning process id, so segments of a process that died
+# without unlinking them can be told apart from live ones
+_SEGMENT_PREFIX = 'kyogre_ocr_'
+# Where Linux exposes POSIX shared memory segments as files
+_SHM_DIR = '/dev/shm'
+
+
+# Counters a worker's modules keep for /v1/stats, sent back with each scan and added up here
+_WORKER_COUNTERS = {'layout': ('hits', 'detections', 'confirmations'), 'ocr_memo': ('lookups', 'skipped')}
+
+
+class WorkerLost(Exception):
+    """An OCR pool worker died or hung before returning its scan"""
+
+
+# State of a pool worker process, set up once by _init_worker
+_worker = {}
+
+
+def _init_worker():
+    # Imported here, as the parent's ocr module imports this one
+    import ocr
+    ocr.warm_up_engine()
+    # Follows the parent's boss snapshot; the parent does the fetching
+    _worker['refresher'] = boss_refresh.BossRefresher()
+    _worker['bosses'] = _worker['refresher'].reload()
+
+
+def _counters():
+    import layout
+    import ocr_memo
+    stats = {'layout': layout.stats(), 'ocr_memo': ocr_memo.stats()}
+    return {module: {key: stats[module][key] for key in keys} for module, keys in _WORKER_COUNTERS.items()}
+
+
+def _scan_segment(name, shape, scan_type, boss_version, deadline):
+    """Runs in a worker: scans the image in segment name with ocr's usual scanners
+
+    Returns the result, the fields skipped for the budget and how much the scan
+    moved the worker's counters. A worker runs one scan at a time, so the
+    counters moved by this scan alone.
+    """
+    import ocr
+    import ocr_memo
+    refresher = _worker['refresher']
+    if boss_version is not None and (refresher.version() is None or boss_version > refresher.version()):
+        _worker['bosses'] = refresher.reload()
+    segment = shared_memory.SharedMemory(name=name)
+    try:
+        image = numpy.ndarray(shape, dtype=numpy.uint8, buffer=segment.buf)
+        before = _counters()
+        with sweep.budget_scope(deadline) as budget, ocr_memo.scope():
+            result = ocr._scan_image(image, scan_type, _worker['bosses'])
+        after = _counters()
+        moved = {module: {key: after[module][key] - before[module][key] for key in keys}
+                 for module, keys in _WORKER_COUNTERS.items()}
+        return result, list(budget.skipped) if budget is not None else [], moved
+    finally:
+        image = None
+        try:
+            segment.close()
+        except BufferError:
+            # A view of the image is still referenced, e.g. by a traceback. The mapping
+            # goes with the last view; the parent unlinks the segment either way.
+            pass
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def remove_stale_segments():
+    """Unlinks segments left behind by processes that died before unlinking them. Returns how many."""
+    try:
+        names = os.listdir(_SHM_DIR)
+    except OSError:
+        # No /dev/shm to look in; the resource tracker still cleans up after a crashed parent
+        return 0
+    removed = 0
+    for name in names:
+        if not name.startswith(_SEGMENT_PREFIX):
+            continue
+        pid = name[len(_SEGMENT_PREFIX):].split('_')[0]
+        if pid.isdigit() and not _alive(int(pid)):
+            try:
+                os.remove(os.path.join(_SHM_DIR, name))
+                removed += 1
+            except OSError:
+                pass
+    return removed
+
+
+class OCRPool(object):
+    """Pre-started OCR worker processes, fed decoded screenshots through shared memory
+
+    Each scan copies the decoded pixels into a new segment once and sends the
+    workers only its name and shape, so a 1440x3200 screenshot costs one memcpy
+    rather than pickling 14 MB. Workers start warm: Tesseract handles created
+    and the boss list and CP table loaded.
+
+    The process that creates a segment unlinks it as soon as the scan returns or
+    fails, including when the worker died. Segments are also registered with the
+    multiprocessing resource tracker, which unlinks them if this process dies,
+    and start() removes any left by a process killed along with its tracker.
+    """
+
+    def __init__(self, processes=None, start_method=None):
+        self.processes = processes or config.OCR_POOL_WORKERS
+        self.start_method = start_method or config.OCR_POOL_START_METHOD
+        self._pool = None
+        self._lock = threading.Lock()
+        self._sequence = itertools.count()
+        self._stats = {'scans': 0, 'lost': 0, 'stale_segments': 0, 'bytes': 0}
+        self._worker_stats = {module: dict.fromkeys(keys, 0) for module, keys in _WORKER_COUNTERS.items()}
+
+    def start(self):
+        with self._lock:
+            if self._pool is not None:
+                return
+            self._stats['stale_segments'] += remove_stale_segments()
+            # Started before the workers so they share it: a worker attaching a segment
+            # then only repeats the parent's registration instead of owning the segment
+            resource_tracker.ensure_running()
+            context = multiprocessing.get_context(self.start_method)
+            self._pool = context.Pool(self.processes, initializer=_init_worker)
+        atexit.register(self.stop)
+
+    def stop(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    def scan(self, image, scan_type):
+        """Scans a decoded PIL image on a worker and returns what ocr._scan_image would
+
+        Fields the worker skipped for the request's budget are recorded in this
+        thread's budget, as if the scan had run here.
+        """
+        self.start()
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGB')
+        pixels = numpy.asarray(image)
+        name = '{}{}_{}'.format(_SEGMENT_PREFIX, os.getpid(), next(self._sequence))
+        segment = shared_memory.SharedMemory(name=name, create=True, size=pixels.nbytes)
+        try:
+            numpy.ndarray(pixels.shape, dtype=numpy.uint8, buffer=segment.buf)[...] = pixels
+            remaining = sweep.remaining()
+            task = self._pool.apply_async(_scan_segment, (name, pixels.shape, scan_type, boss_refresh.version(),
+                                                          remaining))
+            # A worker that dies mid-scan is replaced, but its task never returns
+            if remaining is not None:
+                timeout = remaining + config.OCR_POOL_GRACE
+            else:
+                timeout = config.OCR_POOL_UNBUDGETED_WAIT
+            try:
+                result, skipped, moved = task.get(timeout)
+            except multiprocessing.TimeoutError:
+                with self._lock:
+                    self._stats['lost'] += 1
+                raise WorkerLost("No scan back from the OCR pool after {:.1f}s".format(timeout))
+        finally:
+            segment.close()
+            segment.unlink()
+        for field in skipped:
+            sweep.skip_field(field)
+        with self._lock:
+            self._stats['scans'] += 1
+            self._stats['bytes'] += pixels.nbytes
+            for module, counts in moved.items():
+                for key, count in counts.items():
+                    self._worker_stats[module][key] += count
+        return result
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['workers'] = {module: dict(counts) for module, counts in self._worker_stats.items()}
+        stats['processes'] = self.processes if self._pool is not None else 0
+        return stats
+
+
+_pool = OCRPool()
+
+
+def enabled():
+    return config.OCR_POOL_WORKERS > 0 and shared_memory is not None
+
+
+def start():
+    if enabled():
+        _pool.start()
+
+
+def scan(image, scan_type):
+    return _pool.scan(image, scan_type)
+
+
+def stats():
+    return _pool.stats()
@@ -0,0 +1,183 @@
+import cProfile
+import contextvars
+import hmac
+import json
+import os
+import pstats
+import threading
+import time
+
+import config
+import metrics
+
+
+# The profiling session of the request being scanned, if it asked for one.
+# sweep.submit carries it onto pool threads, where each task gets its own profiler.
+_session = contextvars.ContextVar('profile_session', default=None)
+# The OCR texts of the threshold attempt running in this context
+_attempt = contextvars.ContextVar('profile_attempt', default=None)
+
+
+class Session(object):
+    def __init__(self):
+        self.profiles = []
+        self.trace = []
+        self._lock = threading.Lock()
+        self.start = time.perf_counter()
+
+    def add_profile(self, profile):
+        with self._lock:
+            self.profiles.append(profile)
+
+    def add_trace(self, entry):
+        entry['at'] = round(time.perf_counter() - self.start, 6)
+        with self._lock:
+            self.trace.append(entry)
+
+    def stats(self):
+        with self._lock:
+            profiles = list(self.profiles)
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        return stats
+
+
+def authorized(token):
+    """True if token matches PROFILE_TOKEN. Profiling is off while PROFILE_TOKEN is unset."""
+    if not config.PROFILE_TOKEN or not token:
+        return False
+    return hmac.compare_digest(token.encode(), config.PROFILE_TOKEN.encode())
+
+
+def active():
+    return _session.get() is not None
+
+
+def wrap(fn):
+    """Returns fn, or a version that profiles each call into the active session"""
+    session = _session.get()
+    if session is None:
+        return fn
+
+    def profiled(*args):
+        profile = cProfile.Profile()
+        session.add_profile(profile)
+        return profile.runcall(fn, *args)
+    return profiled
+
+
+def traced(attempt, field, accept):
+    """Wraps a sweep attempt so each threshold it tries is added to the session's trace"""
+    session = _session.get()
+
+    def run(candidate):
+        texts = []
+        token = _attempt.set(texts)
+        start = time.perf_counter()
+        entry = {'field': field, 'threshold': candidate, 'texts': texts}
+        try:
+            value = attempt(candidate)
+            entry['value'] = _jsonable(value)
+            entry['matched'] = bool(accept(value))
+            return value
+        except Exception as e:
+            entry['error'] = type(e).__name__
+            raise
+        finally:
+            entry['seconds'] = round(time.perf_counter() - start, 6)
+            _attempt.reset(token)
+            session.add_trace(entry)
+    return run
+
+
+def record_ocr(config_string, text, seconds):
+    """Adds one Tesseract recognition to the running attempt, or to the trace when outside a sweep"""
+    session = _session.get()
+    if session is None:
+        return
+    texts = _attempt.get()
+    if texts is not None:
+        texts.append(text)
+        return
+    session.add_trace({'field': metrics.current_field(), 'config': config_string, 'texts': [text],
+                       'seconds': round(seconds, 6)})
+
+
+def _jsonable(value):
+    # Match results such as matcher.BossScores describe themselves; anything else unknown is shown as its repr
+    if hasattr(value, 'to_dict'):
+        return _jsonable(value.to_dict())
+    if isinstance(value, dict):
+        return {str(k): _jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return repr(value)
+
+
+def profile(fn, *args, dump=False, label='scan'):
+    """Runs fn(*args) with every thread it fans out to profiled
+
+    Returns (result, report). The report has the trimmed call tree, the threshold
+    trace and, with dump and PROFILE_DIR set, the path of the saved pstats file.
+    """
+    session = Session()
+    token = _session.set(session)
+    try:
+        result = wrap(fn)(*args)
+    finally:
+        _session.reset(token)
+    stats = session.stats()
+    report = {'seconds': round(time.perf_counter() - session.start, 6),
+              'threads': len(session.profiles),
+              'call_tree': call_tree(stats),
+              'trace': sorted(session.trace, key=lambda entry: entry['at'])}
+    if dump and config.PROFILE_DIR:
+        report['dump'] = _dump(stats, report, label)
+    return result, report
+
+
+def _dump(stats, report, label):
+    os.makedirs(config.PROFILE_DIR, exist_ok=True)
+    path = os.path.join(config.PROFILE_DIR, '{}-{}.prof'.format(time.strftime('%Y%m%d-%H%M%S'), label))
+    # The .prof file loads into snakeviz, flameprof or gprof2dot for a flame graph
+    stats.dump_stats(path)
+    with open(path + '.json', 'w') as f:
+        json.dump(report, f, indent=2)
+    return path
+
+
+def _name(func):
+    filename, line, name = func
+    if filename == '~':
+        return name
+    return '{}:{}({})'.format(os.path.basename(filename), line, name)
+
+
+def call_tree(stats, min_fraction=None, max_depth=None):
+    """Returns the profiled calls as a tree, dropping calls under min_fraction of the total time"""
+    min_fraction = config.PROFILE_MIN_FRACTION if min_fraction is None else min_fraction
+    max_depth = config.PROFILE_MAX_DEPTH if max_depth is None else max_depth
+    callees = {}
+    for func, (__, __, __, __, callers) in stats.stats.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((func, edge))
+    roots = [func for func, row in stats.stats.items() if not row[4]]
+    total = sum(stats.stats[func][3] for func in roots) or stats.total_tt or 1
+    cutoff = total * min_fraction
+
+    def node(func, calls, self_seconds, seconds, depth, path):
+        entry = {'function': _name(func), 'calls': calls, 'seconds': round(seconds, 6),
+                 'self_seconds': round(self_seconds, 6)}
+        if depth < max_depth and func not in path:
+            children = [node(child, edge[1], edge[2], edge[3], depth + 1, path | {func})
+                        for child, edge in callees.get(func, ()) if edge[3] >= cutoff]
+            if children:
+                entry['children'] = sorted(children, key=lambda c: c['seconds'], reverse=True)
+        return entry
+
+    tree = [node(func, stats.stats[func][1], stats.stats[func][2], stats.stats[func][3], 0, frozenset())
+            for func in roots if stats.stats[func][3] >= cutoff]
+    return sorted(tree, key=lambda c: c['seconds'], reverse=True)
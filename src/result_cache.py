@@ -0,0 +1,171 @@
+import copy
+import json
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import numpy
+from PIL import Image
+
+import config
+
+
+# Results of these scan types depend on the boss tables swapped in by /v1/setup
+BOSS_DEPENDENT = ('raid', 'boss')
+# Results of these scan types carry timers, read from exactly the small text that differs
+# between two screenshots of the same raid, so only an identical hash may reuse them
+TIMED = ('raid',)
+
+# bucket: (scan_type, aspect ratio); a resized re-upload lands in the same bucket
+# generation: the scan type's generation when the scan started
+CacheKey = namedtuple('CacheKey', ['bucket', 'phash', 'generation'])
+
+
+class _Entry(object):
+    def __init__(self, key, result, size):
+        self.key = key
+        self.result = result
+        self.size = size
+        self.created = time.time()
+
+
+def dhash(pil_image, size=None):
+    """Difference hash of an image as an int of size * size bits"""
+    size = size or config.RESULT_CACHE_HASH_SIZE
+    gray = pil_image.convert('L').resize((size + 1, size), Image.BILINEAR)
+    pixels = numpy.asarray(gray, dtype=numpy.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(numpy.packbits(bits).tobytes(), 'big')
+
+
+def _distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+class ResultCache(object):
+    """LRU cache of scan results for near-duplicate screenshots
+
+    Near duplicates are only served for scan types outside TIMED. Entries expire
+    after ttl seconds, and the oldest are evicted past max_entries or once the
+    estimated size of the stored results passes max_bytes.
+    """
+
+    def __init__(self, max_distance=None, ttl=None, max_entries=None, max_bytes=None):
+        self.max_distance = config.RESULT_CACHE_MAX_DISTANCE if max_distance is None else max_distance
+        self.ttl = ttl or config.RESULT_CACHE_TTL
+        self.max_entries = max_entries or config.RESULT_CACHE_MAX_ENTRIES
+        self.max_bytes = max_bytes or config.RESULT_CACHE_MAX_BYTES
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._buckets = {}
+        self._generations = {}
+        self._bytes = 0
+        self._stats = {'hits': 0, 'near_hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def key(self, scan_type, pil_image):
+        width, height = pil_image.size
+        with self._lock:
+            generation = self._generations.get(scan_type, 0)
+        return CacheKey((scan_type, round(height / width, 2)), dhash(pil_image), generation)
+
+    def get(self, key):
+        """Returns a copy of the cached result for key or a near duplicate, or None"""
+        now = time.time()
+        max_distance = 0 if key.bucket[0] in TIMED else self.max_distance
+        with self._lock:
+            best, best_distance = None, None
+            for entry in self._buckets.get(key.bucket, ()):
+                if now - entry.created > self.ttl:
+                    continue
+                distance = _distance(entry.key.phash, key.phash)
+                if distance <= max_distance and (best is None or distance < best_distance):
+                    best, best_distance = entry, distance
+                    if distance == 0:
+                        break
+            if best is None:
+                self._stats['misses'] += 1
+                return None
+            self._stats['hits' if best_distance == 0 else 'near_hits'] += 1
+            self._entries.move_to_end(id(best))
+            return copy.deepcopy(best.result)
+
+    def put(self, key, result):
+        if result is None:
+            return
+        size = len(json.dumps(result, default=str)) + key.phash.bit_length() // 8
+        now = time.time()
+        with self._lock:
+            if key.generation != self._generations.get(key.bucket[0], 0):
+                # The boss tables changed while this scan ran
+                return
+            entry = _Entry(key, copy.deepcopy(result), size)
+            self._entries[id(entry)] = entry
+            self._buckets.setdefault(key.bucket, []).append(entry)
+            self._bytes += size
+            self._evict(now)
+
+    def invalidate(self, scan_types=BOSS_DEPENDENT):
+        """Drops every entry of the given scan types and rejects results of scans already running"""
+        with self._lock:
+            for scan_type in scan_types:
+                self._generations[scan_type] = self._generations.get(scan_type, 0) + 1
+            for entry in list(self._entries.values()):
+                if entry.key.bucket[0] in scan_types:
+                    self._remove(entry)
+            self._stats['invalidations'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+            return stats
+
+    def _evict(self, now):
+        while self._entries:
+            oldest = next(iter(self._entries.values()))
+            expired = now - oldest.created > self.ttl
+            if not expired and len(self._entries) <= self.max_entries and self._bytes <= self.max_bytes:
+                break
+            self._remove(oldest)
+            self._stats['evictions'] += 1
+        # LRU order isn't creation order, so expired entries can sit behind fresh ones
+        for entry in [e for e in self._entries.values() if now - e.created > self.ttl]:
+            self._remove(entry)
+
+    def _remove(self, entry):
+        del self._entries[id(entry)]
+        bucket = self._buckets[entry.key.bucket]
+        bucket.remove(entry)
+        if not bucket:
+            del self._buckets[entry.key.bucket]
+        self._bytes -= entry.size
+
+
+_cache = ResultCache()
+
+
+def key(scan_type, pil_image):
+    """Returns the cache key for a decoded screenshot, or None when caching is disabled"""
+    if not config.RESULT_CACHE_ENABLED:
+        return None
+    return _cache.key(scan_type, pil_image)
+
+
+def get(key):
+    if key is None:
+        return None
+    return _cache.get(key)
+
+
+def put(key, result):
+    if key is not None:
+        _cache.put(key, result)
+
+
+def invalidate(scan_types=BOSS_DEPENDENT):
+    _cache.invalidate(scan_types)
+
+
+def stats():
+    return _cache.stats()
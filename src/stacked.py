@@ -0,0 +1,107 @@
+import bisect
+
+import cv2
+import numpy
+
+import config
+import metrics
+import ocr_engine
+import ocr_memo
+import profiling
+import sweep
+import threshold_plans
+
+
+# Blank rows between stacked variants, and columns either side of them
+_MIN_GAP = 12
+
+
+def _dark_on_light(image):
+    """Returns image as dark text on a light background, whichever way round the threshold left it"""
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    border = numpy.concatenate([image[0], image[-1], image[:, 0], image[:, -1]])
+    if numpy.median(border) < 128:
+        return cv2.bitwise_not(image)
+    return image
+
+
+def tile(images):
+    """Stacks images top to bottom on a blank page, separated by blank bands
+
+    Returns the page and the (top, bottom) rows of each image on it. The gaps are
+    at least half an image tall so Tesseract never joins lines of two variants.
+    """
+    images = [_dark_on_light(image) for image in images]
+    gap = max(_MIN_GAP, max(image.shape[0] for image in images) // 2)
+    width = max(image.shape[1] for image in images) + 2 * _MIN_GAP
+    height = sum(image.shape[0] for image in images) + gap * (len(images) + 1)
+    page = numpy.full((height, width), 255, dtype=numpy.uint8)
+    bands = []
+    top = gap
+    for image in images:
+        bottom = top + image.shape[0]
+        page[top:bottom, _MIN_GAP:_MIN_GAP + image.shape[1]] = image
+        bands.append((top, bottom))
+        top = bottom + gap
+    return page, bands
+
+
+def split(lines, bands):
+    """Returns the text of each band, from (top, bottom, text) lines read off the whole page"""
+    # Each band owns the rows down to halfway through the gap below it
+    boundaries = [(bands[i][1] + bands[i + 1][0]) / 2 for i in range(len(bands) - 1)]
+    texts = [[] for __ in bands]
+    for top, bottom, text in lines:
+        texts[bisect.bisect_right(boundaries, (top + bottom) / 2)].append(text)
+    return ['\n'.join(band) for band in texts]
+
+
+def read(images, lang='eng', ocr_config=''):
+    """Returns the text of each image, reading every one not memoized with a single Tesseract call"""
+    def recognize(indices):
+        page, bands = tile([images[i] for i in indices])
+        return split(ocr_engine.read_lines(page, lang=lang, config=ocr_config), bands)
+    keys = [(ocr_memo.digest(image), lang, ocr_config) for image in images]
+    return ocr_memo.read_many(keys, recognize)
+
+
+def first_match(render, parse, candidates, accept=bool, field=None, lang='eng', ocr_config='', group=None):
+    """Stacked version of sweep.first_match
+
+    render(candidate) returns the image variant to read and parse(text) the value
+    read from it. Up to `group` variants are read per Tesseract call, then parsed
+    in candidate order; the first accepted value wins, exactly as if each had been
+    read on its own. Later groups are only read if an earlier one has no match.
+    """
+    if field:
+        candidates = threshold_plans.plan(field, candidates)
+    swept = _sweep(render, parse, list(candidates), accept, field, lang, ocr_config,
+                   group or config.STACKED_SWEEP_GROUP)
+    if field:
+        threshold_plans.record(field, swept.candidate, candidates[:len(swept.outputs)])
+        metrics.count_sweep(field, len(swept.outputs))
+    return swept
+
+
+def _sweep(render, parse, candidates, accept, field, lang, ocr_config, group):
+    texts = {}
+
+    def attempt(candidate):
+        # The text already came back with the rest of the group; only parsing is left
+        profiling.record_ocr(ocr_config, texts[candidate], 0)
+        return parse(texts[candidate])
+    if profiling.active():
+        attempt = profiling.traced(attempt, field, accept)
+
+    outputs = []
+    for start in range(0, len(candidates), group):
+        chunk = candidates[start:start + group]
+        sweep.check_cancelled()
+        texts.update(zip(chunk, read([render(candidate) for candidate in chunk], lang, ocr_config)))
+        for candidate in chunk:
+            value = attempt(candidate)
+            outputs.append(value)
+            if accept(value):
+                return sweep.Sweep(candidate, value, outputs)
+    return sweep.Sweep(None, None, outputs)
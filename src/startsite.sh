@@ -1 +1,7 @@
-gunicorn -w 4 app:app
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/kyogre_metrics}
+# SERVER_MODE=asgi serves the same API from asgi_app.py: async downloads, OCR on a thread pool per worker
+if [ "$SERVER_MODE" = "asgi" ]; then
+    gunicorn -c gunicorn_config.py -k uvicorn.workers.UvicornWorker -w 4 asgi_app:app
+else
+    gunicorn -c gunicorn_config.py -w 4 app:app
+fi
@@ -0,0 +1,184 @@
+import contextvars
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import config
+import metrics
+import profiling
+import threshold_plans
+
+
+# candidate: the candidate that produced the accepted value, or None
+# value: the accepted value, or None
+# outputs: every attempt's output in priority order, up to and including the accepted one
+Sweep = namedtuple('Sweep', ['candidate', 'value', 'outputs'])
+
+_executor = ThreadPoolExecutor(max_workers=config.SWEEP_WORKERS)
+
+# Event set by whoever owns the current scan task to stop its sweeps early
+_cancel_event = contextvars.ContextVar('sweep_cancel_event', default=None)
+
+
+class Cancelled(Exception):
+    """Raised before the next OCR attempt once the owning task has been cancelled"""
+
+
+@contextmanager
+def cancel_scope(event):
+    token = _cancel_event.set(event)
+    try:
+        yield
+    finally:
+        _cancel_event.reset(token)
+
+
+class DeadlineExceeded(Cancelled):
+    """Raised before the next OCR attempt once the request's latency budget is spent"""
+
+
+class Budget(object):
+    """The latency budget of one request, and the fields it ran out before reading"""
+
+    def __init__(self, seconds):
+        self.deadline = time.monotonic() + seconds
+        self.skipped = []
+        self._lock = threading.Lock()
+
+    def remaining(self):
+        return self.deadline - time.monotonic()
+
+    def skip(self, field):
+        with self._lock:
+            if field not in self.skipped:
+                self.skipped.append(field)
+
+
+# Budget of the request being scanned, if it has one
+_budget = contextvars.ContextVar('sweep_budget', default=None)
+
+
+@contextmanager
+def budget_scope(seconds):
+    """Gives the scan inside a budget of seconds; None or 0 means no budget. Yields the Budget or None."""
+    if not seconds:
+        yield None
+        return
+    budget = Budget(seconds)
+    token = _budget.set(budget)
+    try:
+        yield budget
+    finally:
+        _budget.reset(token)
+
+
+def scan_deadline(requested=None):
+    """Returns the budget in seconds for a scan that requested one, or None for no budget
+
+    A request that didn't ask gets SCAN_DEADLINE. Budgets are capped at SCAN_MAX_DEADLINE,
+    and 0 or less turns the budget off.
+    """
+    try:
+        deadline = float(config.SCAN_DEADLINE if requested is None else requested)
+    except (TypeError, ValueError):
+        deadline = config.SCAN_DEADLINE
+    if deadline <= 0:
+        return None
+    return min(deadline, config.SCAN_MAX_DEADLINE)
+
+
+def current_budget():
+    return _budget.get()
+
+
+def remaining():
+    """Seconds left in the current request's budget, or None without one"""
+    budget = _budget.get()
+    return budget.remaining() if budget is not None else None
+
+
+def skip_field(field):
+    """Records that the current request's budget ran out before field was read"""
+    budget = _budget.get()
+    if budget is not None:
+        budget.skip(field)
+
+
+def check_cancelled():
+    event = _cancel_event.get()
+    if event is not None and event.is_set():
+        raise Cancelled()
+    budget = _budget.get()
+    if budget is not None and budget.remaining() <= 0:
+        raise DeadlineExceeded()
+
+
+def submit(executor, fn, *args):
+    """Submits fn in a copy of the current context so cancel scopes follow it onto pool threads"""
+    return executor.submit(contextvars.copy_context().run, profiling.wrap(fn), *args)
+
+
+def _checked(attempt):
+    def run(candidate):
+        check_cancelled()
+        return attempt(candidate)
+    return run
+
+
+def first_match(attempt, candidates, accept=bool, window=None, field=None):
+    """Runs attempt(candidate) for each candidate on the shared sweep pool
+
+    Up to `window` attempts run at once. Outputs are consumed in the original
+    candidate order, so the accepted value is always the first one in priority
+    order, not the first one to finish. Attempts still outstanding once a value
+    is accepted are cancelled; an attempt already inside Tesseract runs to
+    completion but its output is ignored.
+
+    With a field name, the candidates are reordered by the field's learned plan
+    and the accepted candidate is recorded against it.
+    """
+    if field:
+        candidates = threshold_plans.plan(field, candidates)
+    if profiling.active():
+        attempt = profiling.traced(attempt, field, accept)
+    swept = _sweep(_checked(attempt), candidates, accept, window or config.SWEEP_WINDOW)
+    if field:
+        threshold_plans.record(field, swept.candidate, candidates[:len(swept.outputs)])
+        metrics.count_sweep(field, len(swept.outputs))
+    return swept
+
+
+def _sweep(attempt, candidates, accept, window):
+    outputs = []
+    if window <= 1:
+        for candidate in candidates:
+            value = attempt(candidate)
+            outputs.append(value)
+            if accept(value):
+                return Sweep(candidate, value, outputs)
+        return Sweep(None, None, outputs)
+
+    remaining = iter(candidates)
+    pending = deque()
+
+    def submit_next():
+        for candidate in remaining:
+            pending.append((candidate, submit(_executor, attempt, candidate)))
+            return
+
+    for __ in range(window):
+        submit_next()
+    try:
+        while pending:
+            candidate, future = pending.popleft()
+            value = future.result()
+            outputs.append(value)
+            if accept(value):
+                return Sweep(candidate, value, outputs)
+            submit_next()
+    finally:
+        for __, future in pending:
+            future.cancel()
+    return Sweep(None, None, outputs)
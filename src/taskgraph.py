@@ -0,0 +1,135 @@
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import config
+import sweep
+
+
+_executor = ThreadPoolExecutor(max_workers=config.GRAPH_WORKERS)
+
+
+def _never(value):
+    return ()
+
+
+def _out_of_time():
+    remaining = sweep.remaining()
+    return remaining is not None and remaining <= 0
+
+
+class _Task(object):
+    def __init__(self, name, fn, args, when, cancels):
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.when = when
+        self.cancels = cancels or _never
+        self.event = threading.Event()
+        self.future = None
+
+
+class TaskGraph(object):
+    """A small graph of field tasks that run concurrently where their preconditions allow
+
+    Each task's `when(results)` is re-evaluated whenever another task finishes. It
+    sees the values of finished, skipped and cancelled tasks (the latter two as None)
+    and returns True to start the task, False to skip it, or None if it can't tell yet.
+    Tasks without a `when` start immediately.
+
+    `cancels(value)` returns the names of tasks made pointless by a task's value. Those
+    are cancelled: not started if pending, stopped before their next OCR attempt if
+    running, and their value discarded if already finished.
+    """
+
+    def __init__(self, executor=None):
+        self._executor = executor or _executor
+        self._tasks = {}
+        self._results = {}
+        self._running = {}
+        self._wasted = []
+        self._skipped = []
+        self._expired = []
+        self._timings = {}
+
+    def add(self, name, fn, *args, when=None, cancels=None):
+        self._tasks[name] = _Task(name, fn, args, when, cancels)
+
+    def run(self):
+        """Runs the graph to completion
+
+        Returns a tuple of (results, report). results maps every task name to its
+        value, or None if it was skipped, cancelled or discarded. report lists the
+        wasted tasks (ran, but their work was thrown away), the skipped ones, the
+        expired ones (stopped or never started because the request's budget ran
+        out) and the time spent in each task that ran.
+        """
+        self._schedule()
+        while self._running:
+            done, __ = wait(list(self._running), return_when=FIRST_COMPLETED)
+            for future in done:
+                task = self._running.pop(future)
+                if task.name in self._results:
+                    # Cancelled while running; its value was already discarded
+                    continue
+                value = future.result()
+                self._results[task.name] = value
+                for name in task.cancels(value):
+                    self._cancel(name)
+            self._schedule()
+        for name in self._tasks:
+            if name not in self._results:
+                self._results[name] = None
+                self._skipped.append(name)
+        report = {'wasted': self._wasted, 'skipped': self._skipped, 'expired': self._expired,
+                  'timings': self._timings}
+        return dict(self._results), report
+
+    def _schedule(self):
+        changed = True
+        while changed:
+            changed = False
+            for task in self._tasks.values():
+                if task.future is not None or task.name in self._results:
+                    continue
+                ready = task.when(dict(self._results)) if task.when else True
+                if ready and _out_of_time():
+                    self._results[task.name] = None
+                    self._expired.append(task.name)
+                    changed = True
+                elif ready:
+                    task.future = sweep.submit(self._executor, self._call, task)
+                    self._running[task.future] = task
+                elif ready is False:
+                    self._results[task.name] = None
+                    self._skipped.append(task.name)
+                    changed = True
+
+    def _call(self, task):
+        start = time.time()
+        try:
+            with sweep.cancel_scope(task.event):
+                return task.fn(*task.args)
+        except sweep.DeadlineExceeded:
+            self._expired.append(task.name)
+            return None
+        except sweep.Cancelled:
+            return None
+        finally:
+            self._timings[task.name] = time.time() - start
+
+    def _cancel(self, name):
+        task = self._tasks[name]
+        if task.future is None:
+            if name not in self._results:
+                self._results[name] = None
+                self._skipped.append(name)
+            return
+        if name in self._wasted or name in self._skipped:
+            return
+        task.event.set()
+        if task.future.cancel():
+            self._skipped.append(name)
+        else:
+            self._wasted.append(name)
+        self._results[name] = None
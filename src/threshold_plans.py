@@ -0,0 +1,217 @@
+import json
+import os
+import random
+import threading
+
+import config
+
+try:
+    import fcntl
+except ImportError:
+    # Windows; a single dev server process has nothing to race with
+    fcntl = None
+
+
+def _unique(candidates):
+    seen = set()
+    return [c for c in candidates if not (c in seen or seen.add(c))]
+
+
+def _add_pending(totals, pending):
+    for field, counts in pending.items():
+        stats = totals.setdefault(field, _empty())
+        stats['runs'] += counts['runs']
+        stats['misses'] += counts['misses']
+        _add_counts(stats['hits'], counts['hits'])
+        _add_counts(stats['tries'], counts['tries'])
+    return totals
+
+
+def _empty():
+    return {'runs': 0, 'misses': 0, 'hits': {}, 'tries': {}}
+
+
+def _add_counts(into, counts):
+    for candidate, count in counts.items():
+        into[candidate] = into.get(candidate, 0) + count
+
+
+class ThresholdPlans(object):
+    """Learns which thresholds of each sweep actually produce the accepted match
+
+    A candidate's hit rate is its hits over the sweeps that actually tried it, so
+    candidates late in the order aren't penalised for the sweeps an earlier one
+    settled. Candidates are tried in order of hit rate, with ties keeping the
+    hand-picked order. A candidate tried min_runs times that hits less than
+    min_hit_rate of the time is left out. A random exploration_rate share of
+    sweeps instead tries every candidate in a shuffled order, so left-out and
+    late candidates can earn their place.
+
+    Counts are merged into the JSON file at path every flush_every records, under
+    a file lock, so all gunicorn workers learn from each other. The file is
+    written outside the lock plan and record take, so sweeps never wait on it.
+    """
+
+    def __init__(self, path=None, min_runs=None, min_hit_rate=None, exploration_rate=None, flush_every=None):
+        self.path = path or config.THRESHOLD_PLAN_PATH
+        self.min_runs = config.THRESHOLD_MIN_RUNS if min_runs is None else min_runs
+        self.min_hit_rate = config.THRESHOLD_MIN_HIT_RATE if min_hit_rate is None else min_hit_rate
+        self.exploration_rate = (config.THRESHOLD_EXPLORATION_RATE if exploration_rate is None
+                                 else exploration_rate)
+        self.flush_every = flush_every or config.THRESHOLD_FLUSH_EVERY
+        self._lock = threading.Lock()
+        # Held by whoever is writing the file, so flushes land in order
+        self._write_lock = threading.Lock()
+        self._totals = self._read()
+        self._pending = {}
+        self._pending_count = 0
+
+    def plan(self, field, defaults):
+        """Returns the order to try the default candidates of field in"""
+        candidates = _unique(defaults)
+        if random.random() < self.exploration_rate:
+            random.shuffle(candidates)
+            return candidates
+        return self._learned(field, candidates)
+
+    def _learned(self, field, candidates):
+        with self._lock:
+            stats = self._merged(field)
+
+        def rate(c):
+            tries = stats['tries'].get(c, 0)
+            return stats['hits'].get(c, 0) / tries if tries else 0.0
+        ordered = sorted(candidates, key=lambda c: -rate(c))
+        kept = [c for c in ordered if stats['tries'].get(c, 0) < self.min_runs or rate(c) >= self.min_hit_rate]
+        # Never prune a field down to nothing
+        return kept or ordered
+
+    def record(self, field, candidate, tried=()):
+        """Records the candidate that produced the accepted match, or None for a miss
+
+        tried lists every candidate the sweep read, the accepted one included.
+        """
+        with self._lock:
+            stats = self._pending.setdefault(field, _empty())
+            stats['runs'] += 1
+            if candidate is None:
+                stats['misses'] += 1
+            else:
+                stats['hits'][candidate] = stats['hits'].get(candidate, 0) + 1
+            for c in tried:
+                stats['tries'][c] = stats['tries'].get(c, 0) + 1
+            self._pending_count += 1
+            flush = self._pending_count >= self.flush_every
+        if flush:
+            self.flush(wait=False)
+
+    def snapshot(self, defaults=None):
+        """Returns the learned counts per field, with the current plan for fields in defaults
+
+        The file is read afresh first, so counts flushed by other processes, such
+        as OCR pool workers, show up here too.
+        """
+        with self._write_lock:
+            totals = self._read()
+            with self._lock:
+                self._totals = totals
+                fields = set(self._totals) | set(self._pending)
+                result = {field: self._merged(field) for field in fields}
+        for field, stats in result.items():
+            if defaults and field in defaults:
+                stats['plan'] = self._learned(field, _unique(defaults[field]))
+            stats['hits'] = {str(c): n for c, n in stats['hits'].items()}
+            stats['tries'] = {str(c): n for c, n in stats['tries'].items()}
+        return result
+
+    def reset(self, field=None):
+        """Forgets the counts of field, or of every field"""
+        with self._write_lock:
+            with self._lock:
+                if field is None:
+                    self._pending = {}
+                else:
+                    self._pending.pop(field, None)
+            self._write(lambda totals: {} if field is None else
+                        {f: s for f, s in totals.items() if f != field})
+
+    def flush(self, wait=True):
+        """Merges the pending counts into the file. Without wait, returns at once if another flush is running."""
+        if not self._write_lock.acquire(blocking=wait):
+            return
+        try:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._pending_count = 0
+            if pending:
+                self._write(lambda totals: _add_pending(totals, pending))
+        finally:
+            self._write_lock.release()
+
+    def _merged(self, field):
+        merged = _empty()
+        for stats in (self._totals.get(field, _empty()), self._pending.get(field, _empty())):
+            merged['runs'] += stats['runs']
+            merged['misses'] += stats['misses']
+            _add_counts(merged['hits'], stats['hits'])
+            _add_counts(merged['tries'], stats['tries'])
+        return merged
+
+    def _write(self, update):
+        """Applies update to the counts in the file under the file lock; the caller holds _write_lock"""
+        lock_path = self.path + '.lock'
+        with open(lock_path, 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                totals = update(self._read())
+                tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+                with open(tmp_path, 'w') as f:
+                    json.dump({field: {'runs': s['runs'], 'misses': s['misses'],
+                                       'hits': {str(c): n for c, n in s['hits'].items()},
+                                       'tries': {str(c): n for c, n in s['tries'].items()}}
+                               for field, s in totals.items()}, f, indent=2, sort_keys=True)
+                os.replace(tmp_path, self.path)
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+        with self._lock:
+            self._totals = totals
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        # JSON keys are strings; thresholds are ints. Files from before 'tries' count nothing as tried.
+        return {field: {'runs': s['runs'], 'misses': s['misses'],
+                        'hits': {int(c): n for c, n in s['hits'].items()},
+                        'tries': {int(c): n for c, n in s.get('tries', {}).items()}}
+                for field, s in data.items()}
+
+
+_plans = ThresholdPlans()
+
+
+def plan(field, defaults):
+    if not config.THRESHOLD_TUNING:
+        return list(defaults)
+    return _plans.plan(field, defaults)
+
+
+def record(field, candidate, tried=()):
+    if config.THRESHOLD_TUNING:
+        _plans.record(field, candidate, tried)
+
+
+def snapshot(defaults=None):
+    return _plans.snapshot(defaults)
+
+
+def reset(field=None):
+    _plans.reset(field)
+
+
+def flush():
+    _plans.flush()
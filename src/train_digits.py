@@ -0,0 +1,119 @@
+"""Trains the digit recognizer used by digits.py on locally rendered timer, clock, CP and reject-class strings
+
+Usage: python train_digits.py [--samples 20000] [--epochs 8] [--font path.ttf ...] [--output models/digits.h5]
+"""
+import argparse
+import glob
+import os
+import random
+
+import numpy
+import tensorflow as tf
+from PIL import Image, ImageDraw, ImageFilter, ImageFont
+
+import config
+import digits
+
+
+_FONT_DIRS = ['/usr/share/fonts', '/Library/Fonts', 'C:\\Windows\\Fonts']
+
+
+def find_fonts():
+    fonts = []
+    for font_dir in _FONT_DIRS:
+        fonts += glob.glob(os.path.join(font_dir, '**', '*.ttf'), recursive=True)
+    return fonts
+
+
+# Letters for the reject class, leaving out the ones that look like a digit (O, l, S, B...)
+_REJECT_LETTERS = 'ACEFHKMNPRTUVWXYacdefhkmnprtuvwxy'
+
+
+def random_text():
+    kind = random.choice(['timer', 'clock', 'cp', 'word'])
+    if kind == 'word':
+        return ''.join(random.choice(_REJECT_LETTERS) for __ in range(random.randint(3, 8)))
+    if kind == 'timer':
+        return '{}:{:02d}:{:02d}'.format(random.randint(0, 1), random.randint(0, 59), random.randint(0, 59))
+    if kind == 'clock':
+        return '{}:{:02d}'.format(random.randint(1, 12), random.randint(0, 59))
+    return str(random.randint(500, 99999))
+
+
+def render(text, font_path):
+    """Renders text the way it shows on a screenshot crop, with blur, noise and either polarity"""
+    size = random.randint(18, 64)
+    font = ImageFont.truetype(font_path, size) if font_path else ImageFont.load_default()
+    light = random.random() < .5
+    background, foreground = (random.randint(0, 80), random.randint(200, 255))
+    if light:
+        background, foreground = foreground, background
+    width, height = font.getsize(text)
+    pad = random.randint(4, 20)
+    image = Image.new('L', (width + pad * 2, height + pad * 2), background)
+    ImageDraw.Draw(image).text((pad, pad), text, fill=foreground, font=font)
+    if not font_path:
+        scale = random.uniform(1.5, 4)
+        image = image.resize((round(image.width * scale), round(image.height * scale)), Image.BILINEAR)
+    if random.random() < .5:
+        image = image.filter(ImageFilter.GaussianBlur(random.uniform(.3, 1.2)))
+    pixels = numpy.asarray(image, dtype=numpy.float32)
+    pixels += numpy.random.normal(0, random.uniform(0, 12), pixels.shape)
+    return numpy.clip(pixels, 0, 255).astype(numpy.uint8)
+
+
+def build_dataset(samples, fonts):
+    """Renders strings and segments them with digits.segment, so training sees the same glyph crops as scans"""
+    glyphs, labels = [], []
+    while len(glyphs) < samples:
+        text = random_text()
+        pixels = render(text, random.choice(fonts) if fonts else None)
+        binary = digits.binarize(pixels)
+        boxes, __ = digits.segment(binary)
+        if len(boxes) != len(text):
+            # Segmentation disagreed with the ground truth; labels would be misaligned
+            continue
+        for char, box in zip(text, boxes):
+            glyphs.append(digits.normalize_glyph(binary, box))
+            labels.append(digits.CHARSET.index(char) if char in digits.CHARSET else digits.REJECT)
+    return numpy.stack(glyphs)[..., numpy.newaxis], numpy.array(labels)
+
+
+def build_model():
+    model = tf.keras.Sequential([
+        tf.keras.layers.Conv2D(16, 3, activation='relu', input_shape=(digits.GLYPH_SIZE, digits.GLYPH_SIZE, 1)),
+        tf.keras.layers.MaxPooling2D(),
+        tf.keras.layers.Conv2D(32, 3, activation='relu'),
+        tf.keras.layers.MaxPooling2D(),
+        tf.keras.layers.Flatten(),
+        tf.keras.layers.Dropout(.25),
+        tf.keras.layers.Dense(64, activation='relu'),
+        tf.keras.layers.Dense(digits.CLASSES, activation='softmax'),
+    ])
+    model.compile(optimizer='adam', loss='sparse_categorical_crossentropy', metrics=['accuracy'])
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--samples', type=int, default=20000, help='glyphs to render')
+    parser.add_argument('--epochs', type=int, default=8)
+    parser.add_argument('--font', action='append', help='TTF font to render with; defaults to the system fonts')
+    parser.add_argument('--output', default=config.DIGIT_MODEL_PATH)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    numpy.random.seed(args.seed)
+    fonts = args.font or find_fonts()
+    print("Rendering {} glyphs with {} fonts".format(args.samples, len(fonts) or 'the default'))
+    x, y = build_dataset(args.samples, fonts)
+    model = build_model()
+    model.fit(x, y, epochs=args.epochs, batch_size=128, validation_split=.1)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    model.save(args.output)
+    print("Saved model to", args.output)
+
+
+if __name__ == '__main__':
+    main()